@@ -1,5 +1,7 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 import json
+import time
 import os
 import sys
 import logging
@@ -35,28 +37,58 @@ src_dir = os.path.abspath(os.path.join(current_file_path, '..', 'src'))
 sys.path.insert(0, src_dir)
 
 # the imports rely on env variables that are set above
-import ingestion.ingest as ingest  # noqa:E402 (module level import not at top of file)
-import transformation.transform_raw as transform  # noqa:E402 (module level import not at top of file)
+import ingestion.backfill as backfill  # noqa:E402 (module level import not at top of file)
 
 # Parse command line arguments
 parser = argparse.ArgumentParser()
 parser.add_argument('--max_date', type=str, help='Maximum date for backfilling',
                     default=datetime.today().strftime('%Y-%m-%d'))
+parser.add_argument('--parallelism', type=int, help='Number of months backfilled at a time',
+                    default=backfill.MAX_PARALLELISM)
+parser.add_argument('--max_requests_per_hour', type=int, help='Maximum number of YNAB requests per hour',
+                    default=backfill.MAX_REQUESTS_PER_HOUR)
+parser.add_argument('--restart', action='store_true', help='Backfill the months completed by previous runs again')
+parser.add_argument('--request_per_month', action='store_true',
+                    help='Load every month with its own YNAB request instead of splitting a single budget export')
 args = parser.parse_args()
 
-months = ingest._fetch_raw_json("months")['data']['months']
-
-backfill_count = 0
-last_month = None
-for month in months:
-    month_date = month['month']
-    if args.max_date and datetime.strptime(month_date, '%Y-%m-%d') > datetime.strptime(args.max_date, '%Y-%m-%d'):
-        break
-    logger.info(f"Backfilling {month_date}")
-    ingest.load_current_budget_month(
-        connection_string, datetime.strptime(month_date, '%Y-%m-%d'))
-    transform.transform_budget_month(connection_string, month_date)
-    backfill_count += 1
-    last_month = month_date
-
-logger.info(f"Backfill complete. {backfill_count} months backfilled, Last month: {last_month}")
+# months completed by a previous (failed) run are checkpointed and skipped
+pending = backfill.list_pending_months(connection_string, args.max_date, args.restart)
+
+if not args.request_per_month:
+    logger.info(f"Loading {len(pending)} months from the budget export")
+    backfill.ingest_months(connection_string, pending)
+
+start_times = []
+failed = []
+in_flight = {}
+
+
+def collect(futures) -> None:
+    for future in futures:
+        month_date = in_flight.pop(future)
+        if future.exception() is not None:
+            logger.error(f"Backfill of {month_date} failed: {future.exception()}")
+            failed.append(month_date)
+
+
+with ThreadPoolExecutor(max_workers=args.parallelism) as executor:
+    for month_date in pending:
+        if len(in_flight) >= args.parallelism:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            collect(done)
+
+        # every month is one YNAB request when it is not loaded from the budget export
+        start_time = backfill.next_start_time(start_times, datetime.now(), args.max_requests_per_hour)
+        if args.request_per_month and start_time > datetime.now():
+            logger.info(f"Hourly request limit reached, waiting until {start_time:%H:%M:%S}")
+            time.sleep(max(0, (start_time - datetime.now()).total_seconds()))
+
+        logger.info(f"Backfilling {month_date}")
+        start_times.append(datetime.now())
+        in_flight[executor.submit(
+            backfill.backfill_month, connection_string, month_date, args.request_per_month)] = month_date
+
+    collect(list(in_flight))
+
+logger.info(f"Backfill complete. {len(pending) - len(failed)} months backfilled, {len(failed)} failed: {failed}")
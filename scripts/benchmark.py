@@ -0,0 +1,228 @@
+from typing import Callable, Generator
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import uuid
+# Set up logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+
+formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+ch.setFormatter(formatter)
+
+logger.addHandler(ch)
+
+current_file_path = os.path.dirname(__file__)
+
+# Add the directory containing the modules to the `PYTHONPATH`
+src_dir = os.path.abspath(os.path.join(current_file_path, '..', 'src'))
+sys.path.insert(0, src_dir)
+
+import pandas as pd  # noqa:E402 (module level import not at top of file)
+import transformation.transform_raw as transform  # noqa:E402 (module level import not at top of file)
+import serve.serve_category_scd as category_scd  # noqa:E402 (module level import not at top of file)
+
+
+def benchmark_transactions(count: int) -> None:
+    """Compares the row based transaction cleaning with the vectorized `_transform_transactions`
+    """
+    transactions = [_fake_transaction(i) for i in range(count)]
+
+    def clean_rows() -> pd.DataFrame:
+        rows = [_clean_transaction(subtransaction)
+                for transaction in transactions
+                for subtransaction in _unnest_subtransactions(transaction)]
+        return transform._to_dataframe(rows, transform.TRANSACTION_SCHEMA)
+
+    expected = _time("row based", clean_rows)
+    actual = _time("vectorized", lambda: transform._transform_transactions(transactions))
+
+    pd.testing.assert_frame_equal(actual, expected)
+    logger.info("outputs match")
+
+
+def benchmark_category_scd(count: int) -> None:
+    """Compares the per group `apply` end dates of the category SCD with the vectorized `_set_end_dates` over a
+    synthetic 10 year budget of about `count` category snapshots
+    """
+    df = _fake_budget_months(count)
+    grouped_df = df.groupby(["month", "id", "budgeted"])\
+        .agg(start_date=("snapshot_date", "min"), end_date=("snapshot_date", "max"))\
+        .sort_values(by=["month", "start_date"])\
+        .reset_index()
+    logger.info(f"{len(df)} snapshots, {len(grouped_df)} scd rows")
+
+    def group_apply() -> pd.DataFrame:
+        result = grouped_df.groupby(["month", "id"]).apply(_replace_max_with_none).reset_index(drop=True)
+        return result.groupby(["month", "id"]).apply(_apply_end_date).reset_index(drop=True)
+
+    expected = _time("group apply", group_apply)
+    actual = _time("vectorized", lambda: category_scd._set_end_dates(grouped_df))
+
+    pd.testing.assert_frame_equal(actual, expected)
+    logger.info("outputs match")
+
+
+def _fake_budget_months(count: int) -> pd.DataFrame:
+    months = pd.date_range("2014-01-01", periods=120, freq="MS")
+    # a snapshot every other day, budgeted amounts change a few times a month
+    snapshot_days = range(0, 45, 2)
+    categories = max(1, count // (len(months) * len(snapshot_days)))
+
+    rows = []
+    for month in months:
+        for category in range(categories):
+            budgeted = random.randint(0, 50) * 10
+            for day in snapshot_days:
+                if random.random() < 0.1:
+                    budgeted = random.randint(0, 50) * 10
+                rows.append((month, f"category-{category}", budgeted, month + pd.Timedelta(days=day)))
+
+    return pd.DataFrame(rows, columns=["month", "id", "budgeted", "snapshot_date"])
+
+
+def _fake_transaction(i: int) -> dict:
+    transaction = {
+        "id": str(uuid.uuid4()),
+        "date": f"20{10 + i % 14:02d}-{1 + i % 12:02d}-{1 + i % 28:02d}",
+        "amount": random.randint(-500000, 500000) // 10 * 10,
+        "memo": random.choice(["", None, "coffee"]),
+        "cleared": random.choice(["cleared", "uncleared", "reconciled"]),
+        "approved": True,
+        "flag_color": random.choice([None, "red"]),
+        "account_id": f"account-{i % 5}",
+        "account_name": f"Account {i % 5}",
+        "payee_id": f"payee-{i % 300}",
+        "payee_name": f"Payee {i % 300}",
+        "category_id": f"category-{i % 60}",
+        "category_name": f"Category {i % 60}",
+        "transfer_account_id": None,
+        "transfer_transaction_id": None,
+        "matched_transaction_id": None,
+        "import_id": None,
+        "import_payee_name": None,
+        "import_payee_name_original": None,
+        "debt_transaction_type": None,
+        "deleted": False,
+        "subtransactions": [],
+    }
+
+    # roughly one in ten transactions is a split
+    if i % 10 == 0:
+        transaction["subtransactions"] = [{
+            "id": str(uuid.uuid4()),
+            "transaction_id": transaction["id"],
+            "amount": transaction["amount"] // 20 * 10,
+            "memo": None,
+            "category_id": f"category-{(i + j) % 60}",
+            "category_name": f"Category {(i + j) % 60}",
+            "deleted": False,
+        } for j in range(2)]
+
+    return transaction
+
+
+def _replace_max_with_none(group):
+    group.loc[group["end_date"] == group["end_date"].max(), "end_date"] = None
+    return group
+
+
+def _apply_end_date(group):
+    # Shift the `start_date` column by one row and subtract one day from it to get the end date of the next row
+    next_start_date = group["start_date"].shift(-1) - pd.Timedelta(days=1)
+
+    # Set the `end_date` value to the end date of the next row
+    group.loc[group["end_date"] == group["end_date"].max(),
+              "end_date"] = next_start_date
+
+    return group
+
+
+def _unnest_subtransactions(transaction: dict) -> Generator[dict, None, None]:
+    """ Unnests subtransactions from a transaction, returns transaction if there are no sub transactions
+    """
+
+    if len(transaction["subtransactions"]) == 0:
+        yield transaction
+        return transaction
+
+    for subtransaction in transaction["subtransactions"]:
+
+        yield {
+            "id": transaction["id"],
+            "date": transaction["date"],
+            "amount": subtransaction["amount"],
+            "memo": subtransaction["memo"],
+            "cleared": transaction["cleared"],
+            "approved": transaction["approved"],
+            "flag_color": transaction["flag_color"],
+            "account_id": transaction["account_id"],
+            "account_name": transaction["account_name"],
+            "payee_id": transaction["payee_id"],
+            "payee_name": transaction["payee_name"],
+            "category_id": subtransaction["category_id"],
+            "category_name": subtransaction["category_name"],
+            "transfer_account_id": transaction["transfer_account_id"],
+            "transfer_transaction_id": transaction["transfer_transaction_id"],
+            "matched_transaction_id": transaction["matched_transaction_id"],
+            "import_id": transaction["import_id"],
+            "import_payee_name": transaction["import_payee_name"],
+            "import_payee_name_original": transaction["import_payee_name_original"],
+            "debt_transaction_type": transaction["debt_transaction_type"],
+            "deleted": transaction["deleted"],
+        }
+
+
+def _clean_transaction(transaction: dict) -> dict:
+    """ Cleans a transaction by removing unneeded fields and converting the amount to a decimal
+    """
+    return {
+        "id": transaction["id"],
+        "date": transaction["date"],
+        # Future work allow for the decimal floating point to be dynamically determined
+        # from the /budgets/{budgetId}/settings endpoint
+        "amount": round(transaction["amount"] / 1000, 2),
+        "memo": transaction["memo"],
+        "cleared": transaction["cleared"],
+        "approved": transaction["approved"],
+        "flag_color": transaction["flag_color"],
+        "account_id": transaction["account_id"],
+        "account_name": transaction["account_name"],
+        "payee_id": transaction["payee_id"],
+        "payee_name": transaction["payee_name"],
+        "category_id": transaction["category_id"],
+        "category_name": transaction["category_name"],
+        "transfer_account_id": transaction["transfer_account_id"],
+        "transfer_transaction_id": transaction["transfer_transaction_id"],
+        "debt_transaction_type": transaction["debt_transaction_type"],
+    }
+
+
+def _time(name: str, func: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+    start = time.perf_counter()
+    result = func()
+    logger.info(f"{name}: {time.perf_counter() - start:.3f}s")
+    return result
+
+
+benchmarks = {
+    "transactions": benchmark_transactions,
+    "category_scd": benchmark_category_scd,
+}
+
+# Parse command line arguments
+parser = argparse.ArgumentParser()
+parser.add_argument('benchmark', choices=benchmarks.keys(), help='Benchmark to run')
+parser.add_argument('--count', type=int, help='Number of records to generate', default=100000)
+args = parser.parse_args()
+
+random.seed(0)
+benchmarks[args.benchmark](args.count)
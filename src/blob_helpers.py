@@ -1,42 +1,362 @@
-from azure.storage.blob import BlobServiceClient
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobProperties, ContentSettings
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
+import json
 import logging
+import re
 import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
+import blob_reader
+import blob_writer
+import storage_clients
 
+PARTITION_PATTERN = re.compile(r"year=(?P<year>\d{4})/month=(?P<month>\d{2})/")
+# projected reads of blobs larger than this fetch only the byte ranges of the needed columns and row groups
+RANGED_READ_MIN_SIZE = 8 * 1024 * 1024
+# blob metadata holding the hash of a raw payload, see `ingest.content_hash`
+CONTENT_HASH_METADATA = "content_hash"
 
-def download_parquet(connect_str: str, blob_name: str) -> pd.DataFrame:
-    # Create the BlobServiceClient object
-    blob_service_client = BlobServiceClient.from_connection_string(connect_str)
+# `pq.write_table` options, the blob names advertise snappy so the codec is only changed for datasets whose readers
+# support it (power bi reads snappy and gzip)
+DEFAULT_WRITER_PROFILE = {
+    "compression": "snappy",
+    "compression_level": None,
+    # the columns dictionary encoded, every column when True
+    "use_dictionary": True,
+    "row_group_size": None,
+    # the columns with min/max statistics, every column when True
+    "write_statistics": True,
+    # page level min/max statistics, lets readers skip pages of a row group
+    "write_page_index": False,
+}
+TRANSACTIONS_WRITER_PROFILE = {
+    **DEFAULT_WRITER_PROFILE,
+    # every column but the unique transaction id, dates, amounts and memos repeat often enough to benefit
+    "use_dictionary": ["date", "amount", "memo", "cleared", "approved", "flag_color", "account_id", "account_name",
+                       "payee_id", "payee_name", "category_id", "category_name", "transfer_account_id",
+                       "transfer_transaction_id", "debt_transaction_type"],
+    # a month of transactions is a single row group, the statistics prune by date
+    "row_group_size": 128 * 1024,
+    "write_statistics": ["date", "account_id", "category_id"],
+    "write_page_index": True,
+}
+BUDGET_MONTHS_WRITER_PROFILE = {
+    **DEFAULT_WRITER_PROFILE,
+    "use_dictionary": ["id", "category_group_id", "name", "category_group_name", "hidden", "month", "snapshot_date"],
+    "write_statistics": ["month", "snapshot_date"],
+}
+# writer profiles keyed by blob name prefix, the longest matching prefix is used
+WRITER_PROFILES = {
+    "silver/transactions/": TRANSACTIONS_WRITER_PROFILE,
+    "gold/transactions_fact": TRANSACTIONS_WRITER_PROFILE,
+    "silver/budget_months/": BUDGET_MONTHS_WRITER_PROFILE,
+    "gold/category_scd": BUDGET_MONTHS_WRITER_PROFILE,
+}
 
-    # Get a reference to the blob
-    blob_client = blob_service_client.get_blob_client(
-        container="ynab", blob=blob_name)
 
-    # Download the blob data
-    blob_data = blob_client.download_blob().readall()
-    reader = pa.BufferReader(blob_data)
-    table = pq.read_table(reader)
-    df = table.to_pandas()
-    logging.info(f"downloaded blob `{blob_name}` with {len(blob_data)} bytes")
-    return df
+def download_parquet(
+        connect_str: str,
+        blob_name: str,
+        columns: list[str] = None,
+        filters: list = None,
+        as_arrow: bool = False) -> pd.DataFrame | pa.Table:
+    """Downloads a parquet blob, only the requested columns and matching rows are decoded
+
+    :param list[str] columns:
+        The columns to read, when omitted every column is read.
+    :param list filters:
+        Row filters in the `pyarrow.parquet.read_table` format, e.g. `[("date", ">=", start_date)]`.
+    :param bool as_arrow:
+        Return the Arrow table instead of converting it to a DataFrame.
+    """
+    size = None
+    if columns is not None or filters is not None:
+        # the size decides whether only the needed ranges are fetched
+        properties = get_blob_properties(connect_str, blob_name)
+        size = None if properties is None else properties.size
+
+    table = _download_table(connect_str, blob_name, columns, filters, size)
+    return table if as_arrow else table.to_pandas()
+
+
+def download_parquet_blobs(
+        connect_str: str,
+        blob_names: Iterable[str],
+        columns: list[str] = None,
+        max_concurrency: int = storage_clients.MAX_CONCURRENCY) -> pd.DataFrame:
+    """Downloads many parquet blobs concurrently and combines them into one DataFrame, in the order of `blob_names`
+
+    :param list[str] columns:
+        The columns to read, when omitted every column is read.
+    :param int max_concurrency:
+        The number of blobs downloaded at a time.
+    """
+    tables = _download_tables(connect_str, blob_names, columns, max_concurrency=max_concurrency)
+
+    if len(tables) == 0:
+        return pd.DataFrame(columns=columns)
+
+    return pa.concat_tables(tables).to_pandas()
+
+
+def upload_parquet(connect_str: str, blob_name: str, df: pd.DataFrame | pa.Table, profile: dict = None) -> int:
+    """Uploads a DataFrame (or Arrow table) as a parquet blob
+
+    :param dict profile:
+        The writer options, see `DEFAULT_WRITER_PROFILE`. When omitted the profile of the dataset in
+        `WRITER_PROFILES` is used.
+    """
+    # save data as parquet using pyarrow, Arrow tables are written as is
+    table = df if isinstance(df, pa.Table) else pa.Table.from_pandas(df)
+    options = _writer_options(profile or get_writer_profile(blob_name), table.column_names)
+
+    # the row groups are uploaded in blocks while the rest of the table is encoded, the file is never copied whole
+    blob_client = storage_clients.get_blob_client(connect_str, blob_name)
+    with blob_writer.StagedBlobWriter(blob_client) as writer:
+        pq.write_table(table, writer, **options)
+
+    byte_count = writer.bytes_written
+    logging.info(f"uploaded blob `{blob_name}` with {byte_count} bytes")
+    return byte_count
+
+
+def get_writer_profile(blob_name: str) -> dict:
+    prefixes = [prefix for prefix in WRITER_PROFILES if blob_name.startswith(prefix)]
+    return WRITER_PROFILES[max(prefixes, key=len)] if len(prefixes) > 0 else DEFAULT_WRITER_PROFILE
 
 
-def upload_parquet(connect_str: str, blob_name: str, df: pd.DataFrame) -> int:
+def _writer_options(profile: dict, column_names: list[str]) -> dict:
+    options = {**DEFAULT_WRITER_PROFILE, **profile}
 
-    # save data as parquet using pyarrow
-    table = pa.Table.from_pandas(df)
+    # column lists only name the columns of the table
+    for option in ["use_dictionary", "write_statistics"]:
+        if isinstance(options[option], list):
+            options[option] = [column for column in options[option] if column in column_names]
 
-    # Write the table to a buffer as a Parquet file
-    buffer = pa.BufferOutputStream()
-    pq.write_table(table, buffer)
-    data = buffer.getvalue().to_pybytes()
+    if options["row_group_size"] is None:
+        del options["row_group_size"]
 
-    # Create the BlobServiceClient object which will be used to create a container client
-    blob_service_client = BlobServiceClient.from_connection_string(connect_str)
-    blob_client = blob_service_client.get_blob_client(
-        container="ynab", blob=blob_name)
-    blob_client.upload_blob(data, overwrite=True)
+    return options
+
+
+def download_json(connect_str: str, blob_name: str) -> dict | None:
+    blob_client = storage_clients.get_blob_client(connect_str, blob_name)
+
+    # missing state blobs are expected on the first run
+    try:
+        blob_data = blob_client.download_blob().readall()
+    except ResourceNotFoundError:
+        logging.info(f"blob `{blob_name}` not found")
+        return None
+
+    return json.loads(blob_data)
+
+
+def upload_json(connect_str: str, blob_name: str, obj: dict) -> int:
+    data = json.dumps(obj).encode("utf-8")
+
+    blob_client = storage_clients.get_blob_client(connect_str, blob_name)
+    blob_client.upload_blob(data, overwrite=True, content_settings=ContentSettings(
+        content_type="application/json"))
     byte_count = len(data)
     logging.info(f"uploaded blob `{blob_name}` with {byte_count} bytes")
     return byte_count
+
+
+def upload_partitioned_parquet(
+        connect_str: str,
+        dataset: str,
+        df: pd.DataFrame,
+        months: Iterable[pd.Timestamp] = None,
+        date_column: str = "date") -> int:
+    """Uploads a DataFrame as a Hive style (`year=YYYY/month=MM`) month partitioned parquet dataset
+
+    :param str dataset:
+        The blob prefix of the dataset, e.g. `silver/transactions`.
+    :param Iterable[pd.Timestamp] months:
+        The months (first day) to write, any month without rows is deleted. When omitted every month is written
+        and partitions without rows are deleted.
+    """
+    partition_months = df[date_column].dt.to_period("M").dt.to_timestamp()
+
+    if months is None:
+        months = set(partition_months) | set(list_partitions(connect_str, dataset).keys())
+
+    byte_count = 0
+    for month in sorted(months):
+        month_df = df[partition_months == month].reset_index(drop=True)
+        blob_name = _partition_blob_name(dataset, month)
+
+        if len(month_df) == 0:
+            delete_blob(connect_str, blob_name)
+            continue
+
+        byte_count += upload_parquet(connect_str, blob_name, month_df)
+
+    return byte_count
+
+
+def download_partitioned_parquet(
+        connect_str: str,
+        dataset: str,
+        start_date: pd.Timestamp = None,
+        end_date: pd.Timestamp = None,
+        columns: list[str] = None,
+        date_column: str = "date",
+        as_arrow: bool = False,
+        months: Iterable[pd.Timestamp] = None) -> pd.DataFrame | pa.Table:
+    """Downloads a month partitioned parquet dataset, only the partitions (and row groups) overlapping the date
+    range are fetched
+
+    :param pd.Timestamp start_date:
+        The first date (inclusive) to read, when omitted the dataset is read from the start.
+    :param pd.Timestamp end_date:
+        The last date (inclusive) to read, when omitted the dataset is read to the end.
+    :param list[str] columns:
+        The columns to read, when omitted every column is read.
+    :param bool as_arrow:
+        Return the Arrow table instead of converting it to a DataFrame.
+    :param Iterable[pd.Timestamp] months:
+        The months (first day) to read, when omitted every month in the date range is read.
+    """
+    months = None if months is None else set(months)
+    filters = []
+    if start_date is not None:
+        filters.append((date_column, ">=", start_date))
+    if end_date is not None:
+        filters.append((date_column, "<=", end_date))
+
+    partitions = list_partitions(connect_str, dataset)
+    blobs = []
+    for month, blob in sorted(partitions.items()):
+        # prune partitions outside of the date range
+        if start_date is not None and month < start_date.to_period("M").to_timestamp():
+            continue
+        if end_date is not None and month > end_date:
+            continue
+        if months is not None and month not in months:
+            continue
+
+        blobs.append(blob)
+
+    tables = _download_tables(
+        connect_str, [blob.name for blob in blobs], columns, filters or None, sizes=[blob.size for blob in blobs])
+
+    # a range without partitions (e.g. a month whose transactions were all deleted) is still typed like the dataset
+    table = pa.concat_tables(tables) if len(tables) > 0 else _empty_table(connect_str, partitions, columns, date_column)
+    return table if as_arrow else table.to_pandas()
+
+
+def _empty_table(
+        connect_str: str,
+        partitions: dict[pd.Timestamp, BlobProperties],
+        columns: list[str] = None,
+        date_column: str = "date") -> pa.Table:
+    """An empty table with the schema of the dataset, read from the footer of any of its partitions. A dataset
+    without partitions only types the date column.
+    """
+    if len(partitions) == 0:
+        schema = pa.schema([(column, pa.timestamp("ns") if column == date_column else pa.null())
+                            for column in columns or [date_column]])
+        return schema.empty_table()
+
+    blob = next(iter(partitions.values()))
+    reader = blob_reader.RangedBlobReader(storage_clients.get_blob_client(connect_str, blob.name), blob.size)
+    table = pq.read_schema(reader).empty_table()
+    return table if columns is None else table.select(columns)
+
+
+def list_partitions(connect_str: str, dataset: str) -> dict[pd.Timestamp, BlobProperties]:
+    """Lists the partitions of a month partitioned parquet dataset keyed by month (first day)
+    """
+    container_client = storage_clients.get_container_client(connect_str)
+
+    partitions = {}
+    for blob in container_client.list_blobs(name_starts_with=f"{dataset}/"):
+        match = PARTITION_PATTERN.search(blob.name)
+        if match is not None:
+            partitions[pd.Timestamp(year=int(match["year"]), month=int(match["month"]), day=1)] = blob
+
+    return partitions
+
+
+def _partition_blob_name(dataset: str, month: pd.Timestamp) -> str:
+    return f"{dataset}/year={month.year}/month={month.month:02d}/part-0.snappy.parquet"
+
+
+def _download_tables(
+        connect_str: str,
+        blob_names: Iterable[str],
+        columns: list[str] = None,
+        filters: list = None,
+        max_concurrency: int = storage_clients.MAX_CONCURRENCY,
+        sizes: list[int] = None) -> list[pa.Table]:
+    blob_names = list(blob_names)
+    sizes = sizes or [None] * len(blob_names)
+
+    # map keeps the order of the blob names regardless of which download finishes first
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        return list(executor.map(
+            lambda blob_name, size: _download_table(connect_str, blob_name, columns, filters, size), blob_names, sizes))
+
+
+def _download_table(
+        connect_str: str,
+        blob_name: str,
+        columns: list[str] = None,
+        filters: list = None,
+        size: int = None) -> pa.Table:
+    blob_client = storage_clients.get_blob_client(connect_str, blob_name)
+
+    if (columns is not None or filters is not None) and size is not None and size > RANGED_READ_MIN_SIZE:
+        # pyarrow reads the footer first and then only the column chunks of the row groups it needs
+        reader = blob_reader.RangedBlobReader(blob_client, size)
+        table = pq.read_table(reader, columns=columns, filters=filters)
+        logging.info(f"downloaded {reader.bytes_downloaded} of {size} bytes of blob `{blob_name}` in "
+                     f"{reader.request_count} range requests")
+        return table
+
+    # Download the blob data
+    blob_data = blob_client.download_blob().readall()
+    table = pq.read_table(pa.BufferReader(blob_data), columns=columns, filters=filters)
+    logging.info(f"downloaded blob `{blob_name}` with {len(blob_data)} bytes")
+    return table
+
+
+def get_blob_properties(connect_str: str, blob_name: str) -> BlobProperties | None:
+    blob_client = storage_clients.get_blob_client(connect_str, blob_name)
+
+    try:
+        return blob_client.get_blob_properties()
+    except ResourceNotFoundError:
+        logging.info(f"blob `{blob_name}` not found")
+        return None
+
+
+def get_content_hash(connect_str: str, blob_name: str) -> str | None:
+    properties = get_blob_properties(connect_str, blob_name)
+    return None if properties is None else properties.metadata.get(CONTENT_HASH_METADATA)
+
+
+def is_stale(connect_str: str, target_blob_name: str, sources: Iterable[BlobProperties | None]) -> bool:
+    """Whether a blob is missing or older than any of the blobs it is built from
+
+    :param Iterable[BlobProperties | None] sources: the blobs the target is built from, missing ones are skipped
+    """
+    target = get_blob_properties(connect_str, target_blob_name)
+    if target is None:
+        return True
+
+    return any(source is not None and source.last_modified > target.last_modified for source in sources)
+
+
+def delete_blob(connect_str: str, blob_name: str) -> None:
+    blob_client = storage_clients.get_blob_client(connect_str, blob_name)
+
+    try:
+        blob_client.delete_blob()
+        logging.info(f"deleted blob `{blob_name}`")
+    except ResourceNotFoundError:
+        pass
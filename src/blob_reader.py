@@ -0,0 +1,131 @@
+from azure.storage.blob import BlobClient
+from collections import OrderedDict
+import io
+import logging
+import threading
+
+# ranges are fetched and cached in blocks, reads of consecutive missing blocks are merged into one request
+BLOCK_SIZE = 1024 * 1024
+CACHE_BLOCKS = 64
+
+
+class RangedBlobReader(io.RawIOBase):
+    """ A read only, seekable file over a blob that downloads only the byte ranges that are read
+
+    Lets pyarrow read the parquet footer first and then fetch only the column chunks (and row groups) it needs,
+    instead of downloading the whole blob. Fetched blocks are kept in a LRU cache so the footer and page headers are
+    not requested twice.
+    """
+
+    def __init__(
+            self,
+            blob_client: BlobClient,
+            size: int = None,
+            block_size: int = BLOCK_SIZE,
+            cache_blocks: int = CACHE_BLOCKS):
+        """
+        :param BlobClient blob_client: the blob to read
+        :param int size: the size of the blob in bytes, fetched from the blob properties when omitted
+        :param int block_size: the size of the cached ranges
+        :param int cache_blocks: the number of ranges kept in memory
+        """
+        super().__init__()
+        self._blob_client = blob_client
+        self.size = blob_client.get_blob_properties().size if size is None else size
+        self._block_size = block_size
+        self._cache_blocks = cache_blocks
+        self._blocks: OrderedDict[int, bytes] = OrderedDict()
+        self._position = 0
+        # pyarrow can read from several threads when it pre buffers column chunks
+        self._lock = threading.Lock()
+        self.request_count = 0
+        self.bytes_downloaded = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"invalid whence {whence}")
+
+        if position < 0:
+            raise ValueError(f"negative seek position {position}")
+
+        self._position = position
+        return position
+
+    def readinto(self, buffer) -> int:
+        data = self.read_range(self._position, len(buffer))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def readall(self) -> bytes:
+        data = self.read_range(self._position, self.size - self._position)
+        self._position += len(data)
+        return data
+
+    def read_range(self, start: int, length: int) -> bytes:
+        """ Reads `length` bytes from `start` without moving the position, downloading the missing blocks
+        """
+        end = min(start + length, self.size)
+        if start >= end:
+            return b""
+
+        first_block, last_block = start // self._block_size, (end - 1) // self._block_size
+        with self._lock:
+            blocks = self._get_blocks(first_block, last_block)
+
+        data = b"".join(blocks)
+        offset = first_block * self._block_size
+        return data[start - offset:end - offset]
+
+    def _get_blocks(self, first_block: int, last_block: int) -> list[bytes]:
+        blocks = {index: self._blocks[index] for index in range(first_block, last_block + 1) if index in self._blocks}
+
+        index = first_block
+        while index <= last_block:
+            if index in blocks:
+                index += 1
+                continue
+
+            # fetch the run of missing blocks in one request
+            run_end = index
+            while run_end + 1 <= last_block and run_end + 1 not in blocks:
+                run_end += 1
+            blocks.update(self._download_blocks(index, run_end))
+            index = run_end + 1
+
+        for index in range(first_block, last_block + 1):
+            self._cache(index, blocks[index])
+
+        return [blocks[index] for index in range(first_block, last_block + 1)]
+
+    def _download_blocks(self, first_block: int, last_block: int) -> dict[int, bytes]:
+        offset = first_block * self._block_size
+        length = min((last_block + 1) * self._block_size, self.size) - offset
+        data = self._blob_client.download_blob(offset=offset, length=length).readall()
+        self.request_count += 1
+        self.bytes_downloaded += len(data)
+        logging.debug(f"downloaded range {offset}-{offset + length - 1} of blob `{self._blob_client.blob_name}`")
+
+        return {index: data[(index - first_block) * self._block_size:(index - first_block + 1) * self._block_size]
+                for index in range(first_block, last_block + 1)}
+
+    def _cache(self, index: int, block: bytes) -> None:
+        self._blocks[index] = block
+        self._blocks.move_to_end(index)
+        while len(self._blocks) > self._cache_blocks:
+            self._blocks.popitem(last=False)
@@ -0,0 +1,122 @@
+from azure.storage.blob import BlobClient
+from concurrent.futures import Future, ThreadPoolExecutor
+import io
+import storage_clients
+
+# the data is uploaded in blocks of this size while it is still being written
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class StagedBlobWriter(io.RawIOBase):
+    """ A write only file that uploads a block blob while it is being written
+
+    Every full block is staged in the background while the writer carries on, so encoding a parquet file overlaps
+    with its upload and at most `max_concurrency` blocks are held in memory instead of the whole file. The blocks are
+    only committed by `commit`, which a `with` block calls when it exits without an exception. A writer closed any
+    other way (an exception, `close`, or garbage collection) leaves the existing blob untouched. Data smaller than a
+    block is uploaded with a single request.
+    """
+
+    def __init__(
+            self,
+            blob_client: BlobClient,
+            block_size: int = BLOCK_SIZE,
+            max_concurrency: int = storage_clients.MAX_CONCURRENCY,
+            metadata: dict[str, str] = None,
+            **upload_kwargs):
+        """
+        :param BlobClient blob_client: the blob to write, it is overwritten
+        :param int block_size: the size of the staged blocks
+        :param int max_concurrency: the number of blocks uploaded at a time
+        :param dict[str, str] metadata: the metadata of the blob, can be changed until the writer is closed
+        :param upload_kwargs: passed to `upload_blob` or `commit_block_list`, e.g. `content_settings`
+        """
+        super().__init__()
+        self._blob_client = blob_client
+        self._block_size = block_size
+        self._max_concurrency = max_concurrency
+        self.metadata = metadata
+        self._upload_kwargs = upload_kwargs
+        self._buffer = bytearray()
+        self._block_ids: list[str] = []
+        self._pending: list[Future] = []
+        self._executor: ThreadPoolExecutor | None = None
+        self.bytes_written = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.bytes_written
+
+    def write(self, data) -> int:
+        view = memoryview(data).cast("B")
+        self._buffer += view
+        self.bytes_written += len(view)
+
+        while len(self._buffer) >= self._block_size:
+            self._stage_block(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+
+        return len(view)
+
+    def commit(self) -> None:
+        """ Uploads the data written and closes the writer
+        """
+        if self.closed:
+            return
+
+        try:
+            if len(self._block_ids) == 0:
+                self._blob_client.upload_blob(bytes(self._buffer), overwrite=True, **self._blob_kwargs())
+            else:
+                if len(self._buffer) > 0:
+                    self._stage_block(bytes(self._buffer))
+                for future in self._pending:
+                    future.result()
+                self._blob_client.commit_block_list(self._block_ids, **self._blob_kwargs())
+        finally:
+            self._shutdown()
+            super().close()
+
+    def close(self) -> None:
+        """ Closes the writer without committing, `io.IOBase` also closes a writer that is garbage collected
+        """
+        self.abort()
+
+    def abort(self) -> None:
+        """ Closes the writer without committing, the staged blocks are discarded by the storage account
+        """
+        for future in self._pending:
+            future.cancel()
+        self._shutdown()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.commit()
+
+    def _stage_block(self, block: bytes) -> None:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._max_concurrency)
+
+        # wait for the oldest upload so the blocks in flight are bounded, this also surfaces upload errors early
+        if len(self._pending) >= self._max_concurrency:
+            self._pending.pop(0).result()
+
+        # block ids of a blob must all have the same length
+        block_id = f"{len(self._block_ids):06d}"
+        self._block_ids.append(block_id)
+        self._pending.append(self._executor.submit(
+            self._blob_client.stage_block, block_id, block, length=len(block)))
+
+    def _blob_kwargs(self) -> dict:
+        return self._upload_kwargs if self.metadata is None else {**self._upload_kwargs, "metadata": self.metadata}
+
+    def _shutdown(self) -> None:
+        self._buffer = bytearray()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
@@ -1,14 +1,18 @@
 from datetime import datetime
 from date_helpers import add_month
+import json
 import logging
 import azure.functions as func
 import azure.durable_functions as df
 import os
+import pipeline_dag
+import ingestion.backfill as backfill
 import ingestion.ingest as ingest
 import transformation.transform_raw as transform_raw
 import serve.serve_category_scd as serve_category_scd
 import serve.serve_monthly_net_worth as serve_monthly_net_worth
 import serve.serve_age_of_money as serve_age_of_money
+import serve.serve_pipeline_state as serve_pipeline_state
 import serve.serve_transactions_star_schema as serve_transaction_star_schema
 import validate.validate_accounts as validate_accounts
 
@@ -18,81 +22,131 @@ connect_str = os.getenv('AzureWebJobsStorage')
 
 @app.orchestration_trigger(context_name="context")
 def ynab_pipeline_orchestrator(context: df.DurableOrchestrationContext):
-
-    # ******Bronze******
+    """Runs the nightly pipeline as a DAG (see `pipeline_dag.nightly_pipeline`), every activity starts as soon as
+    the activities writing its inputs finished and is skipped when none of its inputs changed
+    """
     first_retry_interval_in_milliseconds = 60000
     max_number_of_attempts = 3
 
+    # auto retry api calls in the event of a transient failure of the YNAB api
     retry_options = df.RetryOptions(
         first_retry_interval_in_milliseconds, max_number_of_attempts)
-    logging.info('ingestion start')
-    # auto retry api calls in the event of a transient failure of the YNAB api
-    bronze_tasks = [
-        context.call_activity_with_retry(load_transactions, retry_options),
-        context.call_activity_with_retry(load_accounts, retry_options),
-        context.call_activity_with_retry(
-            load_current_budget_month, retry_options, context.current_utc_datetime.strftime("%Y-%m-%d")),
-    ]
+    scheduler = pipeline_dag.PipelineScheduler(pipeline_dag.nightly_pipeline(context.current_utc_datetime))
+    in_flight = []
 
-    if context.current_utc_datetime.day <= 15:
-        bronze_tasks.append(context.call_activity_with_retry(
-            load_previous_budget_month, retry_options, context.current_utc_datetime.strftime("%Y-%m-%d")))
+    logging.info('pipeline start')
+    while True:
+        for name in scheduler.next_steps():
+            in_flight.append((_call_step(context, name, scheduler.steps[name], retry_options), name))
+        if len(in_flight) == 0:
+            break
 
-    yield context.task_all(bronze_tasks)
+        finished = yield context.task_any([task for task, _ in in_flight])
+        name = next(name for task, name in in_flight if task is finished)
+        in_flight = [(task, other) for task, other in in_flight if task is not finished]
+        if isinstance(finished.result, Exception):
+            raise finished.result
 
-    logging.info('All files ingested')
+        scheduler.complete(name, finished.result)
+        logging.info(f'{name} complete')
 
-    # ******Silver******
+    logging.info(f'pipeline complete, skipped {len(scheduler.skipped)} unchanged steps: {scheduler.skipped}')
 
-    # transform raw form into parquet files
-    silver_tasks = [
-        context.call_activity(transform_transactions),
-        context.call_activity(transform_accounts),
-        context.call_activity(transform_current_budget_month,
-                              context.current_utc_datetime.strftime("%Y-%m-01")),
-    ]
+    # validate results
+    # TODO: there is a bug in the YNAB api so I cannot properly calculate the interest and escrow amounts
+    # for my mortgage account, commenting out for now since it will always fail
+    # validation_tasks = [
+    #     context.call_activity('validate_transactions_fact'),
+    #     context.call_activity('validate_net_worth_fact_activity'),
+    # ]
 
-    if context.current_utc_datetime.day <= 15:
-        silver_tasks.append(context.call_activity(
-            transform_previous_budget_month, add_month(context.current_utc_datetime, -1).strftime("%Y-%m-01")))
+    # yield context.task_all(validation_tasks)
 
-    yield context.task_all(silver_tasks)
 
-    logging.info('transform complete')
+def _call_step(
+        context: df.DurableOrchestrationContext,
+        name: str,
+        step: dict,
+        retry_options: df.RetryOptions):
+    if step["retry"]:
+        return context.call_activity_with_retry(name, retry_options, step["input"])
 
-    # # ******Gold******
-    gold_tasks = [
-        # catagories SCD
-        context.call_activity(serve_category_scd_activity),
+    return context.call_activity(name, step["input"])
 
-        # transaction star schema
-        context.call_activity(create_transactions_fact_activity),
-        context.call_activity(serve_category_dim_activity),
-        context.call_activity(serve_accounts_dim_activity),
-        context.call_activity(serve_payee_dim_activity)
-    ]
 
-    yield context.task_all(gold_tasks)
+@app.orchestration_trigger(context_name="context")
+def ynab_backfill_orchestrator(context: df.DurableOrchestrationContext):
+    """Backfills every budget month up to `max_date`, `max_parallelism` months at a time. The months are loaded with
+    a single request to the budget export, or with `single_request` off one request per month and at most
+    `max_requests_per_hour` YNAB requests per hour. Months are checkpointed as they finish, so a failed backfill
+    started again only loads the months that are missing.
+    """
+    options = context.get_input() or {}
+    single_request = options.get("single_request", True)
 
-    additional_tasks = [
-        context.call_activity(serve_category_variance_activity),
-        context.call_activity(serve_net_worth_fact_activity),
-        context.call_activity(serve_age_of_money_activity)
-    ]
-    # calculate net worth
-    yield context.task_all(additional_tasks)
+    pending = yield context.call_activity(list_backfill_months, options)
+    pending = list(pending)
 
-    logging.info('gold complete')
+    if single_request and len(pending) > 0:
+        yield context.call_activity_with_retry(load_budget_months, df.RetryOptions(60000, 3), {"months": pending})
 
-    # validate results
-    # TODO: there is a bug in the YNAB api so I cannot properly calculate the interest and escrow amounts
-    # for my mortgage account, commenting out for now since it will always fail
-    # validation_tasks = [
-    #     context.call_activity('validate_transactions_fact'),
-    #     context.call_activity('validate_net_worth_fact_activity'),
-    # ]
+    failed, completed_count = yield from _backfill_months(context, pending, options, ingest_months=not single_request)
+
+    if len(failed) > 0:
+        raise Exception(f"backfill failed for {len(failed)} month(s): {failed}, start the backfill again to retry them")
+
+    return completed_count
 
-    # yield context.task_all(validation_tasks)
+
+def _backfill_months(context: df.DurableOrchestrationContext, pending: list[str], options: dict, ingest_months: bool):
+    max_parallelism = options.get("max_parallelism", backfill.MAX_PARALLELISM)
+    max_requests_per_hour = options.get("max_requests_per_hour", backfill.MAX_REQUESTS_PER_HOUR)
+    in_flight, start_times, failed = [], [], []
+    completed_count = 0
+
+    while len(pending) > 0 or len(in_flight) > 0:
+        if len(pending) > 0 and len(in_flight) < max_parallelism:
+            # every month ingested is one YNAB request, wait on a durable timer when the hourly budget is spent
+            start_time = backfill.next_start_time(start_times, context.current_utc_datetime, max_requests_per_hour)
+            if ingest_months and start_time > context.current_utc_datetime:
+                yield context.create_timer(start_time)
+
+            start_times.append(context.current_utc_datetime)
+            month = pending.pop(0)
+            in_flight.append((context.call_sub_orchestrator(
+                ynab_backfill_month_orchestrator, {"month": month, "ingest": ingest_months}), month))
+            continue
+
+        finished = yield context.task_any([task for task, _ in in_flight])
+        month = next(month for task, month in in_flight if task is finished)
+        in_flight = [(task, other) for task, other in in_flight if task is not finished]
+        # a sub orchestrator that failed outright has an exception as its result rather than the month
+        if not isinstance(finished.result, dict) or "error" in finished.result:
+            failed.append(month)
+        else:
+            completed_count += 1
+        context.set_custom_status({"completed": completed_count, "failed": failed, "pending": len(pending)})
+
+    return failed, completed_count
+
+
+@app.orchestration_trigger(context_name="context")
+def ynab_backfill_month_orchestrator(context: df.DurableOrchestrationContext):
+    month_input = context.get_input()
+    month = month_input["month"]
+    retry_options = df.RetryOptions(60000, 3)
+
+    # failures are returned instead of raised so the other months of the backfill carry on
+    try:
+        if month_input.get("ingest", True):
+            yield context.call_activity_with_retry(load_current_budget_month, retry_options, month)
+        yield context.call_activity_with_retry(transform_current_budget_month, retry_options, month)
+        yield context.call_activity(checkpoint_backfill_month, month)
+    except Exception as e:
+        logging.error(f"backfill of {month} failed: {e}")
+        return {"month": month, "error": str(e)}
+
+    return {"month": month}
 
 # region orchestrator triggers
 
@@ -107,17 +161,29 @@ async def ynab_pipeline_orchestrator_trigger(timer: func.TimerRequest, client: d
 
     logging.info(f"Started orchestration with ID = '{instance_id}'.")
 
+
+@app.route(route="backfill", methods=["POST"])
+@app.durable_client_input(client_name="client")
+async def ynab_backfill_orchestrator_start(req: func.HttpRequest, client: df.DurableOrchestrationClient):
+    # optional body: {"max_date": "%Y-%m-%d", "restart": false, "single_request": true, "max_parallelism": 4,
+    #                 "max_requests_per_hour": 150}
+    options = json.loads(req.get_body() or b"{}")
+    instance_id = await client.start_new('ynab_backfill_orchestrator', client_input=options)
+
+    logging.info(f"Started backfill orchestration with ID = '{instance_id}'.")
+    return client.create_check_status_response(req, instance_id)
+
 #  endregion
 
 # region Bronze
 
 
 @app.activity_trigger(input_name="input")
-def load_transactions(input):
+def load_transactions(input: bool):
     connect_str = os.getenv('AzureWebJobsStorage')
-    upload_size = ingest.load_transactions(connect_str)
+    upload_size = ingest.load_transactions(connect_str, incremental=not input)
     logging.info(f"load_transactions: Uploaded {upload_size} bytes")
-    return upload_size
+    return {"upload_size": upload_size, "changed": transform_raw.transactions_changed(connect_str)}
 
 
 @app.activity_trigger(input_name="input")
@@ -126,7 +192,7 @@ def load_accounts(input):
     # return ingest.load_accounts(connect_str)
     upload_size = ingest.load_accounts(connect_str)
     logging.info(f"load_accounts: Uploaded {upload_size} bytes")
-    return upload_size
+    return {"upload_size": upload_size, "changed": transform_raw.accounts_changed(connect_str)}
 
 
 @app.activity_trigger(input_name="input")
@@ -135,7 +201,8 @@ def load_current_budget_month(input: str):
     date = datetime.strptime(input, '%Y-%m-%d')
     upload_size = ingest.load_current_budget_month(connect_str, date)
     logging.info(f"load_current_budget_month: Uploaded {upload_size} bytes")
-    return upload_size
+    return {"upload_size": upload_size,
+            "changed": transform_raw.budget_month_changed(connect_str, date.strftime("%Y-%m-01"))}
 
 
 @app.activity_trigger(input_name="input")
@@ -144,7 +211,32 @@ def load_previous_budget_month(input: str):
     date = datetime.strptime(input, '%Y-%m-%d')
     upload_size = ingest.load_previous_budget_month(connect_str, date)
     logging.info(f"load_previous_budget_month: Uploaded {upload_size} bytes")
+    return {"upload_size": upload_size,
+            "changed": transform_raw.budget_month_changed(connect_str, add_month(date, -1).strftime("%Y-%m-01"))}
+
+
+@app.activity_trigger(input_name="input")
+def load_budget_months(input: dict):
+    connect_str = os.getenv('AzureWebJobsStorage')
+    upload_sizes = ingest.load_budget_months(connect_str, input["months"])
+    upload_size = sum(upload_sizes.values())
+    logging.info(f"load_budget_months: Uploaded {upload_size} bytes for {len(upload_sizes)} months")
     return upload_size
+
+
+@app.activity_trigger(input_name="input")
+def list_backfill_months(input: dict):
+    connect_str = os.getenv('AzureWebJobsStorage')
+    max_date = input.get("max_date") or datetime.today().strftime("%Y-%m-%d")
+    return backfill.list_pending_months(connect_str, max_date, input.get("restart", False))
+
+
+@app.activity_trigger(input_name="input")
+def checkpoint_backfill_month(input: str):
+    connect_str = os.getenv('AzureWebJobsStorage')
+    backfill.checkpoint_month(connect_str, input)
+    logging.info(f"checkpoint_backfill_month: {input} backfilled")
+    return input
 #  endregion
 
 # region Silver
@@ -153,7 +245,9 @@ def load_previous_budget_month(input: str):
 @app.activity_trigger(input_name="input")
 def transform_transactions(input):
     connect_str = os.getenv('AzureWebJobsStorage')
-    upload_size = transform_raw.transform_transactions(connect_str)
+    # falls back to a full rebuild after a full bronze refresh
+    upload_size = transform_raw.transform_transactions(
+        connect_str, incremental=True)
     logging.info(f"transform_transactions: Uploaded {upload_size} bytes")
     return upload_size
 
@@ -229,7 +323,7 @@ def serve_payee_dim_activity(input):
 @app.activity_trigger(input_name="input")
 def serve_net_worth_fact_activity(input):
     connect_str = os.getenv('AzureWebJobsStorage')
-    upload_size = serve_monthly_net_worth.create_net_worth_fact(connect_str)
+    upload_size = serve_monthly_net_worth.create_net_worth_fact(connect_str, incremental=True)
     logging.info(f"create_net_worth_fact: Uploaded {upload_size} bytes")
     return upload_size
 
@@ -237,7 +331,7 @@ def serve_net_worth_fact_activity(input):
 @app.activity_trigger(input_name="input")
 def serve_category_scd_activity(input):
     connect_str = os.getenv('AzureWebJobsStorage')
-    upload_size = serve_category_scd.create_category_scd(connect_str)
+    upload_size = serve_category_scd.create_category_scd(connect_str, incremental=True)
     logging.info(f"create_category_scd: Uploaded {upload_size} bytes")
     return upload_size
 
@@ -245,7 +339,7 @@ def serve_category_scd_activity(input):
 @app.activity_trigger(input_name="input")
 def serve_category_variance_activity(input):
     connect_str = os.getenv('AzureWebJobsStorage')
-    upload_size = serve_category_scd.create_category_variance(connect_str)
+    upload_size = serve_category_scd.create_category_variance(connect_str, incremental=True)
     logging.info(f"create_category_variance: Uploaded {upload_size} bytes")
     return upload_size
 
@@ -253,11 +347,23 @@ def serve_category_variance_activity(input):
 @app.activity_trigger(input_name="input")
 def serve_age_of_money_activity(input):
     connect_str = os.getenv('AzureWebJobsStorage')
-    upload_size = serve_age_of_money.create_age_of_money_fact(connect_str)
+    upload_size = serve_age_of_money.create_age_of_money_fact(connect_str, incremental=True)
     logging.info(f"create_age_of_money_fact: Uploaded {upload_size} bytes")
     return upload_size
 # endregion Views
 
+
+@app.activity_trigger(input_name="input")
+def silver_changed_activity(input) -> bool:
+    connect_str = os.getenv('AzureWebJobsStorage')
+    return serve_pipeline_state.silver_changed(connect_str)
+
+
+@app.activity_trigger(input_name="input")
+def mark_gold_built_activity(input):
+    connect_str = os.getenv('AzureWebJobsStorage')
+    return serve_pipeline_state.mark_gold_built(connect_str)
+
 # endregion Gold
 
 # region Validation
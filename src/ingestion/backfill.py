@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta
+import logging
+import os
+import blob_helpers
+import ingestion.ingest as ingest
+import storage_clients
+import transformation.transform_raw as transform_raw
+
+# one marker blob per backfilled month, separate blobs so concurrent months never overwrite each other's checkpoint
+BACKFILL_CHECKPOINT_PREFIX = "bronze/backfill/"
+# budget months ingested and transformed at a time
+MAX_PARALLELISM = int(os.getenv("BACKFILL_MAX_PARALLELISM", "4"))
+# YNAB allows 200 requests per hour per token, the rest is left to the nightly run
+MAX_REQUESTS_PER_HOUR = int(os.getenv("BACKFILL_MAX_REQUESTS_PER_HOUR", "150"))
+RATE_LIMIT_WINDOW = timedelta(hours=1)
+
+
+def list_pending_months(connect_str: str, max_date: str, restart: bool = False) -> list[str]:
+    """Lists the budget months up to `max_date` that were not backfilled yet, oldest first
+
+    :param str max_date: the last month (`%Y-%m-%d`) to backfill
+    :param bool restart: forget the months checkpointed by previous backfills
+    """
+    months = [month["month"] for month in ingest._fetch_raw_json("months")["data"]["months"]
+              if month["month"] <= max_date]
+
+    if restart:
+        for month in list_completed_months(connect_str):
+            blob_helpers.delete_blob(connect_str, _checkpoint_blob_name(month))
+
+    completed = list_completed_months(connect_str)
+    pending = sorted(month for month in months if month not in completed)
+    logging.info(f"{len(pending)} of {len(months)} budget months to backfill")
+    return pending
+
+
+def list_completed_months(connect_str: str) -> set[str]:
+    container_client = storage_clients.get_container_client(connect_str)
+
+    return {blob.name[len(BACKFILL_CHECKPOINT_PREFIX):].removesuffix(".json")
+            for blob in container_client.list_blobs(name_starts_with=BACKFILL_CHECKPOINT_PREFIX)}
+
+
+def ingest_months(connect_str: str, months: list[str]) -> int:
+    """Ingests many budget months with a single YNAB request, see `ingest.load_budget_months`
+
+    :param list[str] months: the first days of the months (`%Y-%m-%d`)
+    """
+    if len(months) == 0:
+        return 0
+
+    return sum(ingest.load_budget_months(connect_str, months).values())
+
+
+def backfill_month(connect_str: str, month: str, ingest_month: bool = True) -> int:
+    """Ingests and transforms a budget month and checkpoints it
+
+    :param str month: the first day of the month (`%Y-%m-%d`)
+    :param bool ingest_month: load the month from YNAB first, off when it was loaded by `ingest_months`
+    """
+    upload_size = 0
+    if ingest_month:
+        upload_size += ingest.load_current_budget_month(connect_str, datetime.strptime(month, "%Y-%m-%d"))
+    upload_size += transform_raw.transform_budget_month(connect_str, month)
+    checkpoint_month(connect_str, month, upload_size)
+    return upload_size
+
+
+def checkpoint_month(connect_str: str, month: str, upload_size: int = None) -> None:
+    blob_helpers.upload_json(connect_str, _checkpoint_blob_name(month), {
+        "month": month,
+        "upload_size": upload_size,
+    })
+
+
+def next_start_time(
+        start_times: list[datetime],
+        now: datetime,
+        max_requests: int = MAX_REQUESTS_PER_HOUR,
+        window: timedelta = RATE_LIMIT_WINDOW) -> datetime:
+    """Returns the earliest time the next request can start without more than `max_requests` in any `window`
+
+    :param list[datetime] start_times: the start times of the previous requests
+    """
+    recent = sorted(start_time for start_time in start_times if start_time > now - window)
+    if len(recent) < max_requests:
+        return now
+
+    # wait for the request that keeps the window full to drop out of it
+    return recent[-max_requests] + window
+
+
+def _checkpoint_blob_name(month: str) -> str:
+    return f"{BACKFILL_CHECKPOINT_PREFIX}{month}.json"
@@ -1,31 +1,47 @@
-from azure.storage.blob import BlobServiceClient, ContentSettings
+from azure.storage.blob import ContentSettings
 from date_helpers import add_month
+from typing import Generator, Iterable
+import blob_helpers
+import blob_writer
 import logging
 import json
 import datetime
-import requests
-import os
 import gzip
+import hashlib
+import ijson
+import zlib
+import storage_clients
+import ingestion.ynab_client as ynab_client
 
-YNAB_USER_TOKEN_KEY = os.getenv('YNAB_USER_TOKEN_KEY')
-YNAB_BUDGET_ID = os.getenv('YNAB_BUDGET_ID')
-YNAB_BASE_ENDPOINT = os.getenv('YNAB_BASE_ENDPOINT')
 ENCODING = "utf-8"
+# tells zlib to write a gzip header and trailer
+GZIP_WBITS = zlib.MAX_WBITS | 16
 
+TRANSACTIONS_BLOB = "bronze/transactions.json"
+TRANSACTION_DELTAS_PREFIX = "bronze/transaction_deltas/"
+TRANSACTIONS_STATE_BLOB = "bronze/transactions_state.json"
 
-def load_transactions(connect_str: str) -> int:
+
+def load_transactions(connect_str: str, incremental: bool = False) -> int:
     """Loads transactions from the ynab api and saves to blob storage
 
+    In incremental mode only the transactions changed since the last load are requested (using the
+    `server_knowledge` persisted by that load) and written as a delta blob next to the full payload.
+    When no previous load is recorded a full load is done instead.
+
           :param str conn_str:
               A connection string to an Azure Storage account.
+          :param bool incremental:
+              Request only the changes since the last load.
+          :return int: the uploaded bytes, 0 when no transaction changed
     """
 
-    # fetch raw transaction json
-    raw_json_obj = _fetch_raw_json("transactions")
-    raw_json = json.dumps(raw_json_obj)
+    state = blob_helpers.download_json(
+        connect_str, TRANSACTIONS_STATE_BLOB) if incremental else None
+    if state is None:
+        return _load_all_transactions(connect_str)
 
-    blob_name = "bronze/transactions.json"
-    return _upload_blob(connect_str, blob_name, raw_json)
+    return _load_transaction_delta(connect_str, state)
 
 
 def load_accounts(connect_str: str) -> int:
@@ -33,6 +49,7 @@ def load_accounts(connect_str: str) -> int:
 
           :param str conn_str:
               A connection string to an Azure Storage account.
+          :return int: the uploaded bytes, 0 when the accounts did not change
     """
 
     # fetch raw accounts json
@@ -41,7 +58,7 @@ def load_accounts(connect_str: str) -> int:
     raw_json = json.dumps(raw_json_obj)
 
     blob_name = "bronze/accounts.json"
-    return _upload_blob(connect_str, blob_name, raw_json)
+    return _upload_blob(connect_str, blob_name, raw_json, content_hash(raw_json_obj))
 
 
 def load_current_budget_month(connect_str: str, current_date: datetime.datetime) -> int:
@@ -60,7 +77,7 @@ def load_current_budget_month(connect_str: str, current_date: datetime.datetime)
     raw_json = json.dumps(raw_json_obj)
 
     blob_name = f"bronze/month/{first_day_of_month}/{current_date_str}.json"
-    return _upload_blob(connect_str, blob_name, raw_json)
+    return _upload_blob(connect_str, blob_name, raw_json, content_hash(raw_json_obj))
 
 
 def load_previous_budget_month(connect_str: str, current_date: datetime.datetime) -> int:
@@ -81,38 +98,247 @@ def load_previous_budget_month(connect_str: str, current_date: datetime.datetime
     raw_json = json.dumps(raw_json_obj)
 
     blob_name = f"bronze/month/{first_day_of_month}/{current_date_str}.json"
-    return _upload_blob(connect_str, blob_name, raw_json)
+    return _upload_blob(connect_str, blob_name, raw_json, content_hash(raw_json_obj))
+
+
+def load_budget_months(
+        connect_str: str,
+        months: Iterable[str],
+        snapshot_date: datetime.datetime = None) -> dict[str, int]:
+    """Loads many budget months with a single request to the budget export (`budgets/{budget_id}`) and saves each
+    month as its own snapshot, in the same layout as `load_current_budget_month`
+
+          :param str conn_str:
+              A connection string to an Azure Storage account.
+          :param Iterable[str] months:
+              The first days (`%Y-%m-%d`) of the months to save.
+          :param datetime.datetime snapshot_date:
+              The date of the snapshots, when omitted each snapshot is dated on the first day of its month.
+          :return dict[str, int]: the uploaded bytes per month
+    """
+    months = set(months)
+    upload_sizes = {}
+
+    # the export holds every month of the budget, only the months are parsed out of the stream
+    for raw_month in _stream_budget_months(_fetch_raw_stream("")):
+        first_day_of_month = raw_month["month"]
+        if first_day_of_month not in months:
+            continue
+
+        current_date_str = first_day_of_month if snapshot_date is None else snapshot_date.strftime("%Y-%m-%d")
+        raw_json_obj = {"data": {"month": raw_month}}
+        raw_json = json.dumps(raw_json_obj)
+
+        blob_name = f"bronze/month/{first_day_of_month}/{current_date_str}.json"
+        upload_sizes[first_day_of_month] = _upload_blob(connect_str, blob_name, raw_json, content_hash(raw_json_obj))
+
+    missing = months - set(upload_sizes)
+    if len(missing) > 0:
+        raise Exception(f"budget months {sorted(missing)} are not in the budget export")
+
+    return upload_sizes
+
+
+def _stream_budget_months(chunks: Iterable[bytes]) -> Generator[dict, None, None]:
+    """Parses the months out of a budget export stream, the categories of the months are named after their
+    category group the same way as the `months/{month}` endpoint
+
+    The key order of the export is not guaranteed, the months are held back until the category groups were parsed.
+    Either every category group comes before the first month or none of them do, since arrays do not interleave.
+    """
+    category_groups, months = ijson.sendable_list(), ijson.sendable_list()
+    coroutines = [
+        ijson.items_coro(category_groups, "data.budget.category_groups.item", use_float=True),
+        ijson.items_coro(months, "data.budget.months.item", use_float=True),
+    ]
+    category_group_names = {}
+
+    def drain(final: bool = False) -> Generator[dict, None, None]:
+        category_group_names.update((group["id"], group["name"]) for group in category_groups)
+        del category_groups[:]
+        if len(category_group_names) == 0 and not final:
+            return
+
+        for month in months:
+            _name_category_groups(month, category_group_names)
+            yield month
+        del months[:]
+
+    for chunk in chunks:
+        for coroutine in coroutines:
+            coroutine.send(chunk)
+        yield from drain()
+
+    for coroutine in coroutines:
+        coroutine.close()
+    yield from drain(final=True)
+
+
+def _name_category_groups(month: dict, category_group_names: dict[str, str]) -> None:
+    for category in month["categories"]:
+        if "category_group_name" in category:
+            continue
+        if category["category_group_id"] not in category_group_names:
+            raise Exception(f"category group `{category['category_group_id']}` of category `{category['id']}` "
+                            f"is not in the budget export")
+        category["category_group_name"] = category_group_names[category["category_group_id"]]
 
 
-def _fetch_raw_json(endpoint: str) -> dict:
+def _load_all_transactions(connect_str: str) -> int:
+    # an unchanged payload only supersedes the previous full load when no deltas were loaded on top of it
+    has_deltas = any(True for _ in storage_clients.get_container_client(connect_str).list_blobs(
+        name_starts_with=TRANSACTION_DELTAS_PREFIX))
 
-    headers = {"Authorization": f"Bearer {YNAB_USER_TOKEN_KEY}"}
-    request_uri = os.path.join(
-        YNAB_BASE_ENDPOINT, "budgets", YNAB_BUDGET_ID, endpoint).replace('\\', '/')
-    api_response = requests.get(request_uri, headers=headers)
+    # stream the raw transaction json straight into blob storage
+    upload_size, summary = _upload_transactions_stream(
+        connect_str, TRANSACTIONS_BLOB, _fetch_raw_stream("transactions"), skip_unchanged=not has_deltas)
+    if summary["unchanged"]:
+        return 0
+
+    # the full payload supersedes every delta loaded before it
+    _delete_transaction_deltas(connect_str)
+
+    blob_helpers.upload_json(connect_str, TRANSACTIONS_STATE_BLOB, {
+        "server_knowledge": summary["server_knowledge"],
+        "full_server_knowledge": summary["server_knowledge"],
+    })
+    return upload_size
+
+
+def _load_transaction_delta(connect_str: str, state: dict) -> int:
+    # deltas are named by the server knowledge they were requested with, padded so that they list in the order
+    # they need to be applied
+    last_knowledge_of_server = state["server_knowledge"]
+    blob_name = f"{TRANSACTION_DELTAS_PREFIX}{last_knowledge_of_server:012d}.json"
+
+    # fetch only the transactions changed since the last load
+    upload_size, summary = _upload_transactions_stream(connect_str, blob_name, _fetch_raw_stream(
+        "transactions", {"last_knowledge_of_server": last_knowledge_of_server}), skip_empty=True)
+
+    state["server_knowledge"] = summary["server_knowledge"]
+    blob_helpers.upload_json(connect_str, TRANSACTIONS_STATE_BLOB, state)
+    return upload_size
+
+
+def _delete_transaction_deltas(connect_str: str) -> None:
+    container_client = storage_clients.get_container_client(connect_str)
+
+    for blob in container_client.list_blobs(name_starts_with=TRANSACTION_DELTAS_PREFIX):
+        container_client.delete_blob(blob.name)
+        logging.info(f"deleted blob `{blob.name}`")
+
+
+def _fetch_raw_json(endpoint: str, params: dict = None) -> dict:
+    # the client shares its connections and the YNAB rate limit with the other activities of the worker
+    return ynab_client.get_client().get_json(endpoint, params)
+
+
+def _fetch_raw_stream(endpoint: str, params: dict = None) -> Iterable[bytes]:
+    """Fetches the raw json payload as a stream of chunks so large payloads never have to be held in memory
+    """
+    return ynab_client.get_client().iter_chunks(endpoint, params)
+
+
+def _upload_transactions_stream(
+        connect_str: str,
+        blob_name: str,
+        chunks: Iterable[bytes],
+        skip_unchanged: bool = False,
+        skip_empty: bool = False) -> tuple[int, dict]:
+    """Compresses and uploads a raw transactions payload chunk by chunk. The payload is parsed as it passes
+    through to pick up the server knowledge, the number of transactions and the content hash without building the
+    json objects. With `skip_unchanged` the staged upload is discarded when the content hash matches the blob's, and
+    with `skip_empty` when the payload has no transactions.
+    """
+    summary = {"server_knowledge": None, "transaction_count": 0, "unchanged": False}
+    byte_count = 0
+    events = ijson.sendable_list()
+    parser = ijson.parse_coro(events)
+    hasher = hashlib.sha256()
+
+    def compress() -> Generator[bytes, None, None]:
+        nonlocal byte_count
+        compressor = zlib.compressobj(wbits=GZIP_WBITS)
+        for chunk in chunks:
+            # an empty send tells the parser the document ended
+            if len(chunk) > 0:
+                parser.send(chunk)
+            _summarize_events(events, summary, hasher)
+            compressed = compressor.compress(chunk)
+            byte_count += len(compressed)
+            if len(compressed) > 0:
+                yield compressed
+
+        parser.close()
+        _summarize_events(events, summary, hasher)
+        compressed = compressor.flush()
+        byte_count += len(compressed)
+        yield compressed
+
+    blob_client = storage_clients.get_blob_client(connect_str, blob_name)
+    previous_hash = blob_helpers.get_content_hash(connect_str, blob_name) if skip_unchanged else None
+
+    # the blocks are committed once the whole payload is hashed, an unchanged payload is never committed
+    writer = blob_writer.StagedBlobWriter(blob_client, timeout=60, content_settings=ContentSettings(
+        content_type="application/json", content_encoding="gzip"))
+    with writer:
+        for compressed in compress():
+            writer.write(compressed)
+
+        summary["content_hash"] = hasher.hexdigest()
+        if summary["content_hash"] == previous_hash or (skip_empty and summary["transaction_count"] == 0):
+            writer.abort()
+            summary["unchanged"] = True
+            logging.info(f"blob `{blob_name}` is unchanged, skipped the upload")
+            return 0, summary
+        writer.metadata = {blob_helpers.CONTENT_HASH_METADATA: summary["content_hash"]}
 
     logging.info(
-        f"fetched data from {request_uri}, response: {api_response.status_code}")
+        f"uploaded compressed blob `{blob_name}` with {byte_count} bytes")
+    return byte_count, summary
+
+
+def _summarize_events(events: list[tuple], summary: dict, hasher=None) -> None:
+    for prefix, event, value in events:
+        if prefix == "data.transactions.item" and event == "start_map":
+            summary["transaction_count"] += 1
+        elif prefix == "data.server_knowledge":
+            if event == "number":
+                summary["server_knowledge"] = value
+            # the server knowledge moves on with every change to the budget, not only to the transactions
+            continue
+
+        if hasher is not None:
+            hasher.update(f"{prefix}\0{event}\0{value}\n".encode(ENCODING))
+    del events[:]
+
+
+def content_hash(raw_json_obj: dict) -> str:
+    """Hashes the canonical form of a YNAB payload, key order and whitespace do not change the hash. The server
+    knowledge is left out, it moves on with every change to the budget and not only to the payload.
+    """
+    data = raw_json_obj.get("data")
+    if isinstance(data, dict) and "server_knowledge" in data:
+        raw_json_obj = {**raw_json_obj, "data": {key: value for key, value in data.items() if key != "server_knowledge"}}
+
+    canonical = json.dumps(raw_json_obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode(ENCODING)).hexdigest()
 
-    if api_response.status_code != 200:
-        logging.error(
-            f"failed to fetch data, response code {api_response.status_code}")
-        logging.error(api_response.content.decode(ENCODING))
-        raise Exception("failed to fetch data")
-    return json.loads(api_response.content)
 
+def _upload_blob(connect_str: str, blob_name: str, raw_json: str, raw_json_hash: str = None) -> int:
+    # the blob keeps its last modified time when the payload did not change, which is what silver compares against
+    if raw_json_hash is not None and blob_helpers.get_content_hash(connect_str, blob_name) == raw_json_hash:
+        logging.info(f"blob `{blob_name}` is unchanged, skipped the upload")
+        return 0
 
-def _upload_blob(connect_str: str, blob_name: str, raw_json: str) -> int:
     # Compress the raw_json string
     compressed_data = gzip.compress(raw_json.encode(ENCODING))
 
-    # Create the BlobServiceClient object which will be used to create a container client
-    blob_service_client = BlobServiceClient.from_connection_string(connect_str)
-    blob_client = blob_service_client.get_blob_client(
-        container="ynab", blob=blob_name)
+    blob_client = storage_clients.get_blob_client(connect_str, blob_name)
 
     # Upload the compressed data to the blob storage
-    blob_client.upload_blob(compressed_data, overwrite=True, timeout=60, content_settings=ContentSettings(
+    metadata = None if raw_json_hash is None else {blob_helpers.CONTENT_HASH_METADATA: raw_json_hash}
+    blob_client.upload_blob(compressed_data, overwrite=True, timeout=60, metadata=metadata, content_settings=ContentSettings(
         content_type="application/json", content_encoding="gzip"))
 
     byte_count = len(compressed_data)
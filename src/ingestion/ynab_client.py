@@ -0,0 +1,225 @@
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Awaitable, Callable, Generator
+import aiohttp
+import asyncio
+import logging
+import os
+import threading
+import time
+
+YNAB_USER_TOKEN_KEY = os.getenv('YNAB_USER_TOKEN_KEY')
+YNAB_BUDGET_ID = os.getenv('YNAB_BUDGET_ID')
+YNAB_BASE_ENDPOINT = os.getenv('YNAB_BASE_ENDPOINT')
+ENCODING = "utf-8"
+CHUNK_SIZE = 64 * 1024
+# YNAB allows 200 requests per hour per token, the bucket lets a few requests through at once
+MAX_REQUESTS_PER_HOUR = int(os.getenv("YNAB_MAX_REQUESTS_PER_HOUR", "200"))
+REQUEST_BURST = int(os.getenv("YNAB_REQUEST_BURST", "10"))
+MAX_RETRIES = 3
+# a longer Retry-After is left to the retries of the orchestrator rather than holding the activity
+MAX_BACKOFF = 300
+CONNECTION_TIMEOUT = 20
+# per read rather than in total, the budget export is streamed for a while
+READ_TIMEOUT = 60
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class YnabRequestError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class TokenBucket:
+    """ A token bucket shared by the requests of a client, every request takes a token and the tokens refill at
+    `rate` per second up to `capacity`
+    """
+
+    def __init__(
+            self,
+            capacity: int,
+            rate: float,
+            clock: Callable[[], float] = time.monotonic,
+            sleep: Callable[[float], Awaitable] = asyncio.sleep):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = float(capacity)
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock: asyncio.Lock | None = None
+
+    async def acquire(self) -> float:
+        """ Waits for a token
+
+        :return float: the seconds waited
+        """
+        # created lazily so the bucket can be built outside of the event loop it is used on
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        waited = 0.0
+        # the lock queues the waiting requests so they are let through in order
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                delay = (1 - self.tokens) / self.rate
+                await self._sleep(delay)
+                waited += delay
+                self._refill()
+            self.tokens -= 1
+
+        return waited
+
+    def drain(self) -> None:
+        """ Empties the bucket, used when YNAB throttled a request anyway (e.g. another client used the token)
+        """
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class YnabClient:
+    """ An async client of the YNAB api with a shared session, a token bucket rate limit and retries
+
+    Throttled (429) and failed (5xx) requests are retried after their `Retry-After`, or an exponential backoff.
+    The session and the bucket live on an event loop of their own, so the synchronous activities of the function
+    app share the pooled connections and the rate limit through `get_json` and `iter_chunks`.
+    """
+
+    def __init__(
+            self,
+            base_endpoint: str,
+            budget_id: str,
+            token: str,
+            rate_limiter: TokenBucket = None,
+            max_retries: int = MAX_RETRIES,
+            max_backoff: float = MAX_BACKOFF):
+        """
+        :param str base_endpoint: the YNAB api, e.g. `https://api.ynab.com/v1/`
+        :param str budget_id: the budget the endpoints are relative to
+        :param str token: the YNAB user token
+        :param TokenBucket rate_limiter: defaults to `MAX_REQUESTS_PER_HOUR` with bursts of `REQUEST_BURST`
+        :param int max_retries: the retries of a throttled or failed request
+        :param float max_backoff: the longest wait before a retry, a longer `Retry-After` fails the request
+        """
+        self.budget_uri = "/".join([base_endpoint.rstrip("/"), "budgets", budget_id])
+        self._headers = {"Authorization": f"Bearer {token}", "Accept-Encoding": "gzip"}
+        self.rate_limiter = rate_limiter or TokenBucket(REQUEST_BURST, MAX_REQUESTS_PER_HOUR / 3600)
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self._session: aiohttp.ClientSession | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread_lock = threading.Lock()
+
+    async def fetch_json(self, endpoint: str, params: dict = None) -> dict:
+        """ Fetches an endpoint of the budget, an empty endpoint is the budget export
+
+        :param str endpoint: e.g. `months/2024-01-01`
+        :param dict params: the query string
+        """
+        response = await self._request(endpoint, params)
+        async with response:
+            return await response.json(content_type=None)
+
+    async def fetch_stream(self, endpoint: str, params: dict = None) -> aiohttp.ClientResponse:
+        """ Opens the response of an endpoint, read it with `response.content` and release it when done
+        """
+        return await self._request(endpoint, params)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def get_json(self, endpoint: str, params: dict = None) -> dict:
+        """ `fetch_json` for synchronous code, runs on the event loop of the client
+        """
+        return self._run(self.fetch_json(endpoint, params))
+
+    def iter_chunks(self, endpoint: str, params: dict = None, chunk_size: int = CHUNK_SIZE) -> Generator[bytes, None, None]:
+        """ Streams the decompressed payload of an endpoint for synchronous code
+        """
+        response = self._run(self.fetch_stream(endpoint, params))
+        try:
+            while True:
+                chunk = self._run(response.content.read(chunk_size))
+                if len(chunk) == 0:
+                    break
+                yield chunk
+        finally:
+            self._loop.call_soon_threadsafe(response.release)
+
+    async def _request(self, endpoint: str, params: dict | None) -> aiohttp.ClientResponse:
+        request_uri = "/".join([self.budget_uri, endpoint]).rstrip("/")
+        session = self._get_session()
+
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire()
+            try:
+                response = await session.get(request_uri, params=params)
+            except aiohttp.ClientConnectionError as e:
+                if attempt == self.max_retries:
+                    raise
+                logging.warning(f"request to {request_uri} failed: {e}, retrying")
+                await asyncio.sleep(self._backoff(attempt, None))
+                continue
+
+            logging.info(f"fetched data from {request_uri}, response: {response.status}")
+            if response.status == 200:
+                return response
+
+            body = (await response.read()).decode(ENCODING, errors="replace")
+            response.release()
+            if response.status not in RETRY_STATUSES or attempt == self.max_retries:
+                logging.error(f"failed to fetch data, response code {response.status}")
+                logging.error(body)
+                raise YnabRequestError(response.status, "failed to fetch data")
+
+            if response.status == 429:
+                self.rate_limiter.drain()
+            delay = self._backoff(attempt, response.headers.get("Retry-After"))
+            if delay > self.max_backoff:
+                raise YnabRequestError(response.status, f"failed to fetch data, retry after {delay:.0f} seconds")
+            logging.warning(f"response code {response.status} from {request_uri}, retrying in {delay:.1f} seconds")
+            await asyncio.sleep(delay)
+
+    def _backoff(self, attempt: int, retry_after: str | None) -> float:
+        if retry_after is None:
+            return min(2 ** attempt, self.max_backoff)
+
+        # either a number of seconds or a http date
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=CONNECTION_TIMEOUT, sock_read=READ_TIMEOUT)
+            self._session = aiohttp.ClientSession(headers=self._headers, timeout=timeout)
+        return self._session
+
+    def _run(self, coroutine: Awaitable):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._get_loop()).result()
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        with self._thread_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="ynab-client", daemon=True).start()
+        return self._loop
+
+
+@lru_cache(maxsize=None)
+def get_client() -> YnabClient:
+    """Returns the process wide client of the configured budget, its connections and rate limit are shared by every
+    activity of the worker
+    """
+    return YnabClient(YNAB_BASE_ENDPOINT, YNAB_BUDGET_ID, YNAB_USER_TOKEN_KEY)
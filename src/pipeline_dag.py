@@ -0,0 +1,127 @@
+from datetime import datetime
+from date_helpers import add_month
+
+# read by the first gold activities, tells them to run even when their silver inputs did not change this run
+GOLD_STALE = "gold/stale"
+
+
+def nightly_pipeline(run_date: datetime) -> dict[str, dict]:
+    """ The activities of the nightly run with the datasets they read and write, keyed by activity name
+
+    Every step is a dict of the activity `input`, the `inputs` and `outputs` datasets, and whether YNAB calls are
+    `retry`-ed. The previous budget month is only loaded until the 15th.
+
+    :param datetime run_date: the date of the run
+    """
+    current_month = run_date.strftime("%Y-%m-01")
+    previous_month = add_month(run_date, -1).strftime("%Y-%m-01")
+    budget_months = [f"silver/budget_months/{current_month}", f"silver/budget_months/{previous_month}"]
+    steps = {
+        # ******Bronze******
+        # transactions are loaded as deltas, a full refresh on the first of the month keeps the delta count bounded
+        "load_transactions": _step([], ["bronze/transactions"], run_date.day == 1, retry=True),
+        "load_accounts": _step([], ["bronze/accounts"], retry=True),
+        "load_current_budget_month": _step(
+            [], [f"bronze/month/{current_month}"], run_date.strftime("%Y-%m-%d"), retry=True),
+        "load_previous_budget_month": _step(
+            [], [f"bronze/month/{previous_month}"], run_date.strftime("%Y-%m-%d"), retry=True),
+        # a gold run that failed part way is built again even when the YNAB data did not change since, the check runs
+        # alongside bronze so it normally finishes before this run writes silver (which would only rebuild all gold)
+        "silver_changed_activity": _step([], [GOLD_STALE]),
+
+        # ******Silver******
+        # the debt transactions are built from the accounts as well
+        "transform_transactions": _step(["bronze/transactions", "bronze/accounts"], ["silver/transactions"]),
+        "transform_accounts": _step(["bronze/accounts"], ["silver/accounts"]),
+        "transform_current_budget_month": _step(
+            [f"bronze/month/{current_month}"], [f"silver/budget_months/{current_month}"], current_month),
+        "transform_previous_budget_month": _step(
+            [f"bronze/month/{previous_month}"], [f"silver/budget_months/{previous_month}"], previous_month),
+
+        # ******Gold******
+        "serve_category_scd_activity": _step(budget_months + [GOLD_STALE], ["gold/category_scd"]),
+        "create_transactions_fact_activity": _step(["silver/transactions", GOLD_STALE], ["gold/transactions_fact"]),
+        # the category dim is built from the current month only
+        "serve_category_dim_activity": _step([budget_months[0], GOLD_STALE], ["gold/category_dim"]),
+        "serve_accounts_dim_activity": _step(["silver/accounts", GOLD_STALE], ["gold/accounts_dim"]),
+        "serve_payee_dim_activity": _step(["silver/transactions", GOLD_STALE], ["gold/payee_dim"]),
+        "serve_category_variance_activity": _step(["gold/category_scd"], ["gold/category_variance_fact"]),
+        "serve_net_worth_fact_activity": _step(["gold/transactions_fact", "gold/accounts_dim"], ["gold/net_worth_fact"]),
+        "serve_age_of_money_activity": _step(
+            ["silver/transactions", "gold/accounts_dim", "gold/category_dim"], ["gold/age_of_money_fact"]),
+    }
+
+    if run_date.day > 15:
+        del steps["load_previous_budget_month"]
+        del steps["transform_previous_budget_month"]
+
+    # gold is only skipped by the next run when every gold activity succeeded
+    gold_outputs = [dataset for step in steps.values() for dataset in step["outputs"] if dataset.startswith("gold/")]
+    steps["mark_gold_built_activity"] = _step([dataset for dataset in gold_outputs if dataset != GOLD_STALE], [])
+
+    # inputs no step writes this run (the previous month after the 15th) are left as they are
+    outputs = {dataset for step in steps.values() for dataset in step["outputs"]}
+    for step in steps.values():
+        step["inputs"] = [dataset for dataset in step["inputs"] if dataset in outputs]
+
+    return steps
+
+
+class PipelineScheduler:
+    """ Walks a pipeline as a DAG, a step starts as soon as the steps writing its inputs finished instead of waiting
+    for a whole tier
+
+    A step runs when one of its inputs changed (or it has no inputs), otherwise it is skipped and its outputs are
+    unchanged as well. The order of the steps is deterministic, as the replays of an orchestrator require.
+    """
+
+    def __init__(self, steps: dict[str, dict]):
+        self.steps = steps
+        self.changed: dict[str, bool] = {}
+        self.started: set[str] = set()
+        self.skipped: list[str] = []
+
+    def next_steps(self) -> list[str]:
+        """ Returns the steps to start now, skipping the ready steps whose inputs did not change
+        """
+        to_start = []
+        ready = self._ready_steps()
+        while len(ready) > 0:
+            for name in ready:
+                self.started.add(name)
+                if self._should_run(self.steps[name]):
+                    to_start.append(name)
+                else:
+                    self.skipped.append(name)
+                    self.changed.update(dict.fromkeys(self.steps[name]["outputs"], False))
+
+            # skipping a step can make the steps after it ready
+            ready = self._ready_steps()
+
+        return to_start
+
+    def complete(self, name: str, result) -> None:
+        """ Records the outputs of a finished step
+
+        :param result: the result of the activity, a bool or a dict with `changed` when the activity can tell whether
+            its outputs changed, any other result counts as changed
+        """
+        if isinstance(result, bool):
+            changed = result
+        elif isinstance(result, dict) and "changed" in result:
+            changed = result["changed"]
+        else:
+            changed = True
+
+        self.changed.update(dict.fromkeys(self.steps[name]["outputs"], changed))
+
+    def _ready_steps(self) -> list[str]:
+        return [name for name, step in self.steps.items()
+                if name not in self.started and all(dataset in self.changed for dataset in step["inputs"])]
+
+    def _should_run(self, step: dict) -> bool:
+        return len(step["inputs"]) == 0 or any(self.changed[dataset] for dataset in step["inputs"])
+
+
+def _step(inputs: list[str], outputs: list[str], input=None, retry: bool = False) -> dict:
+    return {"input": input, "inputs": inputs, "outputs": outputs, "retry": retry}
@@ -1,70 +1,347 @@
+from azure.storage.blob import BlobProperties
+import logging
+import numpy as np
 import pandas as pd
 import blob_helpers
-import queue
+
 INCOME_CATEGORY = "Inflow: Ready to Assign"
+TRANSACTIONS_DATASET = "silver/transactions"
+AGE_OF_MONEY_BLOB = "gold/age_of_money_fact.snappy.parquet"
+ACCOUNT_AGE_OF_MONEY_BLOB = "gold/age_of_money_by_account_fact.snappy.parquet"
+CATEGORY_GROUP_AGE_OF_MONEY_BLOB = "gold/age_of_money_by_category_group_fact.snappy.parquet"
+# the income buckets left at the end of a closed month, lets the next run resume instead of replaying all history
+AGE_OF_MONEY_STATE_BLOB = "gold/age_of_money_state.json"
+# the rolling age of money averages the last 10 days with spending, YNAB averages the last 10 outflows instead
+ROLLING_WINDOW = 10
 
 
-def create_age_of_money_fact(connect_str: str) -> int:
-    transactions_fact = blob_helpers.download_parquet(
-        connect_str, "silver/transactions.snappy.parquet")
+def create_age_of_money_fact(connect_str: str, incremental: bool = False) -> int:
+    """ Creates the daily age of money facts of the budget, per account and per category group
 
+    :param bool incremental:
+        Resume from the income buckets checkpointed by the previous run and only process the days after it. Falls
+        back to replaying all history when there is no checkpoint or a checkpointed month changed.
+    """
     accounts_dim = blob_helpers.download_parquet(
-        connect_str, "gold/accounts_dim.snappy.parquet")
+        connect_str, "gold/accounts_dim.snappy.parquet", columns=["account_id", "on_budget"])
+    category_dim = blob_helpers.download_parquet(
+        connect_str, "gold/category_dim.snappy.parquet",
+        columns=["category_id", "category_group_id", "category_group_name"])
+
+    state = _load_state(connect_str, accounts_dim, category_dim) if incremental else None
+    start_date = None if state is None else pd.Timestamp(state["through"]) + pd.Timedelta(days=1)
+
+    transactions_fact = blob_helpers.download_partitioned_parquet(
+        connect_str, TRANSACTIONS_DATASET, start_date=start_date,
+        columns=["date", "account_id", "amount", "category_id", "category_name"])
+
+    if len(transactions_fact) == 0:
+        logging.info("no transactions to calculate the age of money from")
+        return 0
+
+    # checkpoint at the end of the month before the latest one, older months rarely change
+    through = pd.to_datetime(transactions_fact["date"]).max().to_period("M").to_timestamp() - pd.Timedelta(days=1)
+
+    facts, new_state = _compute_age_of_money(transactions_fact, accounts_dim, category_dim, state, through)
+
+    upload_size = 0
+    for blob_name, fact in facts.items():
+        if state is not None:
+            # keep the days before the checkpoint from the previous run
+            previous_fact = blob_helpers.download_parquet(connect_str, blob_name)
+            previous_fact = previous_fact[previous_fact["date"] <= pd.Timestamp(state["through"])]
+            # concatenating an empty side would drop its dtypes, keep the other side as is
+            if len(fact) == 0:
+                fact = previous_fact.reset_index(drop=True)
+            elif len(previous_fact) > 0:
+                fact = pd.concat([previous_fact, fact], ignore_index=True)
+        upload_size += blob_helpers.upload_parquet(connect_str, blob_name, fact)
+
+    if new_state is None:
+        logging.info("age of money could not be checkpointed, the next run replays all history")
+        blob_helpers.delete_blob(connect_str, AGE_OF_MONEY_STATE_BLOB)
+    else:
+        upload_size += blob_helpers.upload_json(connect_str, AGE_OF_MONEY_STATE_BLOB, new_state)
+
+    return upload_size
+
+
+def _load_state(connect_str: str, accounts_dim: pd.DataFrame, category_dim: pd.DataFrame) -> dict | None:
+    state_blob = blob_helpers.get_blob_properties(connect_str, AGE_OF_MONEY_STATE_BLOB)
+    if state_blob is None:
+        return None
+
+    state = blob_helpers.download_json(connect_str, AGE_OF_MONEY_STATE_BLOB)
+    partitions = blob_helpers.list_partitions(connect_str, TRANSACTIONS_DATASET)
+    if not _is_resumable(state, state_blob, partitions, accounts_dim, category_dim):
+        logging.info("age of money checkpoint is stale, replaying all history")
+        return None
+
+    for blob_name in [AGE_OF_MONEY_BLOB, ACCOUNT_AGE_OF_MONEY_BLOB, CATEGORY_GROUP_AGE_OF_MONEY_BLOB]:
+        if blob_helpers.get_blob_properties(connect_str, blob_name) is None:
+            return None
+
+    return state
+
+
+def _is_resumable(
+        state: dict,
+        state_blob: BlobProperties,
+        partitions: dict[pd.Timestamp, BlobProperties],
+        accounts_dim: pd.DataFrame,
+        category_dim: pd.DataFrame) -> bool:
+    """ The checkpoint can be resumed from when none of the months it covers changed or were deleted since it was
+    written and the accounts and category groups it was computed with are the same
+    """
+    through = pd.Timestamp(state["through"])
+    if any(month <= through and blob.last_modified > state_blob.last_modified for month, blob in partitions.items()):
+        return False
+
+    # a partition is deleted once all of its transactions are
+    if "months" not in state or any(pd.Timestamp(month) not in partitions for month in state["months"]):
+        return False
+
+    return state["account_ids"] == _on_budget_account_ids(accounts_dim) and \
+        state["category_groups"] == _category_groups(category_dim)
+
+
+def _compute_age_of_money(
+        transactions_fact: pd.DataFrame,
+        accounts_dim: pd.DataFrame,
+        category_dim: pd.DataFrame,
+        state: dict = None,
+        through: pd.Timestamp = None) -> tuple[dict[str, pd.DataFrame], dict | None]:
+    """ Computes the age of money facts in one pass over the income buckets, the per account and per category group
+    facts are the age of the money spent from each account or category group on the days they had spending.
+
+    :param dict state:
+        The checkpoint to resume from, `transactions_fact` only contains the days after it.
+    :param pd.Timestamp through:
+        The day to checkpoint the income buckets at.
+    """
+    scopes = {} if state is None else state["scopes"]
+    budget_fact, buckets = _compute_monthly_age_of_money(transactions_fact, accounts_dim, scopes.get("budget"), through)
+    new_scopes = {"budget": buckets}
+
+    # spending of the accounts and category groups is matched to the age of money of the day it happened
+    df = _on_budget_transactions(transactions_fact, accounts_dim)
+    outflow_df = df[df["category_name"].notna() & (df["category_name"] != INCOME_CATEGORY)]
+    outflow_df = pd.merge(outflow_df, category_dim[["category_id", "category_group_id", "category_group_name"]],
+                          how="left", on="category_id")
+    ages = budget_fact.set_index("date")["age_of_money"]
+
+    account_fact = _spending_age_of_money(outflow_df, ages, ["account_id"], "account", scopes, new_scopes, through)
+    category_group_fact = _spending_age_of_money(
+        outflow_df, ages, ["category_group_id", "category_group_name"], "category_group", scopes, new_scopes, through)
+
+    facts = {
+        AGE_OF_MONEY_BLOB: budget_fact,
+        ACCOUNT_AGE_OF_MONEY_BLOB: account_fact,
+        CATEGORY_GROUP_AGE_OF_MONEY_BLOB: category_group_fact,
+    }
+
+    new_state = None
+    if buckets is not None:
+        new_state = {
+            "through": through.strftime("%Y-%m-%d"),
+            "months": _covered_months(transactions_fact, state, through),
+            "account_ids": _on_budget_account_ids(accounts_dim),
+            "category_groups": _category_groups(category_dim),
+            "scopes": new_scopes,
+        }
+
+    return facts, new_state
+
+
+def _compute_monthly_age_of_money(
+        transactions_fact: pd.DataFrame,
+        accounts_dim: pd.DataFrame,
+        buckets: dict = None,
+        through: pd.Timestamp = None) -> tuple[pd.DataFrame, dict | None]:
+    """ Computes the daily age of money of the on budget transactions, returns the fact and the income buckets left
+    at the end of `through` (None when they cannot be checkpointed)
+    """
+    df = _on_budget_transactions(transactions_fact, accounts_dim)
 
-    # order by date desc
-    age_of_money_fact = _compute_monthly_age_of_money(
-        transactions_fact, accounts_dim)
+    # group by day and category, and aggregate amount column
+    grouped_df = df.groupby(["date", "category_name"]).agg({"amount": "sum"}).reset_index()
 
-    return blob_helpers.upload_parquet(connect_str, "gold/age_of_money_fact.snappy.parquet", age_of_money_fact)
+    inflows = grouped_df[grouped_df["category_name"] == INCOME_CATEGORY].set_index("date")["amount"]
+    outflows = grouped_df[grouped_df["category_name"] != INCOME_CATEGORY].groupby(
+        pd.Grouper(key="date", freq="D"))["amount"].sum().astype("float64")
 
+    # a resumed run carries on from the day after the last outflow day before the checkpoint
+    last_date = None if buckets is None else pd.Timestamp(buckets["last_date"])
+    if last_date is not None and len(outflows) > 0:
+        outflows = outflows.reindex(
+            pd.date_range(last_date + pd.Timedelta(days=1), outflows.index.max()), fill_value=0.0)
 
-def _compute_monthly_age_of_money(transactions_fact: pd.DataFrame, accounts_dim: pd.DataFrame) -> pd.DataFrame:
+    bucket_dates = pd.to_datetime([] if buckets is None else buckets["dates"]).append(inflows.index).to_numpy()
+    bucket_amounts = ([] if buckets is None else buckets["amounts"]) + inflows.tolist()
+
+    # a resumed run without spending still carries the buckets forward to the new checkpoint
+    if len(bucket_amounts) == 0 or (len(outflows) == 0 and buckets is None):
+        fact = pd.DataFrame({"date": pd.Series(dtype="datetime64[ns]"), "age_of_money": pd.Series(dtype="int64")})
+        return _add_rolling_age_of_money(fact, pd.Series(dtype=bool), buckets), None
+
+    bucket_index, new_buckets = _allocate_checkpointed(bucket_dates, bucket_amounts, outflows, through, last_date)
+
+    # age of money is the number of days between the spending and the income bucket it is spent from
+    age_of_money = (outflows.index.to_numpy() - bucket_dates[bucket_index]) // np.timedelta64(1, "D")
+    fact = pd.DataFrame({"date": outflows.index, "age_of_money": age_of_money.astype("int64")})
+
+    fact = _add_rolling_age_of_money(fact, outflows.to_numpy() < 0, buckets, new_buckets, through)
+    return fact, new_buckets
+
+
+def _on_budget_transactions(transactions_fact: pd.DataFrame, accounts_dim: pd.DataFrame) -> pd.DataFrame:
     # convert date column to datetime
     transactions_fact["date"] = pd.to_datetime(transactions_fact["date"])
 
-    # merge transactions_fact and accounts_dim DataFrames
-    df = pd.merge(transactions_fact, accounts_dim, how="inner",
+    # merge transactions_fact and the on budget accounts
+    df = pd.merge(transactions_fact, accounts_dim[accounts_dim["on_budget"]], how="inner",
                   left_on="account_id", right_on="account_id")
+    df["date"] = df["date"].dt.floor("D")
+    return df
+
+
+def _allocate_checkpointed(
+        bucket_dates: np.ndarray,
+        bucket_amounts: list[float],
+        outflows: pd.Series,
+        through: pd.Timestamp,
+        last_date: pd.Timestamp = None) -> tuple[np.ndarray, dict | None]:
+    """ Allocates the outflows in two legs split at the end of `through` so the buckets left at that point can be
+    checkpointed. The first leg only sees the buckets up to `through`, which gives the same allocation as a single
+    leg unless it ran out of buckets, in that case the allocation is redone in one leg and nothing is checkpointed.
+    """
+    split = 0 if through is None else int(np.searchsorted(outflows.index.to_numpy(), through.to_datetime64(), "right"))
+    bucket_split = 0 if through is None else int(np.searchsorted(bucket_dates, through.to_datetime64(), "right"))
+
+    # the first leg needs buckets, and a checkpoint before the first outflow day would change where the days start
+    if bucket_split > 0 and (last_date is not None or split > 0):
+        first_leg, balance, exhausted = _allocate_outflows(bucket_amounts[:bucket_split], outflows.to_numpy()[:split])
+        if not exhausted:
+            bucket = first_leg[-1] if split > 0 else 0
+            remaining_amounts = [balance] + bucket_amounts[bucket + 1:]
+            second_leg, _, _ = _allocate_outflows(remaining_amounts, outflows.to_numpy()[split:])
+
+            buckets = {
+                "through": through.strftime("%Y-%m-%d"),
+                "last_date": (outflows.index[split - 1] if split > 0 else last_date).strftime("%Y-%m-%d"),
+                "dates": [date.strftime("%Y-%m-%d") for date in pd.to_datetime(bucket_dates[bucket:bucket_split])],
+                "amounts": remaining_amounts[:bucket_split - bucket],
+            }
+            return np.concatenate([first_leg, second_leg + bucket]), buckets
+
+    bucket_index, _, _ = _allocate_outflows(bucket_amounts, outflows.to_numpy())
+    return bucket_index, None
+
+
+def _allocate_outflows(inflow_amounts: list[float], outflow_amounts: np.ndarray) -> tuple[np.ndarray, float, bool]:
+    """ Allocates the daily outflows to the daily income buckets first in/first out, returns the index of the bucket
+    being spent from at the end of each outflow day, the balance left in that bucket and whether the buckets ran out.
+
+    A day moves on to at most one new bucket and the balance carried into it is kept, when there are no more buckets
+    the last one keeps being spent from, which lets age of money go negative.
+    """
+    inflow_amounts = np.asarray(inflow_amounts).tolist()
+    last_bucket = len(inflow_amounts) - 1
+
+    bucket = 0
+    balance = inflow_amounts[0]
+    exhausted = False
+    buckets = np.empty(len(outflow_amounts), dtype=np.int64)
+    for day, amount in enumerate(outflow_amounts.tolist()):
+        balance += amount
+
+        if balance <= 0:
+            carrying_balance = balance
+            if bucket < last_bucket:
+                bucket += 1
+                balance = inflow_amounts[bucket]
+            else:
+                exhausted = True
+
+            balance += carrying_balance
+
+        buckets[day] = bucket
+
+    return buckets, balance, exhausted
+
+
+def _spending_age_of_money(
+        outflow_df: pd.DataFrame,
+        ages: pd.Series,
+        keys: list[str],
+        scope: str,
+        scopes: dict,
+        new_scopes: dict,
+        through: pd.Timestamp) -> pd.DataFrame:
+    """ Matches the days each account or category group had spending to the age of money of that day
+    """
+    spending = outflow_df.groupby(["date"] + keys)["amount"].sum().reset_index()
+    spending = spending[spending["amount"] < 0]
+    spending = spending[spending["date"].isin(ages.index)]
+    spending["age_of_money"] = ages.reindex(spending["date"]).to_numpy()
+
+    facts = []
+    for key, group in spending.groupby(keys[0], sort=True):
+        scope_key = f"{scope}/{key}"
+        fact = group[["date"] + keys + ["age_of_money"]].reset_index(drop=True)
+        fact = _add_rolling_age_of_money(
+            fact, np.ones(len(fact), dtype=bool), scopes.get(scope_key), new_scopes.setdefault(scope_key, {}), through)
+        facts.append(fact)
+
+    # keep the recent ages of the scopes that did not spend since the checkpoint
+    for scope_key, recent in scopes.items():
+        if scope_key.startswith(f"{scope}/"):
+            new_scopes.setdefault(scope_key, recent)
+
+    if len(facts) == 0:
+        return pd.DataFrame(columns=["date"] + keys + ["age_of_money", "rolling_age_of_money"])
+
+    return pd.concat(facts, ignore_index=True).sort_values(["date", keys[0]], kind="stable").reset_index(drop=True)
+
+
+def _add_rolling_age_of_money(
+        fact: pd.DataFrame,
+        spending: np.ndarray,
+        recent: dict = None,
+        new_recent: dict = None,
+        through: pd.Timestamp = None) -> pd.DataFrame:
+    """ Adds the average age of money of the last `ROLLING_WINDOW` spending days (one age per day with spending,
+    however many outflows it had), carried forward over the days without spending. `recent` holds the ages of the
+    last spending days before `fact` and `new_recent` is updated with the ones at the end of `through`.
+    """
+    recent_ages = [] if recent is None else recent["recent_ages"]
+    spent = fact.loc[spending, "age_of_money"]
 
-    # group by month and asset type, and aggregate amount column
-    grouped_df = df[df["on_budget"]].groupby([pd.Grouper(
-        key="date", freq="D"), "category_name"]).agg({"amount": "sum"}).reset_index()
+    window = pd.Series(recent_ages + spent.tolist(), dtype="float64")
+    rolling = window.rolling(ROLLING_WINDOW, min_periods=1).mean().iloc[len(recent_ages):]
+    rolling.index = spent.index
 
-    inflow_df = grouped_df[grouped_df["category_name"] == INCOME_CATEGORY].sort_values(
-        "date", ascending=True).reset_index(drop=True)
-    outflow_df = grouped_df[grouped_df["category_name"] != INCOME_CATEGORY].groupby(
-        pd.Grouper(key="date", freq="D")).agg({"amount": "sum"}).reset_index()
+    initial = window.iloc[:len(recent_ages)].mean() if len(recent_ages) > 0 else np.nan
+    fact["rolling_age_of_money"] = rolling.reindex(fact.index).ffill().fillna(initial)
 
-    # create a queue
-    income_buckets = queue.Queue()
+    if new_recent is not None and through is not None:
+        checkpointed = recent_ages + spent[fact.loc[spending, "date"] <= through].tolist()
+        new_recent["recent_ages"] = checkpointed[-ROLLING_WINDOW:]
 
-    # fill the queue with inflow_df rows
-    for i in range(len(inflow_df)):
-        row = inflow_df.loc[i]
-        income_buckets.put({
-            "date": row["date"],
-            "amount": row["amount"]
-        })
+    return fact
 
-    carrying_balance = 0
-    age_of_money = []
-    bucket = income_buckets.get()
-    for _, row in outflow_df.iterrows():
-        bucket["amount"] += row["amount"]
 
-        if (bucket["amount"] <= 0):
-            carrying_balance = bucket["amount"]
+def _covered_months(transactions_fact: pd.DataFrame, state: dict | None, through: pd.Timestamp) -> list[str]:
+    """ Lists the transaction months (first day) up to `through` the checkpoint was computed from
+    """
+    dates = transactions_fact.loc[transactions_fact["date"] <= through, "date"]
+    months = set(dates.dt.to_period("M").dt.to_timestamp().dt.strftime("%Y-%m-%d"))
+    return sorted(months | set([] if state is None else state["months"]))
 
-            # if there are no more buckets then age of money is negative,
-            # this allows for that edge case and age of money can go negative
-            if (not income_buckets.empty()):
-                bucket = income_buckets.get()
 
-            bucket["amount"] += carrying_balance
+def _on_budget_account_ids(accounts_dim: pd.DataFrame) -> list[str]:
+    return sorted(accounts_dim.loc[accounts_dim["on_budget"], "account_id"].astype(str).tolist())
 
-        # add rows to get daily age of money
-        age_of_money.append(
-            {"date": row["date"], "age_of_money": (row["date"] - bucket["date"]).days})
 
-    age_of_money_fact = pd.DataFrame(age_of_money)
-    return age_of_money_fact
+def _category_groups(category_dim: pd.DataFrame) -> dict[str, str]:
+    return dict(zip(category_dim["category_id"].astype(str), category_dim["category_group_id"].astype(str)))
@@ -1,42 +1,92 @@
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob import BlobProperties
 import logging
 import pandas as pd
 import blob_helpers
-
-
-def create_category_scd(connect_str: str) -> int:
-    df = pd.DataFrame()
-
-    blob_service_client = BlobServiceClient.from_connection_string(connect_str)
-
-    container_service = blob_service_client.get_container_client(
-        container="ynab")
-
-    # Get a list of blobs in the folder
-    blobs = container_service.list_blobs(
-        name_starts_with="silver/budget_months/")
-
-    # union all blobs in silver/budget_months/
-
-    for blob in blobs:
-        logging.info(f"downloading {blob.name}")
-        new_df = blob_helpers.download_parquet(connect_str, blob.name)
-        df = pd.concat([df, new_df])
-
-    scd_df = _create_category_sdc(df)
-
-    return blob_helpers.upload_parquet(
-        connect_str, "gold/category_scd.snappy.parquet", scd_df)
-
-
-def create_category_variance(connect_str: str) -> int:
-    df = blob_helpers.download_parquet(
-        connect_str, "gold/category_scd.snappy.parquet")
-
-    scd_df = _create_category_variance(df)
-
-    return blob_helpers.upload_parquet(
-        connect_str, "gold/category_variance_fact.snappy.parquet", scd_df)
+import storage_clients
+
+BUDGET_MONTHS_PREFIX = "silver/budget_months/"
+CATEGORY_SCD_BLOB = "gold/category_scd.snappy.parquet"
+# months of the SCD changed since the variance fact was last built, `null` when every month has to be rebuilt
+CATEGORY_SCD_STATE_BLOB = "gold/category_scd_state.json"
+CATEGORY_VARIANCE_BLOB = "gold/category_variance_fact.snappy.parquet"
+SCD_SOURCE_COLUMNS = ["month", "id", "category_group_id", "name", "category_group_name", "budgeted", "snapshot_date"]
+
+
+def create_category_scd(connect_str: str, incremental: bool = False) -> int:
+    """ Creates the category SCD from the budget months
+
+    :param bool incremental:
+        Only recompute the months whose budget month blob changed since the SCD was written, and splice them into
+        the existing SCD. Falls back to a full rebuild when there is no SCD yet.
+    """
+    budget_months = _list_budget_months(connect_str)
+    scd_blob = blob_helpers.get_blob_properties(connect_str, CATEGORY_SCD_BLOB) if incremental else None
+
+    if scd_blob is None:
+        # union all blobs in silver/budget_months/, reading only the columns the SCD is built from
+        logging.info(f"rebuilding category scd from {len(budget_months)} budget months")
+        df = blob_helpers.download_parquet_blobs(
+            connect_str, [blob.name for _, blob in sorted(budget_months.items())], columns=SCD_SOURCE_COLUMNS)
+        scd_df = _create_category_sdc(df)
+        months = None
+    else:
+        scd_df = blob_helpers.download_parquet(connect_str, CATEGORY_SCD_BLOB)
+
+        # closed months are not written again, so only the open months are normally recomputed
+        months = [month for month, blob in budget_months.items() if blob.last_modified > scd_blob.last_modified]
+        months.extend(month for month in pd.to_datetime(scd_df["month"].unique()) if month not in budget_months)
+        if len(months) == 0:
+            logging.info("category scd is up to date")
+            return 0
+
+        logging.info(f"recomputing category scd for {len(months)} budget months")
+        df = blob_helpers.download_parquet_blobs(
+            connect_str, [budget_months[month].name for month in sorted(months) if month in budget_months],
+            columns=SCD_SOURCE_COLUMNS)
+        scd_df = _update_category_scd(scd_df, df, months)
+
+    upload_size = blob_helpers.upload_parquet(connect_str, CATEGORY_SCD_BLOB, scd_df)
+    _add_changed_months(connect_str, months)
+    return upload_size
+
+
+def create_category_variance(connect_str: str, incremental: bool = False) -> int:
+    """ Creates the category variance fact from the category SCD
+
+    :param bool incremental:
+        Only recompute the months the SCD changed since the variance fact was last built, and splice them into
+        the existing fact. Falls back to a full rebuild when the changed months are unknown.
+    """
+    state = blob_helpers.download_json(connect_str, CATEGORY_SCD_STATE_BLOB) if incremental else None
+    variance_blob = blob_helpers.get_blob_properties(connect_str, CATEGORY_VARIANCE_BLOB) if incremental else None
+
+    if state is None or state["changed_months"] is None or variance_blob is None:
+        variance_df = _create_category_variance(blob_helpers.download_parquet(connect_str, CATEGORY_SCD_BLOB))
+    else:
+        months = pd.to_datetime(state["changed_months"])
+        if len(months) == 0:
+            logging.info("category variance is up to date")
+            return 0
+
+        logging.info(f"recomputing category variance for {len(months)} months")
+        df = blob_helpers.download_parquet(connect_str, CATEGORY_SCD_BLOB)
+        variance_df = _update_category_variance(
+            blob_helpers.download_parquet(connect_str, CATEGORY_VARIANCE_BLOB), df[df["month"].isin(months)], months)
+
+    upload_size = blob_helpers.upload_parquet(connect_str, CATEGORY_VARIANCE_BLOB, variance_df)
+    blob_helpers.upload_json(connect_str, CATEGORY_SCD_STATE_BLOB, {"changed_months": []})
+    return upload_size
+
+
+def _add_changed_months(connect_str: str, months: list[pd.Timestamp] | None) -> None:
+    # months accumulate until the variance fact picks them up, so a failed variance run is caught up on the next run
+    state = blob_helpers.download_json(connect_str, CATEGORY_SCD_STATE_BLOB) or {"changed_months": None}
+    if months is None or state["changed_months"] is None:
+        changed_months = None
+    else:
+        changed_months = sorted(set(state["changed_months"]) | {month.strftime("%Y-%m-%d") for month in months})
+
+    blob_helpers.upload_json(connect_str, CATEGORY_SCD_STATE_BLOB, {"changed_months": changed_months})
 
 
 def _create_category_sdc(df: pd.DataFrame) -> pd.DataFrame:
@@ -63,54 +113,70 @@ def _create_category_sdc(df: pd.DataFrame) -> pd.DataFrame:
     # Reset the index of the resulting DataFrame
     grouped_df = grouped_df.reset_index()
 
-    # Group the DataFrame by `month` and `id`, apply the custom function to each group,
-    # and retain all of the other columns
-    grouped_df = grouped_df.groupby(
-        ["month", "id"]).apply(_replace_max_with_none)
-    grouped_df = grouped_df.reset_index(drop=True)
-
-    grouped_df = grouped_df.groupby(["month", "id"]).apply(_apply_end_date)
-
-    # Reset the index of the resulting DataFrame
-    grouped_df = grouped_df.reset_index(drop=True)
+    grouped_df = _set_end_dates(grouped_df)
 
     # rename id column
     grouped_df = grouped_df.rename(columns={"id": "category_id"})
     return grouped_df
 
 
-def _replace_max_with_none(group):
-    group.loc[group["end_date"] == group["end_date"].max(), "end_date"] = None
-    return group
+def _set_end_dates(df: pd.DataFrame) -> pd.DataFrame:
+    """ Sets the end dates of the (month, id) groups over the whole frame at once, the latest row of a group is left
+    open (NaT) and the row before it ends the day before the latest row starts (see the per group reference in
+    `scripts/benchmark.py`).
+    """
+    # order the rows the same way as `groupby(["month", "id"]).apply`
+    df = df.sort_values(by=["month", "id", "start_date"], kind="stable").reset_index(drop=True)
+    groups = df.groupby(["month", "id"], sort=False)
+
+    # leave the latest row of every group open
+    end_date = df["end_date"].where(df["end_date"] != groups["end_date"].transform("max"))
+
+    # the row that now has the latest end date ends the day before the next row starts
+    next_start_date = groups["start_date"].shift(-1) - pd.Timedelta(days=1)
+    latest_end_date = end_date.groupby([df["month"], df["id"]], sort=False).transform("max")
+    df["end_date"] = next_start_date.where(end_date == latest_end_date, end_date)
+
+    return df
+
 
+def _update_category_scd(scd_df: pd.DataFrame, df: pd.DataFrame, months: list[pd.Timestamp]) -> pd.DataFrame:
+    """ Replaces the rows of `months` in the SCD with the SCD of the budget months in `df`, months are independent
+    of each other so the result matches a full rebuild
+    """
+    scd_df = scd_df[~scd_df["month"].isin(months)]
+    if len(df) > 0:
+        scd_df = pd.concat([scd_df, _create_category_sdc(df)])
 
-def _apply_end_date(group):
-    # Shift the `start_date` column by one row and subtract one day from it to get the end date of the next row
-    next_start_date = group["start_date"].shift(-1) - pd.Timedelta(days=1)
+    # same order as `_create_category_sdc`
+    return scd_df.sort_values(by=["month", "category_id", "start_date"], kind="stable").reset_index(drop=True)
 
-    # Set the `end_date` value to the end date of the next row
-    group.loc[group["end_date"] == group["end_date"].max(),
-              "end_date"] = next_start_date
 
-    return group
+def _list_budget_months(connect_str: str) -> dict[pd.Timestamp, BlobProperties]:
+    container_service = storage_clients.get_container_client(connect_str)
+
+    return {pd.Timestamp(blob.name[len(BUDGET_MONTHS_PREFIX):].replace(".snappy.parquet", "")): blob
+            for blob in container_service.list_blobs(name_starts_with=BUDGET_MONTHS_PREFIX)}
 
 
 def _create_category_variance(df: pd.DataFrame) -> pd.DataFrame:
-    # group by month
-    grouped_df = df.groupby(["category_id", "name", "month"])
-
-    rows = []
-
-    # iterate through the groups
-    for name, group in grouped_df:
-        group = group.sort_values(by=["start_date"])
-        start_amount = group["budgeted"].iloc[0]
-        end_amount = group["budgeted"].iloc[-1]
-        rows.append({
-            "category_id": group["category_id"].iloc[0],
-            "name": group["name"].iloc[0],
-            "month": group["month"].iloc[0],
-            "variance": end_amount - start_amount,
-        })
-
-    return pd.DataFrame(rows)
+    # the first and last budgeted amount of every category and month
+    grouped_df = df.sort_values(by=["start_date"], kind="stable")\
+        .groupby(["category_id", "name", "month"])["budgeted"]\
+        .agg(["first", "last"])
+
+    grouped_df["variance"] = grouped_df["last"] - grouped_df["first"]
+
+    return grouped_df[["variance"]].reset_index()
+
+
+def _update_category_variance(
+        variance_df: pd.DataFrame, scd_df: pd.DataFrame, months: list[pd.Timestamp]) -> pd.DataFrame:
+    """ Replaces the rows of `months` in the variance fact with the variance of the SCD rows in `scd_df`
+    """
+    variance_df = variance_df[~variance_df["month"].isin(months)]
+    if len(scd_df) > 0:
+        variance_df = pd.concat([variance_df, _create_category_variance(scd_df)])
+
+    # same order as `_create_category_variance`
+    return variance_df.sort_values(by=["category_id", "name", "month"], kind="stable").reset_index(drop=True)
@@ -1,60 +1,237 @@
+from azure.storage.blob import BlobProperties
+import logging
+import numpy as np
 import pandas as pd
 import blob_helpers
 
 # although this table is not strictly necessary, it does make working in power bi a little easier
 
-
-def create_net_worth_fact(connect_str: str) -> int:
-    transactions_fact = blob_helpers.download_parquet(
-        connect_str, "gold/transactions_fact.snappy.parquet")
-
+TRANSACTIONS_FACT_DATASET = "gold/transactions_fact"
+NET_WORTH_BLOB = "gold/net_worth_fact.snappy.parquet"
+WEEKLY_NET_WORTH_BLOB = "gold/weekly_net_worth_fact.snappy.parquet"
+DAILY_NET_WORTH_BLOB = "gold/daily_net_worth_fact.snappy.parquet"
+# the unrounded running totals at the end of every month, lets the next run start from the earliest changed month
+NET_WORTH_STATE_BLOB = "gold/net_worth_state.json"
+
+# period alias per granularity, weeks start on monday
+GRANULARITIES = {
+    "daily": "D",
+    "weekly": "W",
+    "monthly": "M",
+}
+NET_WORTH_BLOBS = {
+    "monthly": NET_WORTH_BLOB,
+    "weekly": WEEKLY_NET_WORTH_BLOB,
+    "daily": DAILY_NET_WORTH_BLOB,
+}
+ROUNDED_COLUMNS = ["delta", "running_total", "asset_running_total", "liability_running_total"]
+
+
+def create_net_worth_fact(connect_str: str, incremental: bool = False) -> int:
+    """ Creates the monthly, weekly and daily net worth facts
+
+    :param bool incremental:
+        Start from the running totals persisted for the month before the earliest changed transactions month and
+        only recompute the periods from there. Falls back to a full rebuild when there is no state yet, or the
+        accounts changed.
+    """
     accounts_dim = blob_helpers.download_parquet(
-        connect_str, "gold/accounts_dim.snappy.parquet")
+        connect_str, "gold/accounts_dim.snappy.parquet", columns=["account_id", "asset_type"])
+
+    state, state_blob = _load_state(connect_str, accounts_dim) if incremental else (None, None)
+
+    if state is None:
+        transactions_fact = blob_helpers.download_partitioned_parquet(
+            connect_str, TRANSACTIONS_FACT_DATASET, columns=["date", "account_id", "amount"])
+
+        # every granularity is rolled up from the same daily totals
+        daily_net_worth = _aggregate_daily_net_worth(transactions_fact, accounts_dim)
+        facts = {granularity: _compute_net_worth(daily_net_worth, granularity) for granularity in GRANULARITIES}
+        new_state = _create_state(daily_net_worth, accounts_dim)
+    else:
+        months = _changed_months(state, state_blob, blob_helpers.list_partitions(connect_str, TRANSACTIONS_FACT_DATASET))
+        if len(months) == 0:
+            logging.info("net worth is up to date")
+            return 0
+
+        start_month = min(months)
+        logging.info(f"recomputing net worth from {start_month:%Y-%m}")
+        facts, new_state = _update_net_worth(connect_str, state, start_month, accounts_dim)
+        if facts is None:
+            logging.info("net worth asset types changed, rebuilding")
+            return create_net_worth_fact(connect_str)
+
+    upload_size = 0
+    for granularity, net_worth_fact in facts.items():
+        upload_size += blob_helpers.upload_parquet(connect_str, NET_WORTH_BLOBS[granularity], net_worth_fact)
+
+    # the state is written last, a failed run is picked up again from the months changed since the previous state
+    upload_size += blob_helpers.upload_json(connect_str, NET_WORTH_STATE_BLOB, new_state)
+    return upload_size
+
+
+def _load_state(connect_str: str, accounts_dim: pd.DataFrame) -> tuple[dict | None, BlobProperties | None]:
+    state_blob = blob_helpers.get_blob_properties(connect_str, NET_WORTH_STATE_BLOB)
+    if state_blob is None:
+        return None, None
+
+    state = blob_helpers.download_json(connect_str, NET_WORTH_STATE_BLOB)
+    if state["asset_types"] != _account_asset_types(accounts_dim):
+        logging.info("accounts changed since the net worth was computed")
+        return None, None
+
+    if any(blob_helpers.get_blob_properties(connect_str, blob_name) is None for blob_name in NET_WORTH_BLOBS.values()):
+        return None, None
+
+    return state, state_blob
+
+
+def _changed_months(
+        state: dict,
+        state_blob: BlobProperties,
+        partitions: dict[pd.Timestamp, BlobProperties]) -> list[pd.Timestamp]:
+    """ Lists the months whose transactions partition was written after the state, or no longer exists
+    """
+    months = [month for month, blob in partitions.items() if blob.last_modified > state_blob.last_modified]
+    months.extend(month for month in pd.to_datetime(list(state["running_totals"].keys())) if month not in partitions)
+    return months
+
+
+def _update_net_worth(
+        connect_str: str,
+        state: dict,
+        start_month: pd.Timestamp,
+        accounts_dim: pd.DataFrame) -> tuple[dict[str, pd.DataFrame] | None, dict | None]:
+    """ Recomputes the net worth facts from `start_month` on and splices them into the previous facts
+
+    :return: the facts keyed by granularity and the new state, `(None, None)` when the asset types changed and the
+        facts have to be rebuilt
+    """
+    # a week can start in the month before, so the daily totals are read from the start of that week's month
+    read_month = start_month.to_period("W").start_time.to_period("M").to_timestamp()
+    transactions_fact = blob_helpers.download_partitioned_parquet(
+        connect_str, TRANSACTIONS_FACT_DATASET, start_date=read_month, columns=["date", "account_id", "amount"])
+    daily_net_worth = _aggregate_daily_net_worth(transactions_fact, accounts_dim)
+
+    # an asset type first seen from the start month on adds (or removes) rows to the periods before it
+    first_months = pd.to_datetime(pd.Series(state["first_months"], dtype=object))
+    if not set(daily_net_worth["asset_type"]) <= set(first_months.index) or (first_months >= read_month).any():
+        return None, None
+
+    asset_types = sorted(first_months.index)
+    running_totals = {month: totals for month, totals in state["running_totals"].items()
+                      if pd.Timestamp(month) < read_month}
+    opening = pd.Series(running_totals[max(running_totals)], dtype=float) if len(running_totals) > 0 else None
+
+    facts = {}
+    for granularity in GRANULARITIES:
+        start_date = start_month.to_period(GRANULARITIES[granularity]).start_time
+        previous_fact = blob_helpers.download_parquet(connect_str, NET_WORTH_BLOBS[granularity])
+        net_worth_fact = _compute_net_worth(
+            daily_net_worth[daily_net_worth["date"] >= start_date], granularity, asset_types,
+            _opening_totals(opening, daily_net_worth[daily_net_worth["date"] < start_date]))
+        facts[granularity] = pd.concat(
+            [previous_fact[previous_fact["date"] < start_date], net_worth_fact], ignore_index=True)
+
+    running_totals.update(_month_running_totals(daily_net_worth, asset_types, opening))
+    return facts, {
+        "asset_types": state["asset_types"],
+        "first_months": state["first_months"],
+        "running_totals": running_totals,
+    }
+
+
+def _create_state(daily_net_worth: pd.DataFrame, accounts_dim: pd.DataFrame) -> dict:
+    first_months = daily_net_worth.groupby("asset_type")["date"].min().dt.to_period("M").dt.to_timestamp()
+
+    return {
+        "asset_types": _account_asset_types(accounts_dim),
+        "first_months": {asset_type: month.strftime("%Y-%m-%d") for asset_type, month in first_months.items()},
+        "running_totals": _month_running_totals(daily_net_worth, sorted(first_months.index)),
+    }
+
+
+def _account_asset_types(accounts_dim: pd.DataFrame) -> dict[str, str]:
+    return dict(sorted(zip(accounts_dim["account_id"].astype(str), accounts_dim["asset_type"].astype(str))))
+
+
+def _month_running_totals(
+        daily_net_worth: pd.DataFrame,
+        asset_types: list[str],
+        opening: pd.Series = None) -> dict[str, dict[str, float]]:
+    # unrounded, so resumed totals match a full rebuild
+    months = daily_net_worth["date"].dt.to_period("M").dt.to_timestamp()
+    running_totals = daily_net_worth.groupby([months, "asset_type"])["amount"].sum()\
+        .unstack("asset_type", fill_value=0).reindex(columns=asset_types, fill_value=0).astype(float).cumsum()
+    if opening is not None:
+        running_totals = running_totals + opening.reindex(asset_types, fill_value=0.0)
+
+    return {month.strftime("%Y-%m-%d"): totals.to_dict() for month, totals in running_totals.iterrows()}
+
+
+def _opening_totals(opening: pd.Series | None, daily_net_worth: pd.DataFrame) -> pd.Series | None:
+    # the days between the persisted month end and the start of the recomputed periods
+    if len(daily_net_worth) == 0:
+        return opening
+
+    totals = daily_net_worth.groupby("asset_type")["amount"].sum().astype(float)
+    return totals if opening is None else opening.add(totals, fill_value=0.0)
+
+
+def _aggregate_daily_net_worth(transactions_fact: pd.DataFrame, accounts_dim: pd.DataFrame) -> pd.DataFrame:
+    """Sums the transactions per day and asset type, the transactions are merged with the accounts once here
+
+    :param pd.DataFrame transactions_fact: the transactions with `date`, `account_id` and `amount`
+    :param pd.DataFrame accounts_dim: the accounts with `account_id` and `asset_type`
+    :return pd.DataFrame: `date`, `asset_type` and `amount`
+    """
+    # convert date column to datetime
+    dates = pd.to_datetime(transactions_fact["date"])
+
+    # merge transactions_fact and accounts_dim DataFrames
+    df = pd.merge(transactions_fact[["account_id", "amount"]].assign(date=dates.dt.normalize()),
+                  accounts_dim[["account_id", "asset_type"]], how="left",
+                  left_on="account_id", right_on="account_id")
 
-    # order by date desc
-    net_worth_fact = _compute_monthly_net_worth(
-        transactions_fact, accounts_dim)
+    return df.groupby(["date", "asset_type"], as_index=False)["amount"].sum()
 
-    return blob_helpers.upload_parquet(connect_str, "gold/net_worth_fact.snappy.parquet", net_worth_fact)
 
+def _compute_net_worth(
+        daily_net_worth: pd.DataFrame,
+        granularity: str = "monthly",
+        asset_types: list[str] = None,
+        opening: pd.Series = None) -> pd.DataFrame:
+    """Rolls the daily totals up to the granularity and adds the running totals per asset type
 
-def _compute_monthly_net_worth(transactions_fact: pd.DataFrame, accounts_dim: pd.DataFrame) -> pd.DataFrame:
-    # convert date column to datetime
-    transactions_fact["date"] = pd.to_datetime(transactions_fact["date"])
+    :param pd.DataFrame daily_net_worth: the output of `_aggregate_daily_net_worth`
+    :param str granularity: one of `daily`, `weekly` or `monthly`, periods are labeled by their first day
+    :param list[str] asset_types: the asset types to fill in every period, defaults to the ones in the daily totals
+    :param pd.Series opening: the running totals per asset type before the first period, defaults to 0
+    :return pd.DataFrame: the net worth fact
+    """
+    periods = daily_net_worth["date"].dt.to_period(GRANULARITIES[granularity]).dt.start_time
 
-    # merge transactions_fact and accounts_dim DataFrames
-    df = pd.merge(transactions_fact, accounts_dim, how="left",
-                  left_on="account_id", right_on="account_id")
+    # group by period and asset type, and aggregate amount column
+    net_worth_fact = daily_net_worth.groupby([periods, "asset_type"])["amount"].sum()
 
-    # group by month and asset type, and aggregate amount column
-    net_worth_fact = df.groupby([pd.Grouper(key="date", freq="MS"), "asset_type"]).agg(
-        {"amount": "sum"}).reset_index()
+    # pivot to fill the periods without transactions of an asset type, stacking back orders by date and asset type
+    pivoted = net_worth_fact.unstack("asset_type", fill_value=0).astype(float).sort_index()
+    if asset_types is not None:
+        pivoted = pivoted.reindex(columns=pd.Index(asset_types, name="asset_type"), fill_value=0.0)
+    running_totals = pivoted.cumsum()
+    if opening is not None:
+        running_totals = running_totals + opening.reindex(pivoted.columns, fill_value=0.0)
 
-    # pivot DataFrame to reshape it
-    net_worth_fact = net_worth_fact.pivot(index="date", columns="asset_type", values="amount").fillna(
-        0).stack().reset_index(name="amount")
+    net_worth_fact = pivoted.stack().reset_index(name="delta")
+    net_worth_fact["running_total"] = running_totals.stack().to_numpy()
 
     # add computed fields
-    net_worth_fact["running_total"] = net_worth_fact.groupby("asset_type")[
-        "amount"].cumsum()
-    net_worth_fact["asset_running_total"] = net_worth_fact.apply(
-        lambda row: row["running_total"] if row["asset_type"] == "asset" else None, axis=1)
-    net_worth_fact["liability_running_total"] = net_worth_fact.apply(
-        lambda row: row["running_total"] if row["asset_type"] == "liability" else None, axis=1)
-
-    # rename columns
-    net_worth_fact = net_worth_fact.rename(columns={"amount": "delta"})
+    asset_type = net_worth_fact["asset_type"].to_numpy()
+    running_total = net_worth_fact["running_total"].to_numpy()
+    net_worth_fact["asset_running_total"] = np.where(asset_type == "asset", running_total, np.nan)
+    net_worth_fact["liability_running_total"] = np.where(asset_type == "liability", running_total, np.nan)
 
     # round results to account for floating point errors, future work will make this configurable
-    net_worth_fact["delta"] = round(net_worth_fact["delta"], 2)
-    net_worth_fact["running_total"] = round(net_worth_fact["running_total"], 2)
-    net_worth_fact["asset_running_total"] = round(
-        net_worth_fact["asset_running_total"], 2)
-    net_worth_fact["liability_running_total"] = round(
-        net_worth_fact["liability_running_total"], 2)
-
-    # order by date desc
-    net_worth_fact = net_worth_fact.sort_values(["date", "asset_type"], ascending=[
-                                                True, True]).reset_index(drop=True)
+    net_worth_fact[ROUNDED_COLUMNS] = net_worth_fact[ROUNDED_COLUMNS].round(2)
 
     return net_worth_fact
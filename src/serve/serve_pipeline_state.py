@@ -0,0 +1,21 @@
+from datetime import datetime, timezone
+import blob_helpers
+import storage_clients
+
+SILVER_PREFIX = "silver/"
+# written once every gold activity of a run succeeded
+GOLD_STATE_BLOB = "gold/pipeline_state.json"
+
+
+def silver_changed(connect_str: str) -> bool:
+    """ Whether any silver blob was written since gold was last built in full, a run that failed in gold is not
+    skipped by the next run even when the YNAB data did not change in between
+    """
+    container_client = storage_clients.get_container_client(connect_str)
+    return blob_helpers.is_stale(connect_str, GOLD_STATE_BLOB, container_client.list_blobs(name_starts_with=SILVER_PREFIX))
+
+
+def mark_gold_built(connect_str: str) -> int:
+    return blob_helpers.upload_json(connect_str, GOLD_STATE_BLOB, {
+        "built_at": datetime.now(timezone.utc).isoformat(),
+    })
@@ -1,22 +1,36 @@
+from azure.storage.blob import BlobProperties
 from datetime import datetime
+import logging
 import blob_helpers
 import pandas as pd
 
+CATEGORY_DIM_SOURCE_COLUMNS = ["id", "name", "category_group_id", "category_group_name", "hidden", "snapshot_date"]
+
 
 def create_transactions_fact(connect_str: str) -> int:
     # Define the list of column names that you want to keep
     keep_cols = ["id", "date", "amount", "account_id",
                  "payee_id", "category_id", "debt_transaction_type"]
 
-    df = blob_helpers.download_parquet(
-        connect_str, "silver/transactions.snappy.parquet")
+    # only rebuild the months whose silver partition changed since the gold partition was written
+    months = _stale_months(
+        blob_helpers.list_partitions(connect_str, "silver/transactions"),
+        blob_helpers.list_partitions(connect_str, "gold/transactions_fact"))
+    if len(months) == 0:
+        logging.info("transactions fact is up to date")
+        return 0
 
-    # Drop columns that are not in the list of column names that you want to keep
-    drop_cols = set(df.columns) - set(keep_cols)
-    df = df.drop(columns=drop_cols)
+    df = blob_helpers.download_partitioned_parquet(
+        connect_str, "silver/transactions", min(months), max(months) + pd.offsets.MonthEnd(0), columns=keep_cols)
 
-    return blob_helpers.upload_parquet(
-        connect_str, "gold/transactions_fact.snappy.parquet", df)
+    upload_size = blob_helpers.upload_partitioned_parquet(
+        connect_str, "gold/transactions_fact", df, months)
+
+    # the power bi report reads the fact as a single file, the partitions are combined without going through pandas
+    table = blob_helpers.download_partitioned_parquet(
+        connect_str, "gold/transactions_fact", as_arrow=True)
+    return upload_size + blob_helpers.upload_parquet(
+        connect_str, "gold/transactions_fact.snappy.parquet", table)
 
 
 def create_category_dim(connect_str: str) -> int:
@@ -25,7 +39,7 @@ def create_category_dim(connect_str: str) -> int:
     now = datetime.today()
     month = datetime(now.year, now.month, 1).strftime("%Y-%m-%d")
     df = blob_helpers.download_parquet(
-        connect_str, f"silver/budget_months/{month}.snappy.parquet")
+        connect_str, f"silver/budget_months/{month}.snappy.parquet", columns=CATEGORY_DIM_SOURCE_COLUMNS)
 
     df = _create_category_dim(df)
 
@@ -62,8 +76,9 @@ def create_accounts_dim(connect_str: str) -> int:
         "deleted",
     ]
 
+    # asset_type is derived below, the other columns are the only ones read
     df = blob_helpers.download_parquet(
-        connect_str, "silver/accounts.snappy.parquet")
+        connect_str, "silver/accounts.snappy.parquet", columns=[col for col in keep_cols if col != "asset_type"])
 
     df["asset_type"] = df["type"].map(asset_map)
 
@@ -76,10 +91,10 @@ def create_accounts_dim(connect_str: str) -> int:
 
 
 def create_payee_dim(connect_str: str) -> int:
-    df = blob_helpers.download_parquet(
-        connect_str, "silver/transactions.snappy.parquet")
+    df = blob_helpers.download_partitioned_parquet(
+        connect_str, "silver/transactions", columns=["payee_id", "payee_name"])
 
-    df = df[["payee_id", "payee_name"]]\
+    df = df\
         .drop_duplicates()\
         .rename(columns={"payee_name": "name"})\
         .reset_index(drop=True)
@@ -104,3 +119,17 @@ def _create_category_dim(df: pd.DataFrame) -> pd.DataFrame:
     df = df.rename(columns={"id": "category_id"})
 
     return df
+
+
+def _stale_months(
+        source_partitions: dict[pd.Timestamp, BlobProperties],
+        target_partitions: dict[pd.Timestamp, BlobProperties]) -> list[pd.Timestamp]:
+    """ Lists the months where the target partition is missing, older than the source partition, or no longer has
+    a source partition
+    """
+    months = [month for month, blob in source_partitions.items()
+              if month not in target_partitions or target_partitions[month].last_modified < blob.last_modified]
+    months.extend(month for month in target_partitions.keys()
+                  if month not in source_partitions)
+
+    return sorted(months)
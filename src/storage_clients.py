@@ -0,0 +1,46 @@
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import BlobClient, BlobServiceClient, ContainerClient
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+import os
+import requests
+
+CONTAINER = "ynab"
+# connections kept alive per host, sized for the concurrent blob downloads of the pipeline
+POOL_MAXSIZE = 32
+CONNECTION_TIMEOUT = 20
+READ_TIMEOUT = 60
+# blobs downloaded at a time by the activities that read many blobs, overridable through the app settings
+MAX_CONCURRENCY = int(os.getenv("BLOB_MAX_CONCURRENCY", "8"))
+
+
+@lru_cache(maxsize=None)
+def get_blob_service_client(connect_str: str) -> BlobServiceClient:
+    """Returns the process wide client of the storage account, created once per connection string so the
+    connection string is parsed once and the pooled connections are reused by every activity of the worker
+    """
+    return BlobServiceClient.from_connection_string(connect_str, transport=_create_transport())
+
+
+@lru_cache(maxsize=None)
+def get_container_client(connect_str: str, container: str = CONTAINER) -> ContainerClient:
+    return get_blob_service_client(connect_str).get_container_client(container)
+
+
+def get_blob_client(connect_str: str, blob_name: str, container: str = CONTAINER) -> BlobClient:
+    # blob clients are cheap, they share the pipeline (and connections) of the container client
+    return get_container_client(connect_str, container).get_blob_client(blob_name)
+
+
+def _create_transport() -> RequestsTransport:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    # the session is owned here so the transport does not close it when a client is closed
+    return RequestsTransport(
+        session=session,
+        session_owner=False,
+        connection_timeout=CONNECTION_TIMEOUT,
+        read_timeout=READ_TIMEOUT)
@@ -5,10 +5,10 @@ import blob_helpers
 
 def validate_transactions_fact(connect_str: str):
     # load the accounts_dim table
-    transactions_df = blob_helpers.download_parquet(
-        connect_str, "gold/transactions_fact.snappy.parquet")
+    transactions_df = blob_helpers.download_partitioned_parquet(
+        connect_str, "gold/transactions_fact", columns=["account_id", "amount"])
     accounts_df = blob_helpers.download_parquet(
-        connect_str, "gold/accounts_dim.snappy.parquet")
+        connect_str, "gold/accounts_dim.snappy.parquet", columns=["account_id", "name", "balance"])
 
     _validate_transactions_fact(transactions_df, accounts_df)
     return True
@@ -17,9 +17,9 @@ def validate_transactions_fact(connect_str: str):
 def validate_net_worth_fact(connect_str: str):
     # load the accounts_dim table
     net_worth_df = blob_helpers.download_parquet(
-        connect_str, "gold/net_worth_fact.snappy.parquet")
+        connect_str, "gold/net_worth_fact.snappy.parquet", columns=["delta"])
     accounts_df = blob_helpers.download_parquet(
-        connect_str, "gold/accounts_dim.snappy.parquet")
+        connect_str, "gold/accounts_dim.snappy.parquet", columns=["balance"])
 
     _validate_net_worth_fact(net_worth_df, accounts_df)
     return True
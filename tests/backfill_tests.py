@@ -0,0 +1,147 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+# Add the directory containing the modules to the `PYTHONPATH`
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "src")))
+
+import src.ingestion.backfill as backfill  # noqa:E402 (module level import not at top of file)
+
+
+class NextStartTimeTestCase(unittest.TestCase):
+
+    def test_starts_now_below_the_limit(self):
+        # Arrange
+        now = datetime(2024, 1, 1, 12)
+        start_times = [now - timedelta(minutes=minutes) for minutes in [90, 30, 10]]
+
+        # Act
+        actual = backfill.next_start_time(start_times, now, max_requests=3)
+
+        # Assert
+        self.assertEqual(actual, now)
+
+    def test_waits_for_the_window_to_free_up(self):
+        # Arrange
+        now = datetime(2024, 1, 1, 12)
+        start_times = [now - timedelta(minutes=minutes) for minutes in [50, 40, 30, 10]]
+
+        # Act
+        actual = backfill.next_start_time(start_times, now, max_requests=3)
+
+        # Assert: the request from 40 minutes ago has to leave the hour
+        self.assertEqual(actual, now + timedelta(minutes=20))
+
+
+class ListPendingMonthsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.months = {"data": {"months": [{"month": month} for month in
+                                           ["2024-03-01", "2024-02-01", "2024-01-01", "2023-12-01"]]}}
+        self.container_client = mock.Mock()
+        self.container_client.list_blobs.return_value = [
+            SimpleNamespace(name=f"{backfill.BACKFILL_CHECKPOINT_PREFIX}2024-01-01.json")]
+
+    def test_checkpointed_and_later_months_are_skipped(self):
+        # Act
+        with mock.patch.object(backfill.ingest, "_fetch_raw_json", return_value=self.months), \
+                mock.patch.object(backfill.storage_clients, "get_container_client", return_value=self.container_client):
+            actual = backfill.list_pending_months("", "2024-02-15")
+
+        # Assert
+        self.assertListEqual(actual, ["2023-12-01", "2024-02-01"])
+
+    def test_restart_clears_the_checkpoints(self):
+        # Arrange
+        self.container_client.list_blobs.side_effect = [self.container_client.list_blobs.return_value, []]
+
+        # Act
+        with mock.patch.object(backfill.ingest, "_fetch_raw_json", return_value=self.months), \
+                mock.patch.object(backfill.storage_clients, "get_container_client", return_value=self.container_client), \
+                mock.patch.object(backfill.blob_helpers, "delete_blob") as delete_blob:
+            actual = backfill.list_pending_months("", "2024-02-15", restart=True)
+
+        # Assert
+        delete_blob.assert_called_once_with("", f"{backfill.BACKFILL_CHECKPOINT_PREFIX}2024-01-01.json")
+        self.assertListEqual(actual, ["2023-12-01", "2024-01-01", "2024-02-01"])
+
+
+class LoadBudgetMonthsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        category = {"id": "c1", "category_group_id": "g1", "name": "Rent", "hidden": False,
+                    "budgeted": 1000, "activity": -1000, "balance": 0}
+        export = json.dumps({"data": {"budget": {
+            "category_groups": [{"id": "g1", "name": "Bills"}],
+            "months": [{"month": month, "categories": [dict(category)]}
+                       for month in ["2024-03-01", "2024-02-01", "2024-01-01"]],
+        }}}).encode()
+        # small chunks so the months are split across them
+        self.chunks = [export[index:index + 16] for index in range(0, len(export), 16)]
+
+    def test_months_are_split_into_snapshots(self):
+        # Act
+        with mock.patch.object(backfill.ingest, "_fetch_raw_stream", return_value=iter(self.chunks)) as fetch, \
+                mock.patch.object(backfill.ingest, "_upload_blob", side_effect=lambda _, __, raw, ___: len(raw)) as upload:
+            actual = backfill.ingest.load_budget_months("", ["2024-01-01", "2024-03-01"])
+
+        # Assert: a single request, and the layout of `load_current_budget_month`
+        fetch.assert_called_once_with("")
+        self.assertListEqual(sorted(actual), ["2024-01-01", "2024-03-01"])
+        blobs = {call.args[1]: json.loads(call.args[2]) for call in upload.call_args_list}
+        self.assertListEqual(sorted(blobs), ["bronze/month/2024-01-01/2024-01-01.json",
+                                             "bronze/month/2024-03-01/2024-03-01.json"])
+        month = blobs["bronze/month/2024-03-01/2024-03-01.json"]["data"]["month"]
+        self.assertEqual(month["month"], "2024-03-01")
+        self.assertEqual(month["categories"][0]["category_group_name"], "Bills")
+
+    def test_months_before_category_groups_are_named(self):
+        # Arrange: the key order of the export is not part of the api contract
+        export = json.loads(b"".join(self.chunks))
+        budget = export["data"]["budget"]
+        export["data"]["budget"] = {"months": budget["months"], "category_groups": budget["category_groups"]}
+        encoded = json.dumps(export).encode()
+        chunks = [encoded[index:index + 16] for index in range(0, len(encoded), 16)]
+
+        # Act
+        with mock.patch.object(backfill.ingest, "_fetch_raw_stream", return_value=iter(chunks)), \
+                mock.patch.object(backfill.ingest, "_upload_blob", side_effect=lambda _, __, raw, ___: len(raw)) as upload:
+            backfill.ingest.load_budget_months("", ["2024-03-01"])
+
+        # Assert
+        month = json.loads(upload.call_args.args[2])["data"]["month"]
+        self.assertEqual(month["categories"][0]["category_group_name"], "Bills")
+
+    def test_unknown_category_group_raises(self):
+        # Arrange
+        export = json.loads(b"".join(self.chunks))
+        export["data"]["budget"]["category_groups"] = [{"id": "g2", "name": "Savings"}]
+
+        # Act & Assert
+        with mock.patch.object(backfill.ingest, "_fetch_raw_stream", return_value=iter([json.dumps(export).encode()])), \
+                mock.patch.object(backfill.ingest, "_upload_blob", return_value=1):
+            self.assertRaises(Exception, backfill.ingest.load_budget_months, "", ["2024-03-01"])
+
+    def test_snapshot_date(self):
+        # Act
+        with mock.patch.object(backfill.ingest, "_fetch_raw_stream", return_value=iter(self.chunks)), \
+                mock.patch.object(backfill.ingest, "_upload_blob", return_value=1) as upload:
+            backfill.ingest.load_budget_months("", ["2024-02-01"], datetime(2024, 3, 5))
+
+        # Assert
+        self.assertEqual(upload.call_args.args[1], "bronze/month/2024-02-01/2024-03-05.json")
+
+    def test_missing_month_raises(self):
+        # Act & Assert
+        with mock.patch.object(backfill.ingest, "_fetch_raw_stream", return_value=iter(self.chunks)), \
+                mock.patch.object(backfill.ingest, "_upload_blob", return_value=1):
+            self.assertRaises(Exception, backfill.ingest.load_budget_months, "", ["2023-12-01"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Add the directory containing the modules to the `PYTHONPATH`
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "src")))
+
+import src.blob_helpers as blob_helpers  # noqa:E402 (module level import not at top of file)
+
+
+class DownloadParquetBlobsTestCase(unittest.TestCase):
+
+    def test_blobs_are_combined_in_order(self):
+        # Arrange: finish the first downloads last
+        blob_names = [f"silver/budget_months/2023-{month:02d}-01.snappy.parquet" for month in range(1, 5)]
+
+        def download_table(connect_str, blob_name, columns=None, filters=None, size=None):
+            month = int(blob_name.split("-")[1])
+            time.sleep((5 - month) * 0.01)
+            return pa.table({"month": [month], "budgeted": [month * 1.0]}).select(columns)
+
+        # Act
+        with mock.patch.object(blob_helpers, "_download_table", side_effect=download_table):
+            actual = blob_helpers.download_parquet_blobs("", blob_names, columns=["month"], max_concurrency=4)
+
+        # Assert
+        pd.testing.assert_frame_equal(actual, pd.DataFrame({"month": [1, 2, 3, 4]}))
+
+    def test_no_blobs(self):
+        # Act
+        actual = blob_helpers.download_parquet_blobs("", [], columns=["month", "budgeted"])
+
+        # Assert
+        self.assertEqual(len(actual), 0)
+        self.assertEqual(list(actual.columns), ["month", "budgeted"])
+
+
+class DownloadParquetTestCase(unittest.TestCase):
+
+    def setUp(self):
+        df = pd.DataFrame({
+            "date": pd.to_datetime(["2023-01-01", "2023-01-15", "2023-02-01", "2023-02-15"]),
+            "account_id": ["a", "b", "a", "b"],
+            "amount": [1.0, 2.0, 3.0, 4.0],
+        })
+        buffer = pa.BufferOutputStream()
+        pq.write_table(pa.Table.from_pandas(df), buffer, row_group_size=2)
+
+        data = buffer.getvalue().to_pybytes()
+
+        def download_blob(offset=None, length=None):
+            end = None if length is None else offset + length
+            return mock.Mock(readall=mock.Mock(return_value=data[offset:end]))
+
+        blob_client = mock.Mock(blob_name="gold/transactions_fact.snappy.parquet")
+        blob_client.download_blob.side_effect = download_blob
+        blob_client.get_blob_properties.return_value.size = len(data)
+        self.blob_client = blob_client
+        patcher = mock.patch.object(blob_helpers.storage_clients, "get_blob_client", return_value=blob_client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_columns_and_filters(self):
+        # Act
+        actual = blob_helpers.download_parquet(
+            "", "gold/transactions_fact.snappy.parquet", columns=["date", "amount"],
+            filters=[("date", ">=", pd.Timestamp("2023-02-01"))])
+
+        # Assert
+        pd.testing.assert_frame_equal(actual, pd.DataFrame({
+            "date": pd.to_datetime(["2023-02-01", "2023-02-15"]),
+            "amount": [3.0, 4.0],
+        }))
+
+    def test_as_arrow(self):
+        # Act
+        actual = blob_helpers.download_parquet(
+            "", "gold/transactions_fact.snappy.parquet", columns=["account_id"], as_arrow=True)
+
+        # Assert
+        self.assertIsInstance(actual, pa.Table)
+        self.assertEqual(actual.column_names, ["account_id"])
+        self.assertEqual(actual.num_rows, 4)
+
+    def test_ranged_read(self):
+        # Arrange: treat the blob as large enough to only fetch the needed ranges
+        expected = blob_helpers.download_parquet(
+            "", "gold/transactions_fact.snappy.parquet", columns=["amount"], filters=[("account_id", "==", "a")])
+
+        # Act
+        with mock.patch.object(blob_helpers, "RANGED_READ_MIN_SIZE", 0):
+            actual = blob_helpers.download_parquet(
+                "", "gold/transactions_fact.snappy.parquet", columns=["amount"], filters=[("account_id", "==", "a")])
+
+        # Assert
+        pd.testing.assert_frame_equal(actual, expected)
+        self.assertTrue(all("offset" in call.kwargs for call in self.blob_client.download_blob.call_args_list[1:]))
+
+
+class WriterProfileTestCase(unittest.TestCase):
+
+    def test_longest_prefix_wins(self):
+        # Act
+        transactions = blob_helpers.get_writer_profile("silver/transactions/year=2023/month=01/part-0.snappy.parquet")
+        accounts = blob_helpers.get_writer_profile("silver/accounts.snappy.parquet")
+
+        # Assert
+        self.assertIs(transactions, blob_helpers.TRANSACTIONS_WRITER_PROFILE)
+        self.assertIs(accounts, blob_helpers.DEFAULT_WRITER_PROFILE)
+
+    def test_upload_applies_the_profile(self):
+        # Arrange
+        blob_client = mock.Mock()
+        df = pd.DataFrame({"account_id": ["a", "b"] * 50, "amount": [float(i) for i in range(100)]})
+        profile = {"compression": "zstd", "use_dictionary": ["account_id", "missing"], "row_group_size": 25,
+                   "write_statistics": ["amount"]}
+
+        # Act
+        with mock.patch.object(blob_helpers.storage_clients, "get_blob_client", return_value=blob_client):
+            blob_helpers.upload_parquet("", "gold/fact.snappy.parquet", df, profile)
+
+        # Assert
+        metadata = pq.ParquetFile(pa.BufferReader(blob_client.upload_blob.call_args.args[0])).metadata
+        self.assertEqual(metadata.num_row_groups, 4)
+        account_id, amount = metadata.row_group(0).column(0), metadata.row_group(0).column(1)
+        self.assertEqual(account_id.compression, "ZSTD")
+        self.assertIn("RLE_DICTIONARY", account_id.encodings)
+        self.assertNotIn("RLE_DICTIONARY", amount.encodings)
+        self.assertFalse(account_id.is_stats_set)
+        self.assertTrue(amount.is_stats_set)
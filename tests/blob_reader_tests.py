@@ -0,0 +1,70 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+# Add the directory containing the modules to the `PYTHONPATH`
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from src.blob_reader import RangedBlobReader  # noqa:E402 (module level import not at top of file)
+
+DATA = bytes(range(256)) * 4
+
+
+class RangedBlobReaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.blob_client = mock.Mock(blob_name="gold/fact.snappy.parquet")
+        self.blob_client.download_blob.side_effect = \
+            lambda offset, length: mock.Mock(readall=mock.Mock(return_value=DATA[offset:offset + length]))
+        self.blob_client.get_blob_properties.return_value.size = len(DATA)
+
+    def test_seek_and_read(self):
+        # Arrange
+        reader = RangedBlobReader(self.blob_client, block_size=100)
+
+        # Act
+        reader.seek(-10, os.SEEK_END)
+        tail = reader.read(20)
+        reader.seek(95)
+        middle = reader.read(10)
+
+        # Assert
+        self.assertEqual(tail, DATA[-10:])
+        self.assertEqual(middle, DATA[95:105])
+        self.assertEqual(reader.tell(), 105)
+        self.assertEqual(reader.read(0), b"")
+
+    def test_missing_blocks_are_fetched_in_one_request(self):
+        # Arrange
+        reader = RangedBlobReader(self.blob_client, len(DATA), block_size=100)
+        reader.read_range(150, 10)
+
+        # Act
+        actual = reader.read_range(0, 450)
+
+        # Assert: block 1 is cached, blocks 0 and 2 to 4 are fetched
+        self.assertEqual(actual, DATA[:450])
+        self.assertEqual(reader.request_count, 3)
+        self.assertEqual(reader.bytes_downloaded, 500)
+        self.blob_client.get_blob_properties.assert_not_called()
+
+    def test_least_recently_used_blocks_are_evicted(self):
+        # Arrange
+        reader = RangedBlobReader(self.blob_client, len(DATA), block_size=100, cache_blocks=2)
+        reader.read_range(0, 1)
+        reader.read_range(100, 1)
+        reader.read_range(0, 1)
+
+        # Act: block 1 is the least recently used
+        reader.read_range(200, 1)
+        reader.read_range(0, 1)
+        reader.read_range(100, 1)
+
+        # Assert
+        self.assertEqual(reader.request_count, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import gc
+import os
+import sys
+import unittest
+from unittest import mock
+
+# Add the directory containing the modules to the `PYTHONPATH`
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from src.blob_writer import StagedBlobWriter  # noqa:E402 (module level import not at top of file)
+
+
+class StagedBlobWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.staged = {}
+        self.blob_client = mock.Mock()
+        self.blob_client.stage_block.side_effect = \
+            lambda block_id, block, length: self.staged.__setitem__(block_id, block)
+
+    def test_blocks_are_staged_and_committed_in_order(self):
+        # Arrange
+        data = bytes(range(256)) * 10
+
+        # Act
+        with StagedBlobWriter(self.blob_client, block_size=1000, max_concurrency=2) as writer:
+            for start in range(0, len(data), 300):
+                writer.write(memoryview(data)[start:start + 300])
+
+        # Assert
+        block_ids = self.blob_client.commit_block_list.call_args.args[0]
+        self.assertEqual(block_ids, ["000000", "000001", "000002"])
+        self.assertEqual(b"".join(self.staged[block_id] for block_id in block_ids), data)
+        self.assertEqual(writer.bytes_written, len(data))
+        self.blob_client.upload_blob.assert_not_called()
+
+    def test_small_data_is_uploaded_at_once(self):
+        # Act
+        with StagedBlobWriter(self.blob_client, block_size=1000) as writer:
+            writer.write(b"small")
+
+        # Assert
+        self.blob_client.upload_blob.assert_called_once_with(b"small", overwrite=True)
+        self.blob_client.stage_block.assert_not_called()
+
+    def test_failed_writes_are_not_committed(self):
+        # Act
+        with self.assertRaises(ValueError):
+            with StagedBlobWriter(self.blob_client, block_size=10) as writer:
+                writer.write(b"x" * 25)
+                raise ValueError("encoding failed")
+
+        # Assert
+        self.assertTrue(writer.closed)
+        self.blob_client.commit_block_list.assert_not_called()
+        self.blob_client.upload_blob.assert_not_called()
+
+    def test_writer_dropped_without_commit_leaves_the_blob_untouched(self):
+        # Arrange: e.g. the parquet encoder raised part way through without a `with` block
+        writer = StagedBlobWriter(self.blob_client, block_size=10)
+        writer.write(b"x" * 25)
+
+        # Act
+        del writer
+        gc.collect()
+
+        # Assert
+        self.blob_client.commit_block_list.assert_not_called()
+        self.blob_client.upload_blob.assert_not_called()
+
+    def test_close_does_not_commit(self):
+        # Arrange
+        writer = StagedBlobWriter(self.blob_client, block_size=1000)
+        writer.write(b"small")
+
+        # Act
+        writer.close()
+        writer.commit()
+
+        # Assert
+        self.assertTrue(writer.closed)
+        self.blob_client.upload_blob.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+from datetime import datetime
+from types import SimpleNamespace
+import os
+import sys
+import unittest
+
+# Add the directory containing the modules to the `PYTHONPATH`
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "src")))
+
+import src.function_app as function_app  # noqa:E402 (module level import not at top of file)
+
+
+class FakeOrchestrationContext:
+    """ Records the sub orchestrators started, `task_any` is answered by the test
+    """
+
+    def __init__(self):
+        self.current_utc_datetime = datetime(2024, 3, 1)
+        self.custom_status = None
+
+    def call_sub_orchestrator(self, orchestrator, input):
+        return SimpleNamespace(input=input, result=None)
+
+    def task_any(self, tasks):
+        return tasks
+
+    def set_custom_status(self, status):
+        self.custom_status = status
+
+
+class BackfillMonthsTestCase(unittest.TestCase):
+
+    def run_backfill(self, results: dict) -> tuple[list[str], int]:
+        """ Runs the backfill to completion, finishing the oldest sub orchestrator first with its result in `results`
+        """
+        context = FakeOrchestrationContext()
+        orchestration = function_app._backfill_months(context, list(results), {"max_parallelism": 2}, False)
+
+        try:
+            tasks = next(orchestration)
+            while True:
+                finished = tasks[0]
+                finished.result = results[finished.input["month"]]
+                tasks = orchestration.send(finished)
+        except StopIteration as stop:
+            return stop.value
+
+    def test_months_that_returned_an_error_are_failed(self):
+        # Act
+        failed, completed_count = self.run_backfill({
+            "2024-01-01": {"month": "2024-01-01"},
+            "2024-02-01": {"month": "2024-02-01", "error": "throttled"},
+        })
+
+        # Assert
+        self.assertListEqual(failed, ["2024-02-01"])
+        self.assertEqual(completed_count, 1)
+
+    def test_faulted_sub_orchestrator_does_not_stop_the_backfill(self):
+        # Act: the sub orchestrator of February failed outright
+        failed, completed_count = self.run_backfill({
+            "2024-01-01": {"month": "2024-01-01"},
+            "2024-02-01": Exception("sub orchestrator failed"),
+            "2024-03-01": {"month": "2024-03-01"},
+        })
+
+        # Assert
+        self.assertListEqual(failed, ["2024-02-01"])
+        self.assertEqual(completed_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+from types import SimpleNamespace
+import gzip
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+# Add the directory containing the modules to the `PYTHONPATH`
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "src")))
+
+import src.ingestion.ingest as ingest  # noqa:E402 (module level import not at top of file)
+
+
+class ContentHashTestCase(unittest.TestCase):
+
+    def test_key_order_and_server_knowledge_are_ignored(self):
+        # Arrange
+        payload = {"data": {"accounts": [{"id": "a1", "balance": 100}], "server_knowledge": 10}}
+        reloaded = {"data": {"server_knowledge": 12, "accounts": [{"balance": 100, "id": "a1"}]}}
+
+        # Act & Assert
+        self.assertEqual(ingest.content_hash(payload), ingest.content_hash(reloaded))
+
+    def test_changed_payload(self):
+        # Arrange
+        payload = {"data": {"accounts": [{"id": "a1", "balance": 100}], "server_knowledge": 10}}
+        changed = {"data": {"accounts": [{"id": "a1", "balance": 150}], "server_knowledge": 10}}
+
+        # Act & Assert
+        self.assertNotEqual(ingest.content_hash(payload), ingest.content_hash(changed))
+
+
+class LoadAccountsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.payload = {"data": {"accounts": [{"id": "a1", "balance": 100}], "server_knowledge": 10}}
+        self.blob_client = mock.Mock()
+
+    def load_accounts(self, stored_hash: str | None) -> int:
+        with mock.patch.object(ingest, "_fetch_raw_json", return_value=self.payload), \
+                mock.patch.object(ingest.blob_helpers, "get_content_hash", return_value=stored_hash), \
+                mock.patch.object(ingest.storage_clients, "get_blob_client", return_value=self.blob_client):
+            return ingest.load_accounts("")
+
+    def test_unchanged_accounts_are_not_uploaded(self):
+        # Act
+        actual = self.load_accounts(ingest.content_hash(self.payload))
+
+        # Assert
+        self.assertEqual(actual, 0)
+        self.blob_client.upload_blob.assert_not_called()
+
+    def test_changed_accounts_are_uploaded_with_their_hash(self):
+        # Act
+        actual = self.load_accounts("previous")
+
+        # Assert
+        self.assertGreater(actual, 0)
+        data = self.blob_client.upload_blob.call_args.args[0]
+        self.assertDictEqual(json.loads(gzip.decompress(data)), self.payload)
+        self.assertDictEqual(self.blob_client.upload_blob.call_args.kwargs["metadata"],
+                             {"content_hash": ingest.content_hash(self.payload)})
+
+
+class LoadAllTransactionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.blob_client = mock.Mock()
+        self.container_client = SimpleNamespace(list_blobs=lambda name_starts_with: [], delete_blob=mock.Mock())
+
+    def load_transactions(self, server_knowledge: int, stored_hash: str | None) -> tuple[int, mock.Mock]:
+        payload = json.dumps({"data": {"transactions": [{"id": "t1", "amount": -1000}],
+                                       "server_knowledge": server_knowledge}}).encode()
+
+        with mock.patch.object(ingest, "_fetch_raw_stream", return_value=[payload[:20], payload[20:]]), \
+                mock.patch.object(ingest.blob_helpers, "get_content_hash", return_value=stored_hash), \
+                mock.patch.object(ingest.blob_helpers, "upload_json") as upload_json, \
+                mock.patch.object(ingest.storage_clients, "get_blob_client", return_value=self.blob_client), \
+                mock.patch.object(ingest.storage_clients, "get_container_client", return_value=self.container_client):
+            return ingest.load_transactions(""), upload_json
+
+    def test_transactions_reloaded_unchanged_are_not_uploaded(self):
+        # Arrange
+        self.load_transactions(10, None)
+        stored_hash = self.blob_client.upload_blob.call_args.kwargs["metadata"]["content_hash"]
+        self.blob_client.reset_mock()
+
+        # Act: only the server knowledge moved on
+        actual, upload_json = self.load_transactions(12, stored_hash)
+
+        # Assert: the state is kept, so the next delta is requested from the payload that was stored
+        self.assertEqual(actual, 0)
+        self.blob_client.upload_blob.assert_not_called()
+        self.blob_client.commit_block_list.assert_not_called()
+        upload_json.assert_not_called()
+
+    def test_transactions_are_uploaded_when_deltas_were_loaded(self):
+        # Arrange
+        self.load_transactions(10, None)
+        stored_hash = self.blob_client.upload_blob.call_args.kwargs["metadata"]["content_hash"]
+        self.container_client.list_blobs = lambda name_starts_with: [
+            SimpleNamespace(name=f"{ingest.TRANSACTION_DELTAS_PREFIX}000000000010.json")]
+
+        # Act
+        actual, upload_json = self.load_transactions(12, stored_hash)
+
+        # Assert: the full payload replaces the deltas
+        self.assertGreater(actual, 0)
+        self.container_client.delete_blob.assert_called_once()
+        self.assertEqual(upload_json.call_args.args[2]["full_server_knowledge"], 12)
+
+
+class LoadTransactionDeltaTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.blob_client = mock.Mock()
+
+    def load_delta(self, transactions: list[dict]) -> tuple[int, mock.Mock, mock.Mock]:
+        payload = json.dumps({"data": {"transactions": transactions, "server_knowledge": 12}}).encode()
+
+        with mock.patch.object(ingest, "_fetch_raw_stream", return_value=[payload]), \
+                mock.patch.object(ingest.blob_helpers, "download_json", return_value={"server_knowledge": 10}), \
+                mock.patch.object(ingest.blob_helpers, "upload_json") as upload_json, \
+                mock.patch.object(ingest.blob_helpers, "delete_blob") as delete_blob, \
+                mock.patch.object(ingest.storage_clients, "get_blob_client", return_value=self.blob_client):
+            return ingest.load_transactions("", incremental=True), upload_json, delete_blob
+
+    def test_empty_delta_is_not_written(self):
+        # Act
+        actual, upload_json, delete_blob = self.load_delta([])
+
+        # Assert: nothing to delete afterwards, the state still moves on
+        self.assertEqual(actual, 0)
+        self.blob_client.upload_blob.assert_not_called()
+        self.blob_client.commit_block_list.assert_not_called()
+        delete_blob.assert_not_called()
+        self.assertEqual(upload_json.call_args.args[2]["server_knowledge"], 12)
+
+    def test_delta_is_written(self):
+        # Act
+        actual, upload_json, _ = self.load_delta([{"id": "t1", "amount": -1000}])
+
+        # Assert
+        self.assertGreater(actual, 0)
+        self.assertEqual(self.blob_client.upload_blob.call_args.args[0][:2], b"\x1f\x8b")
+        self.assertEqual(upload_json.call_args.args[2]["server_knowledge"], 12)
+
+
+if __name__ == "__main__":
+    unittest.main()
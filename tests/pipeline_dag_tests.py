@@ -0,0 +1,148 @@
+from datetime import datetime
+import os
+import sys
+import unittest
+
+# Add the directory containing the modules to the `PYTHONPATH`
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "src")))
+
+import src.pipeline_dag as pipeline_dag  # noqa:E402 (module level import not at top of file)
+
+BRONZE_STEPS = ["load_transactions", "load_accounts", "load_current_budget_month", "silver_changed_activity"]
+
+
+class NightlyPipelineTestCase(unittest.TestCase):
+
+    def test_every_input_is_written_by_a_step(self):
+        # Act
+        steps = pipeline_dag.nightly_pipeline(datetime(2024, 3, 10))
+
+        # Assert
+        outputs = {dataset for step in steps.values() for dataset in step["outputs"]}
+        for name, step in steps.items():
+            self.assertLessEqual(set(step["inputs"]), outputs, name)
+
+    def test_previous_month_is_only_loaded_until_the_15th(self):
+        # Act
+        early = pipeline_dag.nightly_pipeline(datetime(2024, 3, 15))
+        late = pipeline_dag.nightly_pipeline(datetime(2024, 3, 16))
+
+        # Assert
+        self.assertEqual(early["transform_previous_budget_month"]["input"], "2024-02-01")
+        self.assertIn("silver/budget_months/2024-02-01", early["serve_category_scd_activity"]["inputs"])
+        self.assertNotIn("transform_previous_budget_month", late)
+        self.assertListEqual(late["serve_category_scd_activity"]["inputs"],
+                             ["silver/budget_months/2024-03-01", pipeline_dag.GOLD_STALE])
+
+    def test_full_refresh_on_the_first(self):
+        # Act & Assert
+        self.assertTrue(pipeline_dag.nightly_pipeline(datetime(2024, 3, 1))["load_transactions"]["input"])
+        self.assertFalse(pipeline_dag.nightly_pipeline(datetime(2024, 3, 2))["load_transactions"]["input"])
+
+
+class PipelineSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = pipeline_dag.PipelineScheduler(pipeline_dag.nightly_pipeline(datetime(2024, 3, 20)))
+
+    def complete(self, results: dict) -> list[str]:
+        for name, result in results.items():
+            self.scheduler.complete(name, result)
+        return self.scheduler.next_steps()
+
+    def test_steps_start_once_their_inputs_are_written(self):
+        # Arrange
+        self.assertListEqual(self.scheduler.next_steps(), BRONZE_STEPS)
+
+        # Act: the transactions are still loading
+        started = self.complete({
+            "load_accounts": {"changed": True},
+            "load_current_budget_month": {"changed": True},
+            "silver_changed_activity": False,
+        })
+
+        # Assert
+        self.assertListEqual(started, ["transform_accounts", "transform_current_budget_month"])
+
+        # Act
+        started = self.complete({"transform_accounts": 100})
+
+        # Assert: the accounts dim does not wait for the budget month
+        self.assertListEqual(started, ["serve_accounts_dim_activity"])
+
+    def test_net_worth_only_waits_for_its_inputs(self):
+        # Arrange
+        self.scheduler.next_steps()
+        self.complete({name: {"changed": True} for name in BRONZE_STEPS[:3]} | {"silver_changed_activity": False})
+        self.complete({"transform_transactions": 100, "transform_accounts": 100})
+
+        # Act
+        started = self.complete({"create_transactions_fact_activity": 100, "serve_accounts_dim_activity": 100})
+
+        # Assert: the category SCD is still running
+        self.assertIn("serve_net_worth_fact_activity", started)
+        self.assertNotIn("serve_category_scd_activity", self.scheduler.changed)
+
+    def test_unchanged_inputs_skip_the_steps_after_them(self):
+        # Arrange
+        self.scheduler.next_steps()
+
+        # Act
+        started = self.complete({
+            "load_transactions": {"changed": False},
+            "load_accounts": {"changed": True},
+            "load_current_budget_month": {"changed": False},
+            "silver_changed_activity": False,
+        })
+
+        # Assert: the debt transactions are built from the accounts
+        self.assertListEqual(started, ["transform_transactions", "transform_accounts"])
+        self.assertListEqual(self.scheduler.skipped, [
+            "transform_current_budget_month", "serve_category_scd_activity", "serve_category_dim_activity",
+            "serve_category_variance_activity"])
+
+    def test_skipped_steps_count_as_written(self):
+        # Arrange
+        self.scheduler.next_steps()
+        self.complete({
+            "load_transactions": {"changed": False},
+            "load_accounts": {"changed": True},
+            "load_current_budget_month": {"changed": False},
+            "silver_changed_activity": False,
+        })
+        self.complete({"transform_transactions": 100, "transform_accounts": 100})
+        self.complete({"create_transactions_fact_activity": 100, "serve_payee_dim_activity": 100})
+
+        # Act
+        started = self.complete({"serve_accounts_dim_activity": 100})
+
+        # Assert: the age of money does not wait for the skipped category dim
+        self.assertListEqual(started, ["serve_net_worth_fact_activity", "serve_age_of_money_activity"])
+
+    def test_stale_gold_is_rebuilt_without_changes(self):
+        # Arrange
+        self.scheduler.next_steps()
+
+        # Act
+        started = self.complete({name: {"changed": False} for name in BRONZE_STEPS[:3]} | {"silver_changed_activity": True})
+
+        # Assert
+        self.assertListEqual(started, [
+            "serve_category_scd_activity", "create_transactions_fact_activity", "serve_category_dim_activity",
+            "serve_accounts_dim_activity", "serve_payee_dim_activity"])
+
+    def test_nothing_runs_when_nothing_changed(self):
+        # Arrange
+        self.scheduler.next_steps()
+
+        # Act
+        started = self.complete({name: {"changed": False} for name in BRONZE_STEPS[:3]} | {"silver_changed_activity": False})
+
+        # Assert: every step is done
+        self.assertListEqual(started, [])
+        self.assertSetEqual(self.scheduler.started, set(self.scheduler.steps))
+
+
+if __name__ == "__main__":
+    unittest.main()
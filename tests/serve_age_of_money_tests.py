@@ -1,13 +1,26 @@
+from types import SimpleNamespace
+from unittest import mock
+import json
 import os
 import sys
 import unittest
+import warnings
+import numpy as np
 import pandas as pd
 
 # Add the directory containing the modules to the `PYTHONPATH`
 sys.path.insert(0, os.path.abspath(
     os.path.join(os.path.dirname(__file__), "..", "src")))
 
-from src.serve.serve_age_of_money import _compute_monthly_age_of_money  # noqa:E402 (module level import not at top of file)
+from src.serve.serve_age_of_money import \
+    AGE_OF_MONEY_BLOB, \
+    ACCOUNT_AGE_OF_MONEY_BLOB, \
+    CATEGORY_GROUP_AGE_OF_MONEY_BLOB, \
+    create_age_of_money_fact, \
+    _compute_age_of_money, \
+    _compute_monthly_age_of_money, \
+    _is_resumable, \
+    _allocate_outflows  # noqa:E402 (module level import not at top of file)
 
 
 class TestComputeMonthlyAgeOfMoney(unittest.TestCase):
@@ -25,14 +38,201 @@ class TestComputeMonthlyAgeOfMoney(unittest.TestCase):
 
     # TODO: think of a better, more robust way to test this function, possibly by decomposing it into smaller functions
     def test_compute_monthly_age_of_money(self):
-        result = _compute_monthly_age_of_money(
+        result, _ = _compute_monthly_age_of_money(
             self.transactions_fact, self.accounts_dim)
         expected_result = pd.DataFrame({
             "date": pd.to_datetime(["2021-01-02"]),
             "age_of_money": [1]
         })
 
-        pd.testing.assert_frame_equal(result, expected_result)
+        pd.testing.assert_frame_equal(result[["date", "age_of_money"]], expected_result)
+
+    def test_spending_before_income_has_negative_age(self):
+        transactions_fact = pd.DataFrame({
+            "date": ["2021-01-01", "2021-01-05", "2021-01-06"],
+            "account_id": [1, 1, 1],
+            "amount": [-50, 100, -10],
+            "category_name": ["Outflow", "Inflow: Ready to Assign", "Outflow"]
+        })
+        accounts_dim = pd.DataFrame({"account_id": [1], "on_budget": [True]})
+
+        result, _ = _compute_monthly_age_of_money(transactions_fact, accounts_dim)
+
+        # every day between the first and last outflow is included
+        expected_result = pd.DataFrame({
+            "date": pd.date_range("2021-01-01", "2021-01-06"),
+            "age_of_money": [-4, -3, -2, -1, 0, 1]
+        })
+        pd.testing.assert_frame_equal(result[["date", "age_of_money"]], expected_result)
+
+
+class TestComputeAgeOfMoney(unittest.TestCase):
+    def setUp(self):
+        self.transactions_fact = pd.DataFrame({
+            "date": ["2021-01-01", "2021-01-02", "2021-01-03"],
+            "account_id": [1, 2, 3],
+            "amount": [300, -200, 300],
+            "category_id": ["c1", "c2", "c1"],
+            "category_name": ["Inflow: Ready to Assign", "Outflow", "Inflow: Ready to Assign"]
+        })
+        self.accounts_dim = pd.DataFrame({
+            "account_id": [1, 2, 3],
+            "on_budget": [True, True, True]
+        })
+        self.category_dim = pd.DataFrame({
+            "category_id": ["c1", "c2"],
+            "category_group_id": ["g1", "g2"],
+            "category_group_name": ["Income", "Bills"]
+        })
+
+    def test_spending_is_split_by_account_and_category_group(self):
+        facts, _ = _compute_age_of_money(
+            self.transactions_fact, self.accounts_dim, self.category_dim)
+
+        self.assertEqual(facts[ACCOUNT_AGE_OF_MONEY_BLOB]["account_id"].tolist(), [2])
+        self.assertEqual(facts[CATEGORY_GROUP_AGE_OF_MONEY_BLOB]["category_group_name"].tolist(), ["Bills"])
+        self.assertEqual(facts[CATEGORY_GROUP_AGE_OF_MONEY_BLOB]["age_of_money"].tolist(), [1])
+
+    def test_rolling_age_only_moves_on_spending_days(self):
+        transactions_fact = pd.DataFrame({
+            "date": ["2021-01-01", "2021-01-05", "2021-01-06"],
+            "account_id": [1, 1, 1],
+            "amount": [-50, 100, -10],
+            "category_id": ["c2", "c1", "c2"],
+            "category_name": ["Outflow", "Inflow: Ready to Assign", "Outflow"]
+        })
+
+        facts, _ = _compute_age_of_money(transactions_fact, self.accounts_dim, self.category_dim)
+
+        expected_result = pd.DataFrame({
+            "date": pd.date_range("2021-01-01", "2021-01-06"),
+            "age_of_money": [-4, -3, -2, -1, 0, 1],
+            "rolling_age_of_money": [-4.0, -4.0, -4.0, -4.0, -4.0, -1.5]
+        })
+        pd.testing.assert_frame_equal(facts[AGE_OF_MONEY_BLOB], expected_result)
+
+    def test_resumed_run_matches_full_run(self):
+        # arrange: a few months of random income and spending over two accounts
+        rng = np.random.default_rng(0)
+        days = pd.date_range("2021-01-01", "2021-06-30")
+        count = 600
+        income = rng.random(count) < 0.1
+        transactions_fact = pd.DataFrame({
+            "date": rng.choice(days, count),
+            "account_id": rng.choice([1, 2], count),
+            "amount": np.where(income, np.round(rng.uniform(1000, 3000, count), 2),
+                               np.round(rng.uniform(-300, 20, count), 2)),
+            "category_id": np.where(income, "c1", "c2"),
+            "category_name": np.where(income, "Inflow: Ready to Assign", "Outflow")
+        }).sort_values("date", kind="stable").reset_index(drop=True)
+        through = pd.Timestamp("2021-03-31")
+
+        expected, _ = _compute_age_of_money(transactions_fact.copy(), self.accounts_dim, self.category_dim)
+
+        # act: checkpoint at the end of march and resume with the days after it
+        before, state = _compute_age_of_money(
+            transactions_fact[transactions_fact["date"] <= through].copy(), self.accounts_dim, self.category_dim,
+            through=through)
+        self.assertIsNotNone(state)
+        state = json.loads(json.dumps(state))
+        after, _ = _compute_age_of_money(
+            transactions_fact[transactions_fact["date"] > through].copy(), self.accounts_dim, self.category_dim,
+            state=state)
+
+        # assert
+        for blob_name, fact in expected.items():
+            actual = pd.concat([before[blob_name], after[blob_name]], ignore_index=True)
+            pd.testing.assert_frame_equal(actual, fact, check_dtype=False)
+
+
+class TestCreateAgeOfMoneyFact(unittest.TestCase):
+    def test_empty_previous_fact_keeps_the_new_fact(self):
+        # arrange: the checkpoint was written before any spending, so no days are kept from the previous run
+        previous_fact = pd.DataFrame({"date": [], "age_of_money": [], "rolling_age_of_money": []}, dtype=object)
+        fact = pd.DataFrame({
+            "date": pd.date_range("2021-02-01", "2021-02-02"),
+            "age_of_money": [3, 4],
+            "rolling_age_of_money": [3.0, 3.5]
+        })
+        blob_helpers = mock.MagicMock()
+        blob_helpers.download_parquet.return_value = previous_fact
+        blob_helpers.download_partitioned_parquet.return_value = pd.DataFrame({"date": fact["date"]})
+
+        # act
+        with mock.patch("src.serve.serve_age_of_money.blob_helpers", blob_helpers), \
+                mock.patch("src.serve.serve_age_of_money._load_state", return_value={"through": "2021-01-31"}), \
+                mock.patch("src.serve.serve_age_of_money._compute_age_of_money",
+                           return_value=({AGE_OF_MONEY_BLOB: fact}, None)), \
+                warnings.catch_warnings():
+            warnings.simplefilter("error")
+            create_age_of_money_fact("", incremental=True)
+
+        # assert
+        pd.testing.assert_frame_equal(blob_helpers.upload_parquet.call_args.args[2], fact)
+
+
+class TestIsResumable(unittest.TestCase):
+    def setUp(self):
+        self.accounts_dim = pd.DataFrame({"account_id": [1], "on_budget": [True]})
+        self.category_dim = pd.DataFrame({
+            "category_id": ["c1"],
+            "category_group_id": ["g1"],
+            "category_group_name": ["Income"]
+        })
+        self.state_blob = SimpleNamespace(last_modified=pd.Timestamp("2021-03-02"))
+        self.state = {
+            "through": "2021-02-28",
+            "months": ["2021-01-01", "2021-02-01"],
+            "account_ids": ["1"],
+            "category_groups": {"c1": "g1"},
+        }
+
+    def partitions(self, months: list[str]) -> dict:
+        return {pd.Timestamp(month): SimpleNamespace(last_modified=pd.Timestamp("2021-03-01")) for month in months}
+
+    def test_unchanged_months_are_resumable(self):
+        self.assertTrue(_is_resumable(
+            self.state, self.state_blob, self.partitions(["2021-01-01", "2021-02-01", "2021-03-01"]),
+            self.accounts_dim, self.category_dim))
+
+    def test_deleted_month_is_not_resumable(self):
+        # every transaction of january was deleted, so was its partition
+        self.assertFalse(_is_resumable(
+            self.state, self.state_blob, self.partitions(["2021-02-01", "2021-03-01"]),
+            self.accounts_dim, self.category_dim))
+
+    def test_months_are_recorded_with_the_checkpoint(self):
+        transactions_fact = pd.DataFrame({
+            "date": ["2021-01-01", "2021-02-03", "2021-03-01", "2021-03-05"],
+            "account_id": [1, 1, 1, 1],
+            "amount": [300, -20, 100, -10],
+            "category_id": ["c1", "c2", "c1", "c2"],
+            "category_name": ["Inflow: Ready to Assign", "Outflow", "Inflow: Ready to Assign", "Outflow"]
+        })
+
+        _, state = _compute_age_of_money(
+            transactions_fact, self.accounts_dim, self.category_dim, through=pd.Timestamp("2021-02-28"))
+
+        self.assertListEqual(state["months"], ["2021-01-01", "2021-02-01"])
+
+
+class TestAllocateOutflows(unittest.TestCase):
+    def test_balance_is_carried_into_the_next_bucket(self):
+        actual, _, _ = _allocate_outflows(np.array([100.0, 100.0]), np.array([-50.0, -60.0, -30.0]))
+
+        np.testing.assert_array_equal(actual, [0, 1, 1])
+
+    def test_one_new_bucket_per_day(self):
+        # the first day spends more than two buckets but only moves on to the second one
+        actual, _, _ = _allocate_outflows(np.array([10.0, 10.0, 10.0]), np.array([-25.0, 0.0]))
+
+        np.testing.assert_array_equal(actual, [1, 2])
+
+    def test_last_bucket_is_kept_when_spent(self):
+        actual, _, exhausted = _allocate_outflows(np.array([10.0]), np.array([-20.0, -5.0]))
+
+        np.testing.assert_array_equal(actual, [0, 0])
+        self.assertTrue(exhausted)
 
 
 if __name__ == '__main__':
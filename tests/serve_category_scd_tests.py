@@ -8,9 +8,11 @@ sys.path.insert(0, os.path.abspath(
     os.path.join(os.path.dirname(__file__), "..", "src")))
 
 from src.serve.serve_category_scd import \
-    _replace_max_with_none, \
+    _set_end_dates, \
     _create_category_sdc, \
-    _create_category_variance  # noqa:E402 (module level import not at top of file)
+    _update_category_scd, \
+    _create_category_variance, \
+    _update_category_variance  # noqa:E402 (module level import not at top of file)
 
 
 class TestCreateCategorySDC(unittest.TestCase):
@@ -49,28 +51,71 @@ class TestCreateCategorySDC(unittest.TestCase):
         pd.testing.assert_frame_equal(sdc_df, expected_df)
 
 
-class TestReplaceMaxWithNone(unittest.TestCase):
-    def test_replace_max_with_none(self):
-        # Create a sample DataFrame
+class TestSetEndDates(unittest.TestCase):
+
+    def test_set_end_dates(self):
+        # Arrange: A changes twice in january, B is budgeted once, A is budgeted once in february
         df = pd.DataFrame({
-            "id": ["A", "A", "B", "B"],
-            "start_date": ["2021-01-01", "2021-02-01", "2021-01-01", "2021-02-01"],
-            "end_date": ["2021-01-31", "2021-03-31", "2021-02-28", "2021-03-31"]
+            "month": pd.to_datetime(["2021-01-01", "2021-01-01", "2021-01-01", "2021-01-01", "2021-02-01"]),
+            "id": ["A", "A", "A", "B", "A"],
+            "budgeted": [100, 200, 300, 50, 10],
+            "start_date": pd.to_datetime(["2021-01-01", "2021-01-06", "2021-01-12", "2021-01-01", "2021-02-01"]),
+            "end_date": pd.to_datetime(["2021-01-05", "2021-01-08", "2021-01-20", "2021-01-31", "2021-02-28"]),
         })
 
-        # Group the DataFrame by `id` and apply the `_replace_max_with_none` function
-        grouped_df = df.groupby("id").apply(_replace_max_with_none)
+        # Act
+        actual_df = _set_end_dates(df)
 
-        # Reset the index of both DataFrames
-        grouped_df = grouped_df.reset_index(drop=True)
-        expected_df = pd.DataFrame({
-            "id": ["A", "A", "B", "B"],
-            "start_date": ["2021-01-01", "2021-02-01", "2021-01-01", "2021-02-01"],
-            "end_date": ["2021-01-31", None, "2021-02-28", None]
-        }).reset_index(drop=True)
+        # Assert: the latest row of every group is open, the row before it ends the day before the latest starts
+        expected_df = df.copy()
+        expected_df["end_date"] = pd.to_datetime(["2021-01-05", "2021-01-11", None, None, None])
+        pd.testing.assert_frame_equal(actual_df, expected_df)
+
+    def test_rows_are_ordered_by_group(self):
+        # Arrange
+        df = pd.DataFrame({
+            "month": pd.to_datetime(["2021-01-01", "2021-01-01", "2021-01-01"]),
+            "id": ["B", "A", "A"],
+            "budgeted": [50, 200, 100],
+            "start_date": pd.to_datetime(["2021-01-01", "2021-01-10", "2021-01-01"]),
+            "end_date": pd.to_datetime(["2021-01-31", "2021-01-31", "2021-01-05"]),
+        })
 
-        # Verify that the maximum `end_date` values were replaced with `None`
-        pd.testing.assert_frame_equal(grouped_df, expected_df)
+        # Act
+        actual_df = _set_end_dates(df)
+
+        # Assert
+        self.assertListEqual(actual_df["id"].tolist(), ["A", "A", "B"])
+        self.assertListEqual(actual_df["end_date"].tolist(), [pd.Timestamp("2021-01-09"), pd.NaT, pd.NaT])
+
+
+class TestUpdateCategorySCD(unittest.TestCase):
+
+    def _budget_months(self, rows):
+        df = pd.DataFrame(rows, columns=["month", "id", "budgeted", "snapshot_date"])
+        df["category_group_id"] = "g"
+        df["name"] = "Category " + df["id"]
+        df["category_group_name"] = "Group"
+        df["month"] = pd.to_datetime(df["month"])
+        df["snapshot_date"] = pd.to_datetime(df["snapshot_date"])
+        return df
+
+    def test_update_matches_full_rebuild(self):
+        # Arrange: a closed month, an open month that changes and a month that is removed
+        closed = [("2021-01-01", "A", 100, "2021-01-01"), ("2021-01-01", "B", 50, "2021-01-01"),
+                  ("2021-01-01", "A", 200, "2021-01-15")]
+        opened = [("2021-02-01", "B", 300, "2021-02-01"), ("2021-02-01", "A", 10, "2021-02-01")]
+        changed = opened + [("2021-02-01", "B", 400, "2021-02-10"), ("2021-02-01", "C", 5, "2021-02-10")]
+        removed = [("2021-03-01", "A", 1, "2021-03-01")]
+        scd_df = _create_category_sdc(self._budget_months(closed + opened + removed))
+        expected_df = _create_category_sdc(self._budget_months(closed + changed))
+
+        # Act
+        actual_df = _update_category_scd(
+            scd_df, self._budget_months(changed), [pd.Timestamp("2021-02-01"), pd.Timestamp("2021-03-01")])
+
+        # Assert
+        pd.testing.assert_frame_equal(actual_df, expected_df)
 
 
 class TestCreateCategoryVariance(unittest.TestCase):
@@ -98,6 +143,41 @@ class TestCreateCategoryVariance(unittest.TestCase):
         # assert
         pd.testing.assert_frame_equal(actual_df, expected_df)
 
+    def test_create_category_variance_uses_start_date_order(self):
+        # arrange: rows out of start date order
+        df = self.df.iloc[[1, 0, 3, 2]].reset_index(drop=True)
+        expected_df = pd.DataFrame({
+            "category_id": ['c1', 'c2'],
+            "name": ['cat1', 'cat2'],
+            "month": ['2022-01', '2022-02'],
+            "variance": [100, 100]
+        })
+
+        # act
+        actual_df = _create_category_variance(df)
+
+        # assert
+        pd.testing.assert_frame_equal(actual_df, expected_df)
+
+    def test_update_category_variance_matches_full_rebuild(self):
+        # arrange: the february rows of c2 change and a march month is added
+        changed_df = pd.concat([self.df, pd.DataFrame({
+            "category_id": ['c2', 'c1', 'c1'],
+            "name": ['cat2', 'cat1', 'cat1'],
+            "month": ['2022-02', '2022-03', '2022-03'],
+            "start_date": ['2022-02-03', '2022-03-01', '2022-03-02'],
+            "budgeted": [700, 10, 5]
+        })]).reset_index(drop=True)
+        variance_df = _create_category_variance(self.df)
+        expected_df = _create_category_variance(changed_df)
+        months = ['2022-02', '2022-03']
+
+        # act
+        actual_df = _update_category_variance(variance_df, changed_df[changed_df["month"].isin(months)], months)
+
+        # assert
+        pd.testing.assert_frame_equal(actual_df, expected_df)
+
 
 if __name__ == "__main__":
     unittest.main()
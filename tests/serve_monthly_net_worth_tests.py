@@ -1,3 +1,5 @@
+from datetime import datetime
+from types import SimpleNamespace
 import os
 import sys
 import pandas as pd
@@ -9,7 +11,13 @@ import unittest
 sys.path.insert(0, os.path.abspath(
     os.path.join(os.path.dirname(__file__), "..", "src")))
 
-from src.serve.serve_monthly_net_worth import _compute_monthly_net_worth  # noqa:E402 (module level import not at top of file)
+from src.serve.serve_monthly_net_worth import \
+    GRANULARITIES, \
+    _aggregate_daily_net_worth, \
+    _compute_net_worth, \
+    _changed_months, \
+    _month_running_totals, \
+    _opening_totals  # noqa:E402 (module level import not at top of file)
 
 
 class TestComputeMonthlyNetWorth(unittest.TestCase):
@@ -31,8 +39,8 @@ class TestComputeMonthlyNetWorth(unittest.TestCase):
                             "asset_running_total", "liability_running_total"]
 
         # act
-        net_worth_fact = _compute_monthly_net_worth(
-            self.transactions_fact, self.accounts_dim)
+        net_worth_fact = _compute_net_worth(
+            _aggregate_daily_net_worth(self.transactions_fact, self.accounts_dim), granularity="monthly")
         actual_columns = list(net_worth_fact.columns)
 
         # assert
@@ -43,8 +51,8 @@ class TestComputeMonthlyNetWorth(unittest.TestCase):
         expected_running_total = [100, -50, 300, -125]
 
         # act
-        net_worth_fact = _compute_monthly_net_worth(
-            self.transactions_fact, self.accounts_dim)
+        net_worth_fact = _compute_net_worth(
+            _aggregate_daily_net_worth(self.transactions_fact, self.accounts_dim), granularity="monthly")
         actual_running_total = list(net_worth_fact["running_total"])
 
         # assert
@@ -55,8 +63,8 @@ class TestComputeMonthlyNetWorth(unittest.TestCase):
         expected_asset_running_total = [100.0, np.nan, 300.0, np.nan]
 
         # act
-        net_worth_fact = _compute_monthly_net_worth(
-            self.transactions_fact, self.accounts_dim)
+        net_worth_fact = _compute_net_worth(
+            _aggregate_daily_net_worth(self.transactions_fact, self.accounts_dim), granularity="monthly")
         actual_asset_running_total = list(
             net_worth_fact["asset_running_total"])
 
@@ -69,8 +77,8 @@ class TestComputeMonthlyNetWorth(unittest.TestCase):
         expected_liability_running_total = [np.nan, -50.0, np.nan, -125.0]
 
         # act
-        net_worth_fact = _compute_monthly_net_worth(
-            self.transactions_fact, self.accounts_dim)
+        net_worth_fact = _compute_net_worth(
+            _aggregate_daily_net_worth(self.transactions_fact, self.accounts_dim), granularity="monthly")
         actual_liability_running_total = list(
             net_worth_fact["liability_running_total"])
 
@@ -83,8 +91,8 @@ class TestComputeMonthlyNetWorth(unittest.TestCase):
         expected_delta = [100, -50, 200, -75]
 
         # act
-        net_worth_fact = _compute_monthly_net_worth(
-            self.transactions_fact, self.accounts_dim)
+        net_worth_fact = _compute_net_worth(
+            _aggregate_daily_net_worth(self.transactions_fact, self.accounts_dim), granularity="monthly")
         actual_delta = list(net_worth_fact["delta"])
 
         # assert
@@ -97,8 +105,8 @@ class TestComputeMonthlyNetWorth(unittest.TestCase):
         expected_asset_type = ["asset", "liability", "asset", "liability"]
 
         # act
-        net_worth_fact = _compute_monthly_net_worth(
-            self.transactions_fact, self.accounts_dim)
+        net_worth_fact = _compute_net_worth(
+            _aggregate_daily_net_worth(self.transactions_fact, self.accounts_dim), granularity="monthly")
         actual_date = list(net_worth_fact["date"])
         actual_asset_type = list(net_worth_fact["asset_type"])
 
@@ -114,5 +122,120 @@ class TestComputeMonthlyNetWorth(unittest.TestCase):
                 self.fail(f"Expected: {expected_list}\nActual: {actual_list}")
 
 
+class TestComputeNetWorthGranularity(unittest.TestCase):
+    def setUp(self):
+        transactions_fact = pd.DataFrame({
+            "date": ["2020-01-01", "2020-01-01", "2020-01-08", "2020-01-09", "2020-02-03"],
+            "account_id": [1, 2, 1, 1, 2],
+            "amount": [100, -50, 200, 25, -75]
+        })
+        accounts_dim = pd.DataFrame({
+            "account_id": [1, 2],
+            "asset_type": ["asset", "liability"]
+        })
+        self.daily_net_worth = _aggregate_daily_net_worth(transactions_fact, accounts_dim)
+
+    def test_weekly_periods_start_on_monday(self):
+        # arrange
+        expected_date = [pd.Timestamp("2019-12-30")] * 2 + [pd.Timestamp("2020-01-06")] * 2 + \
+            [pd.Timestamp("2020-02-03")] * 2
+        expected_running_total = [100, -50, 325, -50, 325, -125]
+
+        # act
+        net_worth_fact = _compute_net_worth(self.daily_net_worth, "weekly")
+
+        # assert
+        self.assertListEqual(list(net_worth_fact["date"]), expected_date)
+        self.assertListEqual(list(net_worth_fact["running_total"]), expected_running_total)
+
+    def test_daily_fills_missing_asset_types(self):
+        # arrange
+        expected_delta = [100, -50, 200, 0, 25, 0, 0, -75]
+
+        # act
+        net_worth_fact = _compute_net_worth(self.daily_net_worth, "daily")
+
+        # assert
+        self.assertListEqual(list(net_worth_fact["delta"]), expected_delta)
+        self.assertEqual(net_worth_fact["running_total"].iloc[-1], -125)
+
+    def test_granularities_end_on_the_same_totals(self):
+        # act
+        totals = [_compute_net_worth(self.daily_net_worth, granularity).groupby("asset_type")["running_total"].last()
+                  for granularity in ["daily", "weekly", "monthly"]]
+
+        # assert
+        pd.testing.assert_series_equal(totals[0], totals[1])
+        pd.testing.assert_series_equal(totals[0], totals[2])
+
+
+class TestIncrementalNetWorth(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        dates = pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.integers(0, 365, 500), unit="D")
+        transactions_fact = pd.DataFrame({
+            "date": dates,
+            "account_id": rng.integers(1, 4, 500),
+            "amount": rng.integers(-100000, 100000, 500) / 100
+        })
+        accounts_dim = pd.DataFrame({
+            "account_id": [1, 2, 3],
+            "asset_type": ["asset", "asset", "liability"]
+        })
+        self.daily_net_worth = _aggregate_daily_net_worth(transactions_fact, accounts_dim)
+
+    def test_resumed_periods_match_full_run(self):
+        # arrange: resume from the totals persisted at the end of june, the first week of july starts in june
+        start_month = pd.Timestamp("2020-07-01")
+        read_month = pd.Timestamp("2020-06-01")
+        persisted = _month_running_totals(
+            self.daily_net_worth[self.daily_net_worth["date"] < read_month], ["asset", "liability"])
+        opening = pd.Series(persisted["2020-05-01"])
+        daily_net_worth = self.daily_net_worth[self.daily_net_worth["date"] >= read_month]
+
+        for granularity in ["daily", "weekly", "monthly"]:
+            start_date = start_month.to_period(GRANULARITIES[granularity]).start_time
+            expected = _compute_net_worth(self.daily_net_worth, granularity)
+            expected = expected[expected["date"] >= start_date].reset_index(drop=True)
+
+            # act
+            actual = _compute_net_worth(
+                daily_net_worth[daily_net_worth["date"] >= start_date], granularity, ["asset", "liability"],
+                _opening_totals(opening, daily_net_worth[daily_net_worth["date"] < start_date]))
+
+            # assert
+            pd.testing.assert_frame_equal(actual, expected)
+
+    def test_missing_asset_types_are_filled(self):
+        # arrange
+        daily_net_worth = self.daily_net_worth[self.daily_net_worth["asset_type"] == "asset"]
+
+        # act
+        net_worth_fact = _compute_net_worth(
+            daily_net_worth, "monthly", ["asset", "liability"], pd.Series({"asset": 10.0, "liability": -5.0}))
+
+        # assert
+        liabilities = net_worth_fact[net_worth_fact["asset_type"] == "liability"]
+        self.assertEqual(len(liabilities), 12)
+        self.assertTrue((liabilities["running_total"] == -5.0).all())
+
+    def test_changed_months(self):
+        # arrange
+        state = {"running_totals": {"2020-01-01": {}, "2020-02-01": {}, "2020-03-01": {}}}
+        state_blob = SimpleNamespace(last_modified=datetime(2020, 4, 1))
+        partitions = {
+            pd.Timestamp("2020-01-01"): SimpleNamespace(last_modified=datetime(2020, 2, 1)),
+            pd.Timestamp("2020-03-01"): SimpleNamespace(last_modified=datetime(2020, 4, 2)),
+            pd.Timestamp("2020-04-01"): SimpleNamespace(last_modified=datetime(2020, 4, 3)),
+        }
+
+        # act
+        actual = _changed_months(state, state_blob, partitions)
+
+        # assert
+        self.assertListEqual(sorted(actual), [pd.Timestamp("2020-02-01"), pd.Timestamp("2020-03-01"),
+                                              pd.Timestamp("2020-04-01")])
+
+
 if __name__ == "__main__":
     unittest.main()
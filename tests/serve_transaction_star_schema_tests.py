@@ -1,14 +1,63 @@
+import itertools
 import os
 import sys
 import unittest
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import mock
+from azure.core.exceptions import ResourceNotFoundError
 import pandas as pd
 
 # Add the directory containing the modules to the `PYTHONPATH`
 sys.path.insert(0, os.path.abspath(
     os.path.join(os.path.dirname(__file__), "..", "src")))
 
+import src.serve.serve_transactions_star_schema as star_schema  # noqa:E402 (module level import not at top of file)
 from src.serve.serve_transactions_star_schema import \
-    _create_category_dim  # noqa:E402 (module level import not at top of file)
+    _create_category_dim, \
+    _stale_months  # noqa:E402 (module level import not at top of file)
+
+
+class InMemoryBlobStore:
+    """ The blob and container clients used by `blob_helpers`, backed by a dict
+    """
+
+    def __init__(self):
+        self.blobs: dict[str, tuple[bytes, int]] = {}
+        self._clock = itertools.count()
+
+    def get_blob_client(self, connect_str: str, blob_name: str) -> SimpleNamespace:
+        def upload_blob(data, overwrite=False, **kwargs):
+            self.blobs[blob_name] = (bytes(data), next(self._clock))
+
+        def download_blob(offset=None, length=None):
+            data = self._get(blob_name)[0]
+            end = None if length is None else offset + length
+            return SimpleNamespace(readall=lambda: data[offset:end])
+
+        def delete_blob():
+            self._get(blob_name)
+            del self.blobs[blob_name]
+
+        return SimpleNamespace(
+            blob_name=blob_name,
+            upload_blob=upload_blob,
+            download_blob=download_blob,
+            get_blob_properties=lambda: self._properties(blob_name),
+            delete_blob=delete_blob)
+
+    def get_container_client(self, connect_str: str) -> SimpleNamespace:
+        return SimpleNamespace(list_blobs=lambda name_starts_with: [
+            self._properties(name) for name in sorted(self.blobs) if name.startswith(name_starts_with)])
+
+    def _get(self, blob_name: str) -> tuple[bytes, int]:
+        if blob_name not in self.blobs:
+            raise ResourceNotFoundError(f"blob `{blob_name}` not found")
+        return self.blobs[blob_name]
+
+    def _properties(self, blob_name: str) -> SimpleNamespace:
+        data, last_modified = self._get(blob_name)
+        return SimpleNamespace(name=blob_name, size=len(data), last_modified=last_modified)
 
 
 class TestCreateTransactionStarSchema(unittest.TestCase):
@@ -44,5 +93,67 @@ class TestCreateTransactionStarSchema(unittest.TestCase):
         pd.testing.assert_frame_equal(sdc_df, expected_df)
 
 
+class TestCreateTransactionsFact(unittest.TestCase):
+
+    def setUp(self):
+        self.store = InMemoryBlobStore()
+        for name in ["get_blob_client", "get_container_client"]:
+            patcher = mock.patch.object(star_schema.blob_helpers.storage_clients, name, getattr(self.store, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.transactions = pd.DataFrame({
+            "id": ["t1", "t2", "t3"],
+            "date": pd.to_datetime(["2021-01-05", "2021-02-03", "2021-02-20"]),
+            "amount": [-10.0, -20.0, 30.0],
+            "account_id": ["a1", "a1", "a2"],
+            "payee_id": ["p1", "p2", "p1"],
+            "category_id": ["c1", "c2", "c1"],
+            "debt_transaction_type": [None, None, None],
+        })
+        star_schema.blob_helpers.upload_partitioned_parquet("", "silver/transactions", self.transactions)
+        star_schema.create_transactions_fact("")
+
+    def test_month_without_transactions_is_removed_from_gold(self):
+        # Arrange: every transaction of february was deleted, so was its silver partition
+        remaining = self.transactions[self.transactions["date"] < "2021-02-01"]
+        star_schema.blob_helpers.upload_partitioned_parquet(
+            "", "silver/transactions", remaining, [pd.Timestamp("2021-02-01")])
+
+        # Act
+        star_schema.create_transactions_fact("")
+
+        # Assert
+        self.assertListEqual(sorted(star_schema.blob_helpers.list_partitions("", "gold/transactions_fact")),
+                             [pd.Timestamp("2021-01-01")])
+        fact = star_schema.blob_helpers.download_parquet("", "gold/transactions_fact.snappy.parquet")
+        self.assertListEqual(fact["id"].tolist(), ["t1"])
+
+        # Act & Assert: the next run has nothing left to rebuild
+        self.assertEqual(star_schema.create_transactions_fact(""), 0)
+
+
+class TestStaleMonths(unittest.TestCase):
+
+    def test_stale_months(self):
+        # arrange
+        january, february, march = pd.Timestamp("2021-01-01"), pd.Timestamp("2021-02-01"), pd.Timestamp("2021-03-01")
+        source_partitions = {
+            january: SimpleNamespace(last_modified=datetime(2021, 4, 1)),
+            february: SimpleNamespace(last_modified=datetime(2021, 4, 3)),
+        }
+        target_partitions = {
+            january: SimpleNamespace(last_modified=datetime(2021, 4, 2)),
+            february: SimpleNamespace(last_modified=datetime(2021, 4, 2)),
+            march: SimpleNamespace(last_modified=datetime(2021, 4, 2)),
+        }
+
+        # act
+        months = _stale_months(source_partitions, target_partitions)
+
+        # assert
+        self.assertListEqual(months, [february, march])
+
+
 if __name__ == "__main__":
     unittest.main()
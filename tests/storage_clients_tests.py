@@ -0,0 +1,41 @@
+import os
+import sys
+import unittest
+
+# Add the directory containing the modules to the `PYTHONPATH`
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "src")))
+
+import src.storage_clients as storage_clients  # noqa:E402 (module level import not at top of file)
+
+CONNECT_STR = "DefaultEndpointsProtocol=https;AccountName=test;AccountKey=dGVzdA==;EndpointSuffix=core.windows.net"
+
+
+class StorageClientsTestCase(unittest.TestCase):
+
+    def test_blob_service_client_is_cached_per_connection_string(self):
+        # Act
+        first = storage_clients.get_blob_service_client(CONNECT_STR)
+        second = storage_clients.get_blob_service_client(CONNECT_STR)
+        other = storage_clients.get_blob_service_client(CONNECT_STR.replace("test", "other"))
+
+        # Assert
+        self.assertIs(first, second)
+        self.assertIsNot(first, other)
+
+    def test_container_client_is_reused(self):
+        # Act
+        first = storage_clients.get_container_client(CONNECT_STR)
+        second = storage_clients.get_container_client(CONNECT_STR)
+
+        # Assert
+        self.assertIs(first, second)
+        self.assertEqual(first.container_name, storage_clients.CONTAINER)
+
+    def test_blob_client_targets_the_container(self):
+        # Act
+        actual = storage_clients.get_blob_client(CONNECT_STR, "silver/accounts.snappy.parquet")
+
+        # Assert
+        self.assertEqual(actual.container_name, storage_clients.CONTAINER)
+        self.assertEqual(actual.blob_name, "silver/accounts.snappy.parquet")
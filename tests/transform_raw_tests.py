@@ -1,6 +1,13 @@
 import sys
 import unittest
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import copy
+import time
+from types import SimpleNamespace
+from unittest import mock
 import json
 import os
 
@@ -14,33 +21,51 @@ import src.transformation.transform_raw as transform  # noqa:E402 (module level
 current_file_path = os.path.dirname(__file__)
 
 
+def read_months(df: pd.DataFrame, columns: list[str] = None, months=None, **kwargs) -> pd.DataFrame:
+    """ Reads a DataFrame the way `download_partitioned_parquet` reads its dataset """
+    if months is not None:
+        df = df[df["date"].dt.to_period("M").dt.to_timestamp().isin(set(months))].reset_index(drop=True)
+    return df if columns is None else df[columns]
+
+
+def write_months(previous_df: pd.DataFrame | None, df: pd.DataFrame, months=None) -> pd.DataFrame:
+    """ Writes a DataFrame the way `upload_partitioned_parquet` writes its dataset """
+    if previous_df is None or months is None:
+        return df
+    previous_df = previous_df[~previous_df["date"].dt.to_period("M").dt.to_timestamp().isin(set(months))]
+    return transform._sort_transactions(pd.concat([previous_df, read_months(df, months=months)]))
+
+
 class SubTransactionsTestCase(unittest.TestCase):
 
-    def test_given_nested_transactions_when_unnest_subtransactions_then_subtransctions_unnested(self):
+    def test_given_nested_transactions_when_transformed_then_subtransctions_unnested(self):
         # arrange
         with open(os.path.join(current_file_path, 'resources/nested_transaction.json'), 'r', encoding='utf-8') as f:
             transactions = json.load(f)
         with open(os.path.join(current_file_path, 'resources/expected_subtransactions.json'), 'r', encoding='utf-8') as f:
-            expected = json.load(f)
+            expected_rows = json.load(f)
+        expected = transform._to_dataframe(
+            [dict(row, amount=row["amount"] / 1000) for row in expected_rows], transform.TRANSACTION_SCHEMA)
 
         # act
-        unnested = list(transform._unnest_subtransactions(transactions))
+        unnested = transform._transform_transactions([transactions])
 
         # assert
         self.assertEqual(len(unnested), 2)
-        self.assertListEqual(unnested, expected)
+        pd.testing.assert_frame_equal(unnested, expected)
 
-    def test_given_unnested_transactions_when_unnest_subtransactions_then_transctions_returned(self):
+    def test_given_unnested_transactions_when_transformed_then_transctions_returned(self):
         # arrange
         with open(os.path.join(current_file_path, 'resources/unnested_transaction.json'), 'r', encoding='utf-8') as f:
             transaction = json.load(f)
 
         # act
-        unnested = list(transform._unnest_subtransactions(transaction))
+        unnested = transform._transform_transactions([transaction])
 
         # assert
         self.assertEqual(len(unnested), 1)
-        self.assertDictEqual(unnested[0], transaction)
+        self.assertEqual(unnested["id"][0], transaction["id"])
+        self.assertEqual(unnested["amount"][0], transaction["amount"] / 1000)
 
 
 class TransactionsTestCase(unittest.TestCase):
@@ -53,10 +78,274 @@ class TransactionsTestCase(unittest.TestCase):
             expected = json.load(f)
 
         # act
-        cleaned_transaction = transform._clean_transaction(transaction)
+        cleaned_transaction = transform._transform_transactions([transaction])
+
+        # assert
+        pd.testing.assert_frame_equal(
+            cleaned_transaction, transform._to_dataframe([expected], transform.TRANSACTION_SCHEMA))
+
+
+class TransformTransactionsTestCase(unittest.TestCase):
+
+    def test_given_missing_values_when_transformed_then_amounts_rounded_and_nulls_kept(self):
+        # arrange
+        with open(os.path.join(current_file_path, 'resources/unnested_transaction.json'), 'r', encoding='utf-8') as f:
+            unnested = json.load(f)
+        with open(os.path.join(current_file_path, 'resources/expected_cleaned_transaction.json'), 'r', encoding='utf-8') as f:
+            cleaned = json.load(f)
+        # half cent amounts are where vectorized rounding can differ from python's round
+        transactions = [dict(unnested, amount=-2999995, memo=None, approved=None),
+                        dict(unnested, amount=12345, subtransactions=None)]
+        expected = transform._to_dataframe([
+            dict(cleaned, amount=-2999.99, memo=None, approved=False),
+            dict(cleaned, amount=12.35),
+        ], transform.TRANSACTION_SCHEMA)
+
+        # act
+        actual = transform._transform_transactions(transactions)
+
+        # assert
+        pd.testing.assert_frame_equal(actual, expected)
+
+    def test_given_no_transactions_when_transformed_then_empty_frame_returned(self):
+        # act
+        actual = transform._transform_transactions([])
+
+        # assert
+        pd.testing.assert_frame_equal(actual, transform._to_dataframe([], transform.TRANSACTION_SCHEMA))
+
+
+class MergeTransactionDeltasTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.transactions = [
+            {"id": "a", "amount": 100, "deleted": False},
+            {"id": "b", "amount": 200, "deleted": False},
+        ]
+
+    def test_given_changed_transaction_when_deltas_merged_then_transaction_replaced(self):
+        # arrange
+        deltas = [[{"id": "a", "amount": 150, "deleted": False}]]
+
+        # act
+        merged = list(transform._merge_transaction_deltas(self.transactions, deltas))
+
+        # assert
+        self.assertListEqual(merged, [
+            {"id": "a", "amount": 150, "deleted": False},
+            {"id": "b", "amount": 200, "deleted": False},
+        ])
+
+    def test_given_new_and_deleted_transactions_when_deltas_merged_then_transactions_added_and_removed(self):
+        # arrange
+        deltas = [
+            [{"id": "c", "amount": 300, "deleted": False}],
+            [{"id": "b", "amount": 200, "deleted": True}, {"id": "c", "amount": 350, "deleted": False}],
+        ]
+
+        # act
+        merged = list(transform._merge_transaction_deltas(self.transactions, deltas))
 
         # assert
-        self.assertDictEqual(cleaned_transaction, expected)
+        self.assertListEqual(merged, [
+            {"id": "a", "amount": 100, "deleted": False},
+            {"id": "c", "amount": 350, "deleted": False},
+        ])
+
+
+class MergeTransactionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        with open(os.path.join(current_file_path, 'resources/nested_transaction.json'), 'r', encoding='utf-8') as f:
+            nested = json.load(f)
+        with open(os.path.join(current_file_path, 'resources/unnested_transaction.json'), 'r', encoding='utf-8') as f:
+            unnested = json.load(f)
+        with open(os.path.join(current_file_path, 'resources/mortgage_transactions.json'), 'r', encoding='utf-8') as f:
+            mortgage = json.load(f)
+        with open(os.path.join(current_file_path, 'resources/accounts.json'), 'r', encoding='utf-8') as f:
+            self.accounts = json.load(f)
+
+        # the fixtures share ids, give every transaction its own
+        self.mortgage = [dict(transaction, id=f"mortgage-{i}", deleted=False, subtransactions=[])
+                         for i, transaction in enumerate(mortgage)]
+        self.nested = dict(nested, id="nested")
+        self.unnested = dict(unnested, id="unnested")
+        self.transactions = [self.nested, self.unnested] + self.mortgage[:3]
+
+    def test_given_deltas_when_transactions_merged_then_output_matches_full_rebuild(self):
+        # arrange
+        delta = [
+            dict(self.unnested, amount=-12340),
+            dict(self.nested, deleted=True),
+            self.mortgage[3],
+            dict(self.unnested, id="new", date="2023-07-15"),
+        ]
+        transactions_df, debt_transactions_df = transform._build_transactions(
+            copy.deepcopy(self.transactions), self.accounts)
+        expected_transactions_df, expected_debt_transactions_df = transform._build_transactions(
+            transform._merge_transaction_deltas(copy.deepcopy(self.transactions), [copy.deepcopy(delta)]),
+            self.accounts)
+
+        # act
+        merged_df, actual_debt_transactions_df, changed_months = self._merge(
+            self._round_trip(transactions_df), self._round_trip(debt_transactions_df), [delta])
+        actual_transactions_df = write_months(transactions_df, merged_df, changed_months)
+
+        # assert
+        self.assertEqual(self._to_parquet(actual_transactions_df),
+                         self._to_parquet(expected_transactions_df))
+        self.assertEqual(self._to_parquet(actual_debt_transactions_df),
+                         self._to_parquet(expected_debt_transactions_df))
+
+    def test_given_deleted_transaction_when_transactions_merged_then_transaction_removed(self):
+        # arrange
+        transactions_df, debt_transactions_df = transform._build_transactions(
+            copy.deepcopy(self.transactions), self.accounts)
+
+        # act
+        merged_df, _, changed_months = self._merge(
+            transactions_df, debt_transactions_df, [[dict(self.nested, deleted=True)]])
+        actual_df = write_months(transactions_df, merged_df, changed_months)
+
+        # assert
+        self.assertNotIn("nested", set(actual_df["id"]))
+        self.assertEqual(len(actual_df), len(transactions_df) - 2)
+
+    def test_given_small_batches_when_transactions_built_then_output_matches_single_batch(self):
+        # arrange
+        expected_df, expected_debt_df = transform._build_transactions(copy.deepcopy(self.transactions), self.accounts)
+        batch_size = transform.TRANSACTION_BATCH_SIZE
+        transform.TRANSACTION_BATCH_SIZE = 2
+
+        # act
+        try:
+            actual_df, actual_debt_df = transform._build_transactions(
+                iter(copy.deepcopy(self.transactions)), self.accounts)
+        finally:
+            transform.TRANSACTION_BATCH_SIZE = batch_size
+
+        # assert
+        pd.testing.assert_frame_equal(actual_df, expected_df)
+        pd.testing.assert_frame_equal(actual_debt_df, expected_debt_df)
+
+    def test_given_merged_transactions_when_changed_months_computed_then_only_changed_months_returned(self):
+        # arrange
+        transactions_df, debt_transactions_df = transform._build_transactions(
+            copy.deepcopy(self.transactions), self.accounts)
+
+        # act
+        _, _, changed_months = self._merge(
+            transactions_df, debt_transactions_df, [[dict(self.nested, deleted=True)]])
+
+        # assert
+        self.assertListEqual(changed_months, [pd.Timestamp("2021-01-01")])
+
+    def _merge(self, transactions_df: pd.DataFrame, debt_transactions_df: pd.DataFrame, deltas: list[list[dict]]):
+        with mock.patch.object(transform.blob_helpers, "download_parquet", return_value=debt_transactions_df), \
+                mock.patch.object(transform.blob_helpers, "download_partitioned_parquet",
+                                  side_effect=lambda connect_str, dataset, **kwargs: read_months(transactions_df, **kwargs)):
+            return transform._merge_transactions("", deltas, self.accounts)
+
+    def _to_parquet(self, df: pd.DataFrame) -> bytes:
+        buffer = pa.BufferOutputStream()
+        pq.write_table(pa.Table.from_pandas(df), buffer)
+        return buffer.getvalue().to_pybytes()
+
+    def _round_trip(self, df: pd.DataFrame) -> pd.DataFrame:
+        return pq.read_table(pa.BufferReader(self._to_parquet(df))).to_pandas()
+
+
+class IncrementalTransformTransactionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        with open(os.path.join(current_file_path, 'resources/unnested_transaction.json'), 'r', encoding='utf-8') as f:
+            unnested = json.load(f)
+        with open(os.path.join(current_file_path, 'resources/mortgage_transactions.json'), 'r', encoding='utf-8') as f:
+            mortgage = json.load(f)
+        with open(os.path.join(current_file_path, 'resources/accounts.json'), 'r', encoding='utf-8') as f:
+            self.debt_accounts = json.load(f)
+
+        # the mortgage account is tracked without its interest rates at first
+        self.accounts = [dict(account, debt_interest_rates={}, debt_escrow_amounts={})
+                         for account in self.debt_accounts]
+        self.mortgage = [dict(transaction, id=f"mortgage-{i}", deleted=False, subtransactions=[])
+                         for i, transaction in enumerate(mortgage)]
+        self.unnested = dict(unnested, id="unnested", deleted=False)
+        self.raw_transactions = [self.unnested] + self.mortgage[:3]
+        # deltas keyed by the server knowledge they were requested with
+        self.deltas = {}
+        self.store = {"bronze/transactions_state.json": {"full_server_knowledge": 5, "server_knowledge": 5}}
+
+    def transform(self, accounts: list[dict]) -> None:
+        with mock.patch.object(transform, "_download_blob", return_value={"data": {"accounts": accounts}}), \
+                mock.patch.object(transform, "_stream_blob_items",
+                                  side_effect=lambda *args: iter(copy.deepcopy(self.raw_transactions))), \
+                mock.patch.object(transform, "_list_transaction_deltas",
+                                  side_effect=lambda connect_str, knowledge: [
+                                      name for name in sorted(self.deltas) if name >= knowledge]), \
+                mock.patch.object(transform, "_download_transaction_deltas",
+                                  side_effect=lambda connect_str, names: (
+                                      copy.deepcopy(self.deltas[name]) for name in names)), \
+                mock.patch.object(transform.blob_helpers, "download_json", side_effect=self.download), \
+                mock.patch.object(transform.blob_helpers, "download_parquet", side_effect=self.download), \
+                mock.patch.object(transform.blob_helpers, "download_partitioned_parquet",
+                                  side_effect=self.download_months) as self.download_partitioned_parquet, \
+                mock.patch.object(transform.blob_helpers, "upload_json", side_effect=self.upload), \
+                mock.patch.object(transform.blob_helpers, "upload_parquet", side_effect=self.upload), \
+                mock.patch.object(transform.blob_helpers, "upload_partitioned_parquet", side_effect=self.upload_months):
+            transform.transform_transactions("", incremental=True)
+
+    def download(self, connect_str, blob_name):
+        return self.store.get(blob_name)
+
+    def upload(self, connect_str, blob_name, data, *args):
+        self.store[blob_name] = data
+        return 0
+
+    def download_months(self, connect_str, dataset, **kwargs):
+        return read_months(self.store[dataset], **kwargs)
+
+    def upload_months(self, connect_str, dataset, df, months=None):
+        self.store[dataset] = write_months(self.store.get(dataset), df, months)
+        return 0
+
+    def load_delta(self, delta: list[dict]) -> None:
+        bronze_state = self.store["bronze/transactions_state.json"]
+        self.deltas[bronze_state["server_knowledge"]] = delta
+        bronze_state["server_knowledge"] += 3
+
+    def test_given_account_becomes_debt_account_when_merged_then_output_matches_full_rebuild(self):
+        # arrange
+        self.transform(self.accounts)
+        self.load_delta([dict(self.unnested, amount=-12340)])
+        self.transform(self.accounts)
+
+        # act: the rates of the mortgage are added along with its next payment
+        self.load_delta([self.mortgage[3]])
+        self.transform(self.debt_accounts)
+
+        # assert: the interest is calculated from the whole mortgage history
+        expected_df, expected_debt_df = transform._build_transactions(
+            transform._merge_transaction_deltas(
+                copy.deepcopy(self.raw_transactions), [self.deltas[name] for name in sorted(self.deltas)]),
+            self.debt_accounts)
+        pd.testing.assert_frame_equal(self.store[transform.TRANSACTIONS_DATASET], expected_df)
+        pd.testing.assert_frame_equal(self.store[transform.DEBT_TRANSACTIONS_BLOB], expected_debt_df)
+
+    def test_given_delta_when_merged_then_only_touched_months_loaded(self):
+        # arrange
+        self.raw_transactions.append(dict(self.unnested, id="later", date="2022-05-10"))
+        self.transform(self.accounts)
+        self.load_delta([dict(self.unnested, amount=-12340)])
+
+        # act
+        self.transform(self.accounts)
+
+        # assert: the debt account has no rates, so only the month of the changed transaction is loaded
+        months = [call.kwargs["months"] for call in self.download_partitioned_parquet.call_args_list
+                  if "months" in call.kwargs]
+        self.assertEqual(months, [{pd.Timestamp("2021-01-01")}])
+        self.assertEqual(self.store[transform.TRANSACTIONS_DATASET].set_index("id").loc["unnested", "amount"], -12.34)
 
 
 class MortgageTransactionsTestCase(unittest.TestCase):
@@ -76,7 +365,7 @@ class MortgageTransactionsTestCase(unittest.TestCase):
             expected = json.load(f)
 
         # act
-        actual = transform._add_mortgage_payments(transactions, accounts)
+        actual = transactions + transform._create_mortgage_payments(transactions, accounts)
 
         # assert
         actual_df = pd.DataFrame(actual)
@@ -93,74 +382,45 @@ class MortgageTransactionsTestCase(unittest.TestCase):
             abs(actual_df["amount"].sum() - expected_df["amount"].sum()) < 0.01, True)
 
 
-class TestEscrowAmountFromDate(unittest.TestCase):
+class TestCreateAccountMortgagePayments(unittest.TestCase):
     def setUp(self):
-        # Arrange: Set up the account as a class field
+        # Arrange: Set up the account and two months without transactions as class fields
         self.account = {"id": "123", "name": "Test Account",
+                        "debt_interest_rates": {"2022-01-01": 0},
                         "debt_escrow_amounts": {"2022-01-01": 100}}
+        self.monthly_amounts = pd.Series(
+            [0, 0], index=pd.DatetimeIndex(["2022-01-01", "2022-02-01"]))
 
-    def test_create_escrow_transaction(self):
-        # Arrange: Set up the row and expected keys
-        row = pd.Series({"date": pd.Timestamp('2022-01-01')})
-        expected_keys = [
-            "id",
-            "date",
-            "amount",
-            "memo",
-            "cleared",
-            "approved",
-            "flag_color",
-            "account_id",
-            "account_name",
-            "payee_id",
-            "payee_name",
-            "category_id",
-            "category_name",
-            "transfer_account_id",
-            "transfer_transaction_id",
-            "debt_transaction_type",
-            "subtransactions"]
-
-        # Act: Call the _create_escrow_transaction() function with the row and account
-        actual = transform._create_escrow_transaction(row, self.account)
-
-        # Assert: Check that the actual dictionary has the expected keys
-        self.assertEqual(list(actual.keys()), expected_keys)
-
-    def test_create_escrow_transaction_amount(self):
-        # Arrange: Set up the row and expected amount
-        row = pd.Series({"date": pd.Timestamp('2022-01-01')})
+    def test_escrow_amount(self):
+        # Arrange: Set up the expected amount
         expected_amount = -100
 
-        # Act: Call the _create_escrow_transaction() function with the row and account
-        actual = transform._create_escrow_transaction(row, self.account)
+        # Act: Call the _create_account_mortgage_payments() function with the monthly amounts and account
+        actual = transform._create_account_mortgage_payments(self.monthly_amounts, self.account)
 
-        # Assert: Check that the actual amount matches the expected amount
-        self.assertEqual(actual["amount"], expected_amount)
+        # Assert: Check that the escrow payment amount matches the expected amount
+        escrow = [payment for payment in actual if payment["debt_transaction_type"] == "escrow"]
+        self.assertEqual([payment["amount"] for payment in escrow], [expected_amount])
 
-    def test_create_escrow_transaction_date(self):
-        # Arrange: Set up the row and expected date
-        row = pd.Series({"date": pd.Timestamp('2022-01-01')})
-        expected_date = "2022-01-01"
+    def test_payments_start_in_second_month(self):
+        # Arrange: Set up the expected dates
+        expected_dates = ["2022-02-01", "2022-02-01"]
 
-        # Act: Call the _create_escrow_transaction() function with the row and account
-        actual = transform._create_escrow_transaction(row, self.account)
+        # Act: Call the _create_account_mortgage_payments() function with the monthly amounts and account
+        actual = transform._create_account_mortgage_payments(self.monthly_amounts, self.account)
 
-        # Assert: Check that the actual date matches the expected date
-        self.assertEqual(actual["date"], expected_date)
+        # Assert: Check that the interest and escrow payments are dated the second month
+        self.assertEqual([payment["date"] for payment in actual], expected_dates)
 
 
-class TestCreateInterestTransaction(unittest.TestCase):
+class TestCreateDebtPayment(unittest.TestCase):
 
     def setUp(self):
         # Arrange: Set up the account as a class field
-        self.account = {"id": "123", "name": "Test Account",
-                        "debt_interest_rates": {"2022-01-01": 50000}}
+        self.account = {"id": "123", "name": "Test Account"}
 
-    def test_create_interest_transaction(self):
-        # Arrange: Set up the row and runningTotal, and expected keys
-        row = pd.Series({"date": pd.Timestamp('2022-01-01')})
-        runningTotal = 1000
+    def test_create_debt_payment(self):
+        # Arrange: Set up the expected keys
         expected_keys = [
             "id",
             "date",
@@ -181,41 +441,65 @@ class TestCreateInterestTransaction(unittest.TestCase):
             "subtransactions"
         ]
 
-        # Act: Call the _create_interest_transaction() function with the row, runningTotal, and account
-        actual = transform._create_interest_transaction(
-            row, runningTotal, self.account)
+        # Act: Call the _create_debt_payment() function with the account, date, amount and type
+        actual = transform._create_debt_payment(
+            self.account, pd.Timestamp('2022-01-01'), 1000, "interest")
 
         # Assert: Check that the actual dictionary has the expected keys
         self.assertEqual(list(actual.keys()), expected_keys)
 
-    def test_create_interest_transaction_amount(self):
-        # Arrange: Set up the row and runningTotal, and expected amount
-        row = pd.Series({"date": pd.Timestamp('2022-01-01')})
-        runningTotal = -1000000
-        expected_amount = -41667
-
-        # Act: Call the _create_interest_transaction() function with the row, runningTotal, and account
-        actual = transform._create_interest_transaction(
-            row, runningTotal, self.account)
-
-        # Assert: Check that the actual amount matches the expected amount
-        self.assertEqual(actual["amount"], expected_amount)
-
-    def test_create_interest_transaction_date(self):
-        # Arrange: Set up the row and runningTotal, and expected date
-        row = pd.Series({"date": pd.Timestamp('2022-01-01')})
-        runningTotal = 1000
+    def test_create_debt_payment_date(self):
+        # Arrange: Set up the expected date
         expected_date = "2022-01-01"
 
-        # Act: Call the _create_interest_transaction() function with the row, runningTotal, and account
-        actual = transform._create_interest_transaction(
-            row, runningTotal, self.account)
+        # Act: Call the _create_debt_payment() function with the account, date, amount and type
+        actual = transform._create_debt_payment(
+            self.account, pd.Timestamp('2022-01-01'), 1000, "interest")
 
         # Assert: Check that the actual date matches the expected date
         self.assertEqual(actual["date"], expected_date)
 
+    def test_create_debt_payment_id_is_deterministic(self):
+        # Act: Call the _create_debt_payment() function twice for the same month
+        first = transform._create_debt_payment(
+            self.account, pd.Timestamp('2022-01-01'), 1000, "interest")
+        second = transform._create_debt_payment(
+            self.account, pd.Timestamp('2022-01-01'), 2000, "interest")
+
+        # Assert: Check that the ids match
+        self.assertEqual(first["id"], second["id"])
+
 
-class TestFetchValueFromDate(unittest.TestCase):
+class TestCalculateInterest(unittest.TestCase):
+
+    def test_interest_amount(self):
+        # Arrange: Set up a balance at 50% APR and the expected interest
+        amounts = np.array([-1000000, 0])
+        interest_rates = np.array([0.5, 0.5])
+        expected_interest = [0, -41667]
+
+        # Act: Call the _calculate_interest() function without escrow
+        actual = transform._calculate_interest(amounts, interest_rates, np.zeros(2))
+
+        # Assert: Check that the interest matches the expected interest
+        self.assertEqual(actual, expected_interest)
+
+    def test_interest_includes_previous_interest_and_escrow(self):
+        # Arrange: Set up a balance at 12% APR with escrow and the expected interest
+        amounts = np.array([-1000000, 0, 0])
+        interest_rates = np.array([0.12, 0.12, 0.12])
+        escrow_amounts = np.array([0, 100000, 100000])
+        # month two accrues on -1000000 - 10000 - 100000
+        expected_interest = [0, -10000, -11100]
+
+        # Act: Call the _calculate_interest() function with escrow
+        actual = transform._calculate_interest(amounts, interest_rates, escrow_amounts)
+
+        # Assert: Check that the interest matches the expected interest
+        self.assertEqual(actual, expected_interest)
+
+
+class TestFetchValuesFromDates(unittest.TestCase):
 
     def setUp(self):
         # class level set up
@@ -227,8 +511,8 @@ class TestFetchValueFromDate(unittest.TestCase):
         date = pd.Timestamp('2022-01-02')
         expected_value = 100
 
-        # Act: Call the _fetch_value_from_date() function with the JSON object, date, and expected value
-        actual_value = transform._fetch_value_from_date(self.json_obj, date)
+        # Act: Call the _fetch_values_from_dates() function with the JSON object and date
+        actual_value = transform._fetch_values_from_dates(self.json_obj, pd.DatetimeIndex([date]))[0]
 
         # Assert: Check that the actual value matches the expected value
         self.assertEqual(actual_value, expected_value)
@@ -238,8 +522,8 @@ class TestFetchValueFromDate(unittest.TestCase):
         date = pd.Timestamp('2021-12-31')
         expected_value = 0
 
-        # Act: Call the _fetch_value_from_date() function with the JSON object, date, and expected value
-        actual_value = transform._fetch_value_from_date(self.json_obj, date)
+        # Act: Call the _fetch_values_from_dates() function with the JSON object and date
+        actual_value = transform._fetch_values_from_dates(self.json_obj, pd.DatetimeIndex([date]))[0]
 
         # Assert: Check that the actual value matches the expected value
         self.assertEqual(actual_value, expected_value)
@@ -249,8 +533,8 @@ class TestFetchValueFromDate(unittest.TestCase):
         date = pd.Timestamp('2022-04-04')
         expected_value = 300
 
-        # Act: Call the _fetch_value_from_date() function with the JSON object, date, and expected value
-        actual_value = transform._fetch_value_from_date(self.json_obj, date)
+        # Act: Call the _fetch_values_from_dates() function with the JSON object and date
+        actual_value = transform._fetch_values_from_dates(self.json_obj, pd.DatetimeIndex([date]))[0]
 
         # Assert: Check that the actual value matches the expected value
         self.assertEqual(actual_value, expected_value)
@@ -261,8 +545,8 @@ class TestFetchValueFromDate(unittest.TestCase):
         date = pd.Timestamp('2022-01-01')
         expected_value = 0
 
-        # Act: Call the _fetch_value_from_date() function with the empty JSON object, date, and expected value
-        actual_value = transform._fetch_value_from_date(json_obj, date)
+        # Act: Call the _fetch_values_from_dates() function with the empty JSON object and date
+        actual_value = transform._fetch_values_from_dates(json_obj, pd.DatetimeIndex([date]))[0]
 
         # Assert: Check that the actual value matches the expected value
         self.assertEqual(actual_value, expected_value)
@@ -469,3 +753,77 @@ class TestCleanBudgetMonth(unittest.TestCase):
 
 if __name__ == '__main__':
     unittest.main()
+
+
+class TestTransformBudgetMonth(unittest.TestCase):
+
+    def test_snapshots_are_combined_in_date_order(self):
+        # Arrange: list the snapshots out of order and finish the earliest downloads last
+        blob_names = [f"bronze/month/2023-09-01/2023-09-{day:02d}.json" for day in (3, 1, 2, 5, 4)]
+        container_client = SimpleNamespace(
+            list_blobs=lambda name_starts_with: [SimpleNamespace(name=name) for name in blob_names])
+
+        def download_blob(connect_str, blob_name):
+            day = int(blob_name[-7:-5])
+            time.sleep((6 - day) * 0.01)
+            return {"data": {"month": {"month": "2023-09-01", "categories": [{
+                "id": "123",
+                "category_group_id": "456",
+                "category_group_name": "Groceries",
+                "name": "Food",
+                "hidden": False,
+                "budgeted": day * 1000,
+                "activity": 0,
+                "balance": 0,
+            }]}}}
+
+        uploaded = {}
+
+        def upload_blob(connect_str, blob_name, rows, schema):
+            uploaded[blob_name] = rows
+            return 0
+
+        # Act
+        with mock.patch.object(transform.storage_clients, "get_container_client", return_value=container_client), \
+                mock.patch.object(transform, "_download_blob", side_effect=download_blob), \
+                mock.patch.object(transform, "_upload_blob", side_effect=upload_blob):
+            transform.transform_budget_month("", "2023-09-01", max_concurrency=5)
+
+        # Assert
+        rows = uploaded["silver/budget_months/2023-09-01.snappy.parquet"]
+        self.assertEqual([row["snapshot_date"] for row in rows], [f"2023-09-{day:02d}" for day in range(1, 6)])
+        self.assertEqual([row["budgeted"] for row in rows], [1.0, 2.0, 3.0, 4.0, 5.0])
+
+
+class TestBudgetMonthChanged(unittest.TestCase):
+
+    def setUp(self):
+        self.silver_blob = SimpleNamespace(last_modified=pd.Timestamp("2023-09-03 12:00"))
+
+    def changed(self, snapshots: list[tuple[int, str]]) -> bool:
+        blobs = [SimpleNamespace(name=f"bronze/month/2023-09-01/2023-09-{day:02d}.json",
+                                 last_modified=pd.Timestamp(f"2023-09-{day:02d} 02:42"),
+                                 metadata={"content_hash": content_hash})
+                 for day, content_hash in snapshots]
+        container_client = SimpleNamespace(list_blobs=lambda name_starts_with, include: list(reversed(blobs)))
+
+        with mock.patch.object(transform.storage_clients, "get_container_client", return_value=container_client), \
+                mock.patch.object(transform.blob_helpers, "get_blob_properties", return_value=self.silver_blob):
+            return transform.budget_month_changed("", "2023-09-01")
+
+    def test_repeated_snapshot_is_not_a_change(self):
+        # Act & Assert: the 4th repeats the 3rd, which was transformed
+        self.assertFalse(self.changed([(1, "a"), (2, "b"), (3, "c"), (4, "c")]))
+
+    def test_new_content_is_a_change(self):
+        # Act & Assert
+        self.assertTrue(self.changed([(1, "a"), (2, "b"), (3, "c"), (4, "d")]))
+
+    def test_repeated_snapshot_not_transformed_yet_is_a_change(self):
+        # Act & Assert: silver was built before the 2nd snapshot, e.g. a failed run
+        self.silver_blob.last_modified = pd.Timestamp("2023-09-01 12:00")
+        self.assertTrue(self.changed([(1, "a"), (2, "b"), (3, "b"), (4, "b")]))
+
+    def test_snapshots_without_hash_are_changes(self):
+        # Act & Assert
+        self.assertTrue(self.changed([(3, None), (4, None)]))
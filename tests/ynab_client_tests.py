@@ -0,0 +1,174 @@
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import asyncio
+import gzip
+import json
+import os
+import sys
+import unittest
+
+# Add the directory containing the modules to the `PYTHONPATH`
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from src.ingestion.ynab_client import \
+    TokenBucket, YnabClient, YnabRequestError  # noqa:E402 (module level import not at top of file)
+
+
+class StubYnab:
+    """ A local YNAB api answering the queued responses of a route in order
+    """
+
+    def __init__(self):
+        self.responses: dict[str, list] = {}
+        self.requests: list[web.Request] = []
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        self.requests.append(request)
+        status, body, headers = self.responses[request.match_info.get("endpoint", "")].pop(0)
+        return web.Response(status=status, body=body, headers=headers)
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/v1/budgets/budget-id/{endpoint:.*}", self.handle)
+        # the budget export
+        app.router.add_get("/v1/budgets/budget-id", self.handle)
+        return app
+
+
+class YnabClientTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.stub = StubYnab()
+        self.server = TestServer(self.stub.create_app())
+        await self.server.start_server()
+        self.client = YnabClient(
+            str(self.server.make_url("/v1/")), "budget-id", "token", TokenBucket(100, 100), max_backoff=0)
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.server.close()
+
+    async def test_fetch_json_accepts_gzip(self):
+        # Arrange
+        payload = {"data": {"accounts": [{"id": "a1"}]}}
+        self.stub.responses["accounts"] = [
+            (200, gzip.compress(json.dumps(payload).encode()), {"Content-Encoding": "gzip"})]
+
+        # Act
+        actual = await self.client.fetch_json("accounts", {"last_knowledge_of_server": 5})
+
+        # Assert
+        self.assertDictEqual(actual, payload)
+        request = self.stub.requests[0]
+        self.assertEqual(request.headers["Authorization"], "Bearer token")
+        self.assertIn("gzip", request.headers["Accept-Encoding"])
+        self.assertEqual(request.query["last_knowledge_of_server"], "5")
+
+    async def test_throttled_request_is_retried_after_retry_after(self):
+        # Arrange
+        self.stub.responses["months"] = [
+            (429, b"{}", {"Retry-After": "0"}),
+            (503, b"{}", {"Retry-After": "0"}),
+            (200, b'{"data": {"months": []}}', {}),
+        ]
+
+        # Act
+        actual = await self.client.fetch_json("months")
+
+        # Assert
+        self.assertDictEqual(actual, {"data": {"months": []}})
+        self.assertEqual(len(self.stub.requests), 3)
+
+    async def test_long_retry_after_fails(self):
+        # Arrange
+        self.stub.responses["months"] = [(429, b"{}", {"Retry-After": "3600"})]
+
+        # Act
+        with self.assertRaises(YnabRequestError) as context:
+            await self.client.fetch_json("months")
+
+        # Assert: the orchestrator retries later instead of the activity waiting an hour
+        self.assertEqual(context.exception.status, 429)
+        self.assertEqual(len(self.stub.requests), 1)
+
+    async def test_client_errors_are_not_retried(self):
+        # Arrange
+        self.stub.responses["months"] = [(404, b'{"error": {"id": "404.2"}}', {})]
+
+        # Act & Assert
+        with self.assertRaises(YnabRequestError):
+            await self.client.fetch_json("months")
+        self.assertEqual(len(self.stub.requests), 1)
+
+    async def test_retries_are_bounded(self):
+        # Arrange
+        self.client.max_retries = 2
+        self.stub.responses["months"] = [(500, b"{}", {})] * 3
+
+        # Act & Assert
+        with self.assertRaises(YnabRequestError):
+            await self.client.fetch_json("months")
+        self.assertEqual(len(self.stub.requests), 3)
+
+    async def test_synchronous_calls_share_the_client_loop(self):
+        # Arrange
+        payload = json.dumps({"data": {"transactions": list(range(1000))}}).encode()
+        self.stub.responses["transactions"] = [(200, gzip.compress(payload), {"Content-Encoding": "gzip"})]
+        self.stub.responses[""] = [(200, b'{"data": {"budget": {}}}', {})]
+        sync_client = YnabClient(str(self.server.make_url("/v1/")), "budget-id", "token", TokenBucket(100, 100))
+
+        # Act: from a worker thread, as an activity would
+        chunks = await asyncio.to_thread(lambda: list(sync_client.iter_chunks("transactions", chunk_size=256)))
+        budget = await asyncio.to_thread(sync_client.get_json, "")
+        await asyncio.to_thread(sync_client._run, sync_client.close())
+
+        # Assert
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b"".join(chunks), payload)
+        self.assertDictEqual(budget, {"data": {"budget": {}}})
+        self.assertEqual(self.stub.requests[1].path, "/v1/budgets/budget-id")
+
+
+class TokenBucketTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.now = 0.0
+
+        async def sleep(delay):
+            self.now += delay
+
+        self.bucket = TokenBucket(2, 0.5, clock=lambda: self.now, sleep=sleep)
+
+    async def test_bursts_up_to_capacity(self):
+        # Act
+        waited = [await self.bucket.acquire() for _ in range(3)]
+
+        # Assert: the third request waits for a token to refill
+        self.assertListEqual(waited, [0.0, 0.0, 2.0])
+
+    async def test_refills_over_time(self):
+        # Arrange
+        await self.bucket.acquire()
+        await self.bucket.acquire()
+        self.now += 4
+
+        # Act
+        waited = [await self.bucket.acquire() for _ in range(2)]
+
+        # Assert
+        self.assertListEqual(waited, [0.0, 0.0])
+
+    async def test_drain_after_throttling(self):
+        # Arrange
+        self.bucket.drain()
+
+        # Act
+        waited = await self.bucket.acquire()
+
+        # Assert
+        self.assertEqual(waited, 2.0)
+
+
+if __name__ == "__main__":
+    unittest.main()